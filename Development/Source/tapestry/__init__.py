@@ -1,4 +1,5 @@
 __version__ = "2.0.2"
 
 from .classes import *
+from .blocksort import *
 from .functions import *
@@ -0,0 +1,47 @@
+"""Defines the blocksort used by Tapestry to divide the files to be backed up
+between the blocks of a run. This is shared by both the unix and windows
+packing functions in functions.py.
+
+The sort is a best-fit decreasing bin-packing: files are placed largest-first
+into whichever open block has the least remaining space that will still hold
+them. Open blocks are kept in a list sorted by remaining capacity, so finding
+the best fit is a binary search rather than a scan over every block.
+
+"""
+
+from .classes import Block
+import bisect
+
+
+def sort_blocks(sizes, ops_list, max_size, name_base):
+    """Divides the files listed in sizes between as few blocks as possible.
+
+    :param sizes: a list of file identifiers sorted by file size, largest
+    first, as returned by build_recovery_index.
+    :param ops_list: the full ops list prepared by build_ops_list.
+    :param max_size: the maximum size of a block in bytes.
+    :param name_base: the block name, less the block number. Blocks are named
+    name_base-1, name_base-2, and so forth.
+    :return: a list of tapestry.Block objects, in block number order.
+    """
+    collection_blocks = []
+    if len(sizes) == 0:
+        return collection_blocks
+    smallest = ops_list[sizes[-1]]['fsize']
+    open_blocks = []  # (remaining capacity, block number) for blocks that are not yet full, kept sorted.
+    for item in sizes:
+        size = ops_list[item]['fsize']
+        position = bisect.bisect_left(open_blocks, (size, 0))
+        if position < len(open_blocks):  # The tightest open block that can still take this file.
+            remaining, counter = open_blocks.pop(position)
+            working_block = collection_blocks[counter - 1]
+        else:
+            counter = len(collection_blocks) + 1
+            working_block = Block((name_base + "-" + str(counter)), max_size, counter, smallest)
+            collection_blocks.append(working_block)
+        working_block.put(item, ops_list[item])  # build_ops_list splits anything larger than a block.
+        ops_list[item]['block'] = counter  # Recorded in every RIFF so recovery can fetch only the blocks it needs.
+        if working_block.remaining >= smallest:  # Block.full is set when the smallest file would fit exactly.
+            bisect.insort(open_blocks, (working_block.remaining, counter))
+
+    return collection_blocks
@@ -6,15 +6,238 @@ Classes are to be organized by general purpose - see block comments for guidance
 
 """
 
-import bz2
+from . import compression
+import array
+import collections.abc
+import fnmatch
 import ftplib
 import hashlib
+import io
+import itertools
 import json
+import mmap
 import multiprocessing as mp
 import os
 import pickle
 import shutil
+import struct
 import tarfile
+import threading
+
+hash_buffer_size = 2 ** 20  # Read size used whenever whole files are hashed.
+riff_batch_lines = 4096  # Index entries parsed at once by iter_riff.
+
+# The binary recovery index, or TRIX. A header, the run and block metadata as
+# JSON, a table of interned strings, and then one fixed-width record per file,
+# sorted by FID so that a file can be found by binary search.
+trix_magic = b"TRIX"
+trix_version = 1
+trix_header = struct.Struct("<4sHHIIQQQQ")  # Magic, version, spare, records, strings, then the section offsets.
+# Strings: fid, category, fpath, fname, run, ref, extra; then flags, fsize, block, segments, segment, spare, offset,
+# offset_data, seg_offset and the sha256 digest.
+trix_record = struct.Struct("<8IQ4I3Q32s")
+trix_none = 0xFFFFFFFF  # In a string column, the entry has no such key.
+trix_strings = ["fid", "category", "fpath", "fname", "run", "ref"]  # The string columns, then "extra" and the flags.
+trix_numbers = [("fsize", 2 ** 64), ("block", 2 ** 32), ("segments", 2 ** 32), ("segment", 2 ** 32),
+                ("offset", 2 ** 64), ("offset_data", 2 ** 64), ("seg_offset", 2 ** 64)]  # Each with its limit.
+trix_sha256 = 1 << len(trix_numbers)  # The flag bit set when the sha256 column holds a digest.
+
+# The ops list of a run is held by a FileTable in columns, one row per file, so
+# that a file costs a few fixed-width values rather than a dictionary of its own.
+file_table_numbers = ["fsize", "block", "offset", "offset_data"]  # Each absent from a row when -1.
+file_table_strings = ["category", "run"]  # Interned, and absent from a row when -1.
+file_table_digest = 1  # Flag: the digest column holds the row's sha256.
+file_table_unhashed = 2  # Flag: the row's sha256 is None, as it is until the file is hashed.
+file_table_full_path = 4  # Flag: the row's directory string is its whole fpath, which doesn't end in its fname.
+
+
+def hash_stream(stream):
+    """Returns the SHA256 hexdigest of everything left in a binary file
+    object, which is read hash_buffer_size bytes at a time so that memory use
+    doesn't grow with the size of the file.
+    """
+    hasher = hashlib.sha256()
+    chunk = stream.read(hash_buffer_size)
+    while chunk != b"":
+        hasher.update(chunk)
+        chunk = stream.read(hash_buffer_size)
+    return hasher.hexdigest()
+
+
+def add_located(tar, path, fid, locations, hash_good=None, segment=None):
+    """Adds a file to a tarfile being written and notes where it was placed,
+    so that recovery can later seek straight to it.
+
+    :param tar: a tarfile.TarFile open for writing.
+    :param path: absolute path to the file to add.
+    :param fid: the name to give the file in the tarfile.
+    :param locations: a dictionary, updated with fid: [header offset, data
+    offset], both in bytes from the start of the uncompressed tarfile.
+    :param hash_good: optionally, the known-good SHA256 hexdigest of the
+    file. If given, the bytes written into the tarfile are hashed on the way
+    through and compared to it.
+    :param segment: optionally, an (offset, length) tuple, if only that part
+    of the file is to be added.
+    :return: False if the bytes written did not match hash_good, else True.
+    """
+    header_offset = tar.offset
+    matched = True
+    if hash_good is None and segment is None:
+        tar.add(path, arcname=fid, recursive=False)
+    else:
+        tarinfo = tar.gettarinfo(path, arcname=fid)
+        if tarinfo.isreg():
+            with open(path, "rb") as f:
+                if segment is not None:  # Only part of a file too large for one block.
+                    f.seek(segment[0])
+                    tarinfo.size = segment[1]
+                reader = HashingReader(f)
+                tar.addfile(tarinfo, reader)
+            if hash_good is not None:
+                matched = reader.hexdigest() == hash_good
+        else:
+            tar.addfile(tarinfo)
+    padded_size = -(-tar.members[-1].size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    locations.update({fid: [header_offset, tar.offset - padded_size]})
+    return matched
+
+
+def write_segment(source, path, offset):
+    """Writes a segment of a file too large for one block into place, at its
+    offset in the restored file. Other segments may be written into the same
+    file at the same time, so the file is neither truncated nor replaced.
+
+    :param source: a readable binary file object holding the segment.
+    :param path: absolute path to the restored file.
+    :param offset: the position of the segment in the file, in bytes.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o666)
+    with os.fdopen(fd, "wb") as f:
+        f.seek(offset)
+        shutil.copyfileobj(source, f, hash_buffer_size)
+
+
+def known_hash(hashes, fid):
+    """Returns the known-good hash of fid from an optional dictionary of them,
+    or None if there is no dictionary.
+    """
+    if hashes is None:
+        return None
+    return hashes.get(fid)
+
+
+def iter_riff(lines):
+    """Reads a RIFF one index entry at a time, rather than loading the whole
+    index at once. RIFFs written by RiffWriter hold one entry per line and
+    are read line by line; older RIFFs, written as a single line, are loaded
+    whole instead.
+
+    :param lines: an iterable of the lines of the RIFF, as text or bytes,
+    such as a file object opened on it.
+    :return: a tuple of a dictionary of the RIFF's "metaBlock" and "metaRun"
+    and an iterator over its (FID, entry) pairs.
+    """
+    lines = iter(lines)
+    first = next(lines, "")
+    if isinstance(first, bytes):
+        first = first.decode("utf-8")
+        lines = (line.decode("utf-8") for line in lines)
+    if not first.rstrip().endswith('"index": {'):  # Written as a single line, before there was a RiffWriter.
+        unpacked = json.loads(first + "".join(lines))
+        index = unpacked.pop("index")
+        return unpacked, iter(index.items())
+
+    def entries():
+        batch = []  # Lines are parsed a few thousand at a time, which is much faster than one at a time.
+        for line in lines:
+            line = line.strip().rstrip(",")
+            if line == "}}" or len(batch) == riff_batch_lines:
+                yield from json.loads("{%s}" % ",".join(batch)).items()
+                batch = []
+            if line == "}}":
+                return
+            elif line != "":
+                batch.append(line)
+        raise json.JSONDecodeError("The RIFF ends before its index does.", "", 0)
+
+    metadata = json.loads(first + "}}")
+    del metadata["index"]  # Still empty, having been closed straight after it was opened.
+
+    return metadata, entries()
+
+
+def write_binary_index(metadata, entries, path):
+    """Writes a RIFF as a binary recovery index, which RecoveryIndex can read
+    without decoding every entry. Any key of an entry which does not fit one
+    of the fixed columns is kept as a JSON string in its "extra" column, so
+    nothing is lost in conversion. Each entry is packed into its record as it
+    is read, so the entries need not all be held as dictionaries at once.
+
+    :param metadata: a dictionary holding the RIFF's "metaRun" and, if it
+    has one, its "metaBlock", as returned by iter_riff.
+    :param entries: an iterable of (FID, entry) pairs, as from iter_riff.
+    :param path: the absolute path to write the binary index to.
+    :return: path, for convenience.
+    """
+    strings = {}  # String: its number in the string table.
+
+    def intern(value):
+        return strings.setdefault(value, len(strings))
+
+    records = {}  # FID, as bytes: its packed record, which are written in FID order.
+    for fid, entry in entries:
+        entry = dict(entry, fid=fid)
+        columns = []
+        for key in trix_strings:
+            if isinstance(entry.get(key), str):
+                columns.append(intern(entry.pop(key)))
+            else:
+                columns.append(trix_none)
+        flags = 0
+        numbers = []
+        for bit, (key, limit) in enumerate(trix_numbers):
+            value = entry.get(key)
+            if isinstance(value, int) and not isinstance(value, bool) and 0 <= value < limit:
+                flags |= 1 << bit
+                numbers.append(entry.pop(key))
+            else:
+                numbers.append(0)
+        digest = bytes(32)
+        try:
+            if len(entry.get("sha256", "")) == 64:
+                digest = bytes.fromhex(entry["sha256"])
+                flags |= trix_sha256
+                del entry["sha256"]
+        except (TypeError, ValueError):  # Not a hex digest, so it is kept with the other extra keys.
+            pass
+        extra = intern(json.dumps(entry)) if len(entry) > 0 else trix_none
+        records.update({fid.encode("utf-8"): trix_record.pack(*columns, extra, flags, numbers[0], numbers[1],
+                                                              numbers[2], numbers[3], 0, numbers[4], numbers[5],
+                                                              numbers[6], digest)})
+
+    meta = json.dumps({"metaRun": metadata["metaRun"], "metaBlock": metadata.get("metaBlock", {})}).encode("utf-8")
+    encoded = [string.encode("utf-8") for string in strings]  # In the order they were numbered.
+    meta_offset = trix_header.size
+    table_offset = meta_offset + len(meta)
+    data_offset = table_offset + 8 * (len(encoded) + 1)
+    records_offset = data_offset + sum(len(string) for string in encoded)
+    with open(path, "wb") as f:
+        f.write(trix_header.pack(trix_magic, trix_version, 0, len(records), len(encoded),
+                                 meta_offset, len(meta), table_offset, records_offset))
+        f.write(meta)
+        position = data_offset
+        for string in encoded:  # Each string runs from its offset to the next one's.
+            f.write(struct.pack("<Q", position))
+            position += len(string)
+        f.write(struct.pack("<Q", position))
+        for string in encoded:
+            f.write(string)
+        for fid in sorted(records):
+            f.write(records[fid])
+
+    return path
+
 
 # Define Exceptions
 
@@ -75,79 +298,409 @@ class ChildProcess(mp.Process):
                 self.ret.put(debug_message)
             except TypeError:
                 self.ret.put("Something has gone wrong - unexpected item in queue.")
+            except Exception as e:  # A task that raises must not take its worker down with it.
+                self.ret.put("Something has gone wrong - %s: %s" % (type(e).__name__, e))
             self.queue.task_done()
         return
 
 
-class TaskTarBuild(object):
-    """A simple task object which instructs the process to add a particular
-    file to a particular tarfile, all fully enumerated.
+class PoolTask(object):
+    """Wraps a task submitted to a WorkerPool, so that its result can be
+    matched back to it when it comes off the results queue.
     """
 
-    def __init__(self, tarf, fid, path, bname):
+    def __init__(self, ticket, task):
         """
-        Create the tarfile or, otherwise, add a file to it.
-        :param tarf: which tarfile to use, relative to the working directory
-        :param fid: GUID FID as a string.
-        :param path: absolute path to the file in need of backup
-        :param bname: block name, used as a key to the locks dictionary.
+        :param ticket: the integer the pool issued for this task.
+        :param task: any callable task object.
+        """
+        self.ticket = ticket
+        self.task = task
+
+    def __call__(self):
+        try:
+            result = self.task()
+        except Exception as e:
+            result = "Something has gone wrong - %s: %s" % (type(e).__name__, e)
+        return self.ticket, result
+
+
+class WorkerPool(object):
+    """A set of ChildProcess workers which is started once and then shared by
+    every stage of a run, rather than each stage starting and stopping its
+    own. Tasks are submitted to the pool and their results collected by ticket,
+    so callers never need to count poison pills.
+    """
+
+    def __init__(self, working_directory, workers=None, debug=False):
+        """Starts the workers.
+
+        :param working_directory: String to the absolute path of the desired
+        working directory.
+        :param workers: the number of worker processes; defaults to one per core.
+        :param debug: Boolean, activates the debugging statement.
+        """
+        if workers is None:
+            workers = os.cpu_count()
+        self.tasks = mp.JoinableQueue()
+        self.results = mp.Queue()
+        self.next_ticket = 0
+        self.pending = 0
+        self.workers = []
+        for i in range(max(workers, 1)):
+            self.workers.append(ChildProcess(self.tasks, self.results, working_directory, {}, debug))
+        for w in self.workers:
+            w.start()
+
+    def submit(self, task):
+        """Queues a task for the workers.
+
+        :param task: any callable task object.
+        :return: the ticket which collect() will return alongside the result.
+        """
+        ticket = self.next_ticket
+        self.next_ticket += 1
+        self.pending += 1
+        self.tasks.put(PoolTask(ticket, task))
+        return ticket
+
+    def collect(self):
+        """Waits for the next task to finish.
+
+        :return: a (ticket, result) tuple.
+        """
+        while True:
+            message = self.results.get()
+            if isinstance(message, tuple):
+                self.pending -= 1
+                return message
+            # Anything else is a worker's own debugging output.
+
+    def map(self, tasks, progress=None):
+        """Runs a list of tasks and waits for all of them. This should not be
+        used while results from earlier submit() calls are still outstanding.
+
+        :param tasks: a list of callable task objects.
+        :param progress: optional callable, given (done, total, result) as each
+        task finishes.
+        :return: a list of the results, in the same order as tasks.
+        """
+        tickets = [self.submit(task) for task in tasks]
+        results = {}
+        while len(results) < len(tickets):
+            ticket, result = self.collect()
+            results[ticket] = result
+            if progress is not None:
+                progress(len(results), len(tickets), result)
+        return [results[ticket] for ticket in tickets]
+
+    def close(self):
+        """Stops every worker and waits for them to exit."""
+        for w in self.workers:
+            self.tasks.put(None)
+        for w in self.workers:
+            w.join()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TaskPackBlock(object):
+    """A task object which builds an entire block's tarfile in one pass. The
+    task is the only writer for its tarfile, so it keeps the archive open for
+    its whole lifetime and no locks are needed. Parallelism comes from running
+    several of these (one per block) at once.
+    """
+
+    def __init__(self, tarf, members, riff, locations=None, hashes=None, segments=None):
+        """Describe the block to be packed.
+
+        :param tarf: absolute path of the tarfile to create.
+        :param members: list of (fid, path) tuples to add to the tarfile, in
+        the order they should be written.
+        :param riff: absolute path to the block's RIFF file, which is added to
+        the tarfile as "recovery-riff".
+        :param locations: optional absolute path of a JSON file to write the
+        header and data offsets of each member to, as fid: [header, data].
+        :param hashes: optional dictionary of fid: known-good SHA256 hash. If
+        given, each file is hashed as it is written and any whose bytes do not
+        match are listed after the first line of the returned message.
+        :param segments: optional dictionary of fid: (offset, length), for
+        members which are segments of files too large for one block.
         """
         self.tarf = tarf
-        self.a = fid
-        self.b = path
-        self.block = bname
+        self.members = members
+        self.riff = riff
+        self.locations = locations
+        self.hashes = hashes
+        self.segments = segments or {}
 
     def __call__(self):
-        global dict_locks
+        locations = {}
+        failures = []
+        with tarfile.open(name=self.tarf, mode="w:") as tar:
+            tar.add(self.riff, arcname="recovery-riff", recursive=False)
+            for fid, path in self.members:
+                if not add_located(tar, path, fid, locations, known_hash(self.hashes, fid), self.segments.get(fid)):
+                    failures.append("File %s has an invalid hash.\n" % fid)
+        if self.locations is not None:
+            with open(self.locations, "w") as f:
+                json.dump(locations, f)
+
+        message = "Packed %s files into tarfile %s" % (len(self.members), self.tarf)
+        if len(failures) > 0:
+            message += "\n" + "".join(failures)
+        return message
+
+
+class TaskStreamBlock(object):
+    """A task which packs, compresses and encrypts a whole block in one pass.
+    The tarfile is written into a pipe, through the compressor, and straight
+    into gpg's stdin, so the only file written to disk is the finished .tap.
+    """
+
+    def __init__(self, name, members, riff, fp, out, gpg, compress, lvl, armor=True, codec="bz2", threads=0,
+                 locations=None, hashes=None, segments=None):
+        """Describe the block to be built and how to protect it.
+
+        :param name: the block name; the output file will be name+".tap".
+        :param members: list of (fid, path) tuples to add to the tarfile, in
+        the order they should be written.
+        :param riff: absolute path to the block's RIFF file, which is added to
+        the tarfile as "recovery-riff".
+        :param fp: the fingerprint of the PGP key to encrypt to.
+        :param out: The absolute path to the output directory.
+        :param gpg: An gnupg.GPG object provided to allow an interface with
+        the local GPG runtime.
+        :param compress: Boolean, whether or not to compress the tar stream.
+        :param lvl: Integer between 1 and 9 which determines the compression level
+        :param armor: Boolean, if False the output is binary OpenPGP rather
+        than ASCII-armored.
+        :param codec: the compression codec, as returned by
+        compression.resolve_codec.
+        :param threads: the number of threads zstd may use to compress.
+        :param locations: optional absolute path of a JSON file to write the
+        header and data offsets of each member to, as fid: [header, data].
+        :param hashes: optional dictionary of fid: known-good SHA256 hash. If
+        given, each file is hashed as it is written and any whose bytes do not
+        match are listed after the first line of the returned message.
+        :param segments: optional dictionary of fid: (offset, length), for
+        members which are segments of files too large for one block.
+        """
+        self.name = name
+        self.members = members
+        self.riff = riff
+        self.fp = fp
+        self.out = out
+        self.gpg = gpg
+        self.compress = compress
+        self.level = lvl
+        self.armor = armor
+        self.codec = codec
+        self.threads = threads
+        self.locations = locations
+        self.hashes = hashes
+        self.segments = segments or {}
+
+    def __call__(self):
+        tgt_output = os.path.join(self.out, self.name + ".tap")
+        fd_read, fd_write = os.pipe()
+        stream_out = os.fdopen(fd_read, "rb")
+        stream_in = os.fdopen(fd_write, "wb")
+        errors = []
+        failures = []
+        locations = {}
+
+        def produce():
+            try:
+                if self.compress:
+                    target = compression.open_compressor(stream_in, self.codec, self.level, self.threads)
+                else:
+                    target = stream_in
+                with tarfile.open(fileobj=target, mode="w|") as tar:
+                    tar.add(self.riff, arcname="recovery-riff", recursive=False)
+                    for fid, path in self.members:
+                        if not add_located(tar, path, fid, locations, known_hash(self.hashes, fid),
+                                           self.segments.get(fid)):
+                            failures.append("File %s has an invalid hash.\n" % fid)
+                if self.compress:
+                    target.close()
+            except (OSError, tarfile.TarError) as e:
+                errors.append(str(e))
+            finally:
+                stream_in.close()  # Signals end-of-file to gpg.
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        k = self.gpg.encrypt_file(stream_out, self.fp, output=tgt_output, armor=self.armor, always_trust=True)
+        stream_out.close()  # If gpg stopped reading early, this unblocks the producer.
+        producer.join()
+        if self.locations is not None and len(errors) == 0:
+            with open(self.locations, "w") as f:
+                json.dump(locations, f)
+
+        if k.ok and len(errors) == 0:
+            message = "Encryption Success for %s." % self.name
+            if len(failures) > 0:
+                message += "\n" + "".join(failures)
+            return message
+        elif not k.ok:
+            return "Encryption Failed for %s, status: %s" % (self.name, k.status)
+        else:
+            return "Packing Failed for %s, error: %s" % (self.name, errors[0])
+
 
-        f_lock = dict_locks[self.block]  # Aquires the lock indicated in the index value from the master
-        f_lock.acquire()
-        tar = tarfile.open(name=self.tarf, mode="a:")
-        tar.add(self.b, arcname=self.a, recursive=False)
-        tar.close()
-        f_lock.release()
+class TaskHashFiles(object):
+    """A task which computes the SHA256 digest of a batch of files. Files are
+    handed out in batches so that the cost of passing tasks between processes
+    stays small compared to the cost of the hashing itself.
+    """
+
+    def __init__(self, batch):
+        """Provide the batch of files to be hashed.
+
+        :param batch: a list of (fid, path) tuples, where path is the absolute
+        path to the file to be hashed. Files which can't be read, such as
+        those deleted since they were listed, are left out of the result.
+        """
+        self.batch = batch
+
+    def __call__(self):
+        digests = []
+        for fid, path in self.batch:
+            try:
+                with open(path, "rb") as contents:
+                    digests.append((fid, hash_stream(contents)))
+            except OSError:  # One unreadable file shouldn't cost the rest of the batch.
+                continue
 
-        return "Added %s to tarfile %s" % (self.b, self.tarf)
+        return digests
 
 
-class TaskTarUnpack(object):
-    """A simple object that describes a file to pull from a particular tarfile
-    and puts it back where it belongs. Absolute paths required.
+class TaskHashSegments(object):
+    """A task which hashes a file too large for one block, both as a whole and
+    in the block-sized segments it will be split into, in a single read.
     """
-    def __init__(self, tar, fid, category_dir, path_end):
-        """Initializing this object gives it all the information it needs to
-        unpack one particular file back to its original position in the
-        filesystem or to the fallback location.
+
+    def __init__(self, fid, path, segment_size):
+        """Provide the file to be hashed.
+
+        :param fid: the file's identifier.
+        :param path: the absolute path to the file.
+        :param segment_size: the size of each segment in bytes; the last
+        segment holds whatever is left.
+        """
+        self.fid = fid
+        self.path = path
+        self.segment_size = segment_size
+
+    def __call__(self):
+        whole = hashlib.sha256()
+        segments = []
+        try:
+            contents = open(self.path, "rb")
+        except OSError as e:
+            return "Could not hash %s: %s" % (self.path, e)
+        with contents:
+            while True:
+                segment = hashlib.sha256()
+                left = self.segment_size
+                while left > 0:
+                    chunk = contents.read(min(left, hash_buffer_size))
+                    if not chunk:
+                        break
+                    whole.update(chunk)
+                    segment.update(chunk)
+                    left -= len(chunk)
+                if left == self.segment_size:  # Nothing was read, so the file has ended.
+                    break
+                segments.append(segment.hexdigest())
+                if left > 0:
+                    break
+
+        return [self.fid, whole.hexdigest(), segments]
+
+
+class TaskUnpackBlock(object):
+    """A task which restores every wanted file from one tarball in a single
+    pass, rather than reopening and searching the tarball once per file.
+    Parallelism comes from unpacking several blocks at once.
+    """
+    def __init__(self, tar, destinations, offsets=None, copies=None):
+        """Describe the tarball to unpack and where its files belong.
 
         :param tar: string describing the absolute path of the relevant tarball
-        :param fid: The GUID FID that the file has been packed into the tarball as.
-        :param category_dir: full path to the top of the category.
-        :param path_end: sub-path from the category including the filename
+        :param destinations: a dictionary of FID: the absolute path the file is
+        to be restored to, or a (path, offset) tuple if the member is a segment
+        of a larger file. Members of the tarball not listed are skipped.
+        :param offsets: an optional dictionary of FID: the offset of the
+        member's header in the tarball, as recorded in the recovery index.
+        Members with a known offset are read directly; anything else is found
+        by reading through the tarball.
+        :param copies: an optional dictionary of FID: a list of further
+        destinations, in the same form, that the file is copied to once it is
+        restored, for files which were identical to it and so were not packed
+        themselves.
         """
         self.tar = tar
-        self.fid = fid
-        self.catdir = category_dir
-        self.pathend = path_end
+        self.destinations = destinations
+        self.offsets = offsets
+        self.copies = copies or {}
 
     def __call__(self):
-        path_end = self.pathend.strip('~/')
-        abs_path_out = os.path.join(self.catdir, path_end)
-        placement, name_proper = os.path.split(abs_path_out)
-        # split the pathend component into the subpath from the category dir, and the original filename
-        # print("Attempting to pull %s" % self.fid)
-        unpacking = True
-        while unpacking:
-            try:  # Issue 13: need to catch the raise from tf.extract() when workers collide
-                with tarfile.open(self.tar, "r:*") as tf:
-                    # print("Now opened: %s" % self.tar)  # Debugging statement, uncomment to use.
-                    tf.extract(self.fid, path=placement)  # the file is now located where it needs to be.
-                    # print("Extracted %s" % self.fid)  # Debugging statement, uncomment to use.
-                    placed = os.path.join(placement, self.fid)
-                    os.rename(placed, abs_path_out)  # and now it's named correctly.
-                    unpacking = False
-            except FileExistsError:
-                unpacking = True
-        return "Restored %s to %s" % (self.fid, abs_path_out)
+        remaining = dict(self.destinations)
+        restored = 0
+        errors = []
+        if self.offsets:
+            with compression.open_tar(self.tar) as tf:
+                tf.firstmember = None  # Already read by open(); next() would otherwise hand it back.
+                for offset in sorted(self.offsets.values()):  # In order, so the tarball is read forwards.
+                    tf.offset = offset
+                    restored += self.restore(tf, tf.next(), remaining, errors, self.copies)
+        if len(remaining) > 0:
+            with compression.open_tar(self.tar) as tf:
+                for member in tf:
+                    restored += self.restore(tf, member, remaining, errors, self.copies)
+                    if len(remaining) == 0:
+                        break
+
+        message = "Restored %s files from %s" % (restored, os.path.basename(self.tar))
+        if len(errors) > 0:
+            message += "; failed: %s" % "; ".join(errors)
+        return message
+
+    @staticmethod
+    def restore(tf, member, remaining, errors, copies):
+        """Extracts one member to its destination, if it is one we want, and
+        then copies it to wherever its duplicates belong.
+
+        :return: the number of files restored.
+        """
+        if member is None or member.name not in remaining:
+            return 0
+        restored = 0
+        extracted = None  # The first whole file restored, which any further copies are made from.
+        for target in [remaining.pop(member.name)] + copies.get(member.name, []):
+            try:
+                if isinstance(target, tuple):  # A segment, written into its file at its offset.
+                    write_segment(tf.extractfile(member), target[0], target[1])
+                elif extracted is None:
+                    placement = os.path.dirname(target)
+                    os.makedirs(placement, exist_ok=True)  # Another block may be creating the same directories.
+                    tf.extract(member, path=placement)
+                    os.replace(os.path.join(placement, member.name), target)  # and now it's named correctly.
+                    extracted = target
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copy2(extracted, target)
+                restored += 1
+            except (OSError, tarfile.TarError) as e:
+                errors.append("%s (%s)" % (target, e))
+        return restored
 
 
 class TaskCompress(object):
@@ -155,28 +708,34 @@ class TaskCompress(object):
     compresses it to a specified level
     """
 
-    def __init__(self, t, lvl):
+    def __init__(self, t, lvl, codec="bz2", threads=0):
         """Defines the absolute path to a tarfile and the level (1-9) of
         compression to apply.
 
         :param t: Absolute path to a tarfile
         :param lvl: Integer between 1 and 9 which determines the compression level
+        :param codec: the compression codec, as returned by
+        compression.resolve_codec.
+        :param threads: the number of threads zstd may use to compress.
         """
         self.tarf = t
         self.level = lvl
+        self.codec = codec
+        self.threads = threads
 
     def __call__(self):
-        with open(self.tarf, "rb") as b:
-            bz2d = self.tarf+".bz2"
-            bz2f = bz2.BZ2File(bz2d, "wb", compresslevel=self.level)
-            shutil.copyfileobj(b, bz2f)
+        compressed = self.tarf + compression.codec_extension(self.codec)
+        with open(self.tarf, "rb") as b, open(compressed, "wb") as c:
+            with compression.open_compressor(c, self.codec, self.level, self.threads) as out:
+                shutil.copyfileobj(b, out, hash_buffer_size)
 
-        return "Compressed %s to level %s" % (self.tarf, self.level)
+        return "Compressed %s to level %s with %s" % (self.tarf, self.level, self.codec)
 
 
 class TaskDecompress(object):
     """A simple task that points exactly to a tarfile to decompress. The task
-    can determine for itself if the file actually needs decompressing at runtime.
+    can determine for itself if the file actually needs decompressing at
+    runtime, and with which codec.
     """
 
     def __init__(self, t):
@@ -188,17 +747,17 @@ class TaskDecompress(object):
 
     def __call__(self):
         with open(self.tarf, "rb") as file:
-            signature = file.read(3)
-            # print(signature)
-            if signature.startswith(b"BZh"):  # Microheader that indicates a BZ2 file.
-                shutil.copy(self.tarf, (self.tarf + ".temp"))
-                with bz2.BZ2File((self.tarf + ".temp"), "rb") as compressed:
-                    with open(self.tarf, "wb") as uncompressed:
-                        shutil.copyfileobj(compressed, uncompressed)
-                os.remove(self.tarf+".temp")  # No sense in cluttering up the drive.
-                return "Decompressed %s" % self.tarf
-            else:
-                return "File is already decompressed."
+            signature = file.read(6)
+        codec = compression.detect_codec(signature)  # Each codec opens its stream with a magic number.
+        if codec is None:
+            return "File is already decompressed."
+        elif not compression.codec_available(codec):
+            return "Could not decompress %s, the %s codec is not installed." % (self.tarf, codec)
+        with compression.open_decompressor(self.tarf, codec) as compressed:
+            with open(self.tarf + ".temp", "wb") as uncompressed:
+                shutil.copyfileobj(compressed, uncompressed, hash_buffer_size)
+        os.replace(self.tarf + ".temp", self.tarf)
+        return "Decompressed %s" % self.tarf
 
 
 class TaskEncrypt(object):
@@ -206,7 +765,7 @@ class TaskEncrypt(object):
     encrypted, and the directory currently used for output.
 
     """
-    def __init__(self, t, fp, out, gpg):
+    def __init__(self, t, fp, out, gpg, armor=True):
         """This object expects the following arguments in order to signify a
         tarfile which needs to be encrypted. Calling the task will cause the
         tarfile to be encrypted using the gpg object passed to it at runtime.
@@ -216,19 +775,21 @@ class TaskEncrypt(object):
         :param out: The absolute path to the output directory.
         :param gpg: An gnupg.GPG object provided to allow an interface with
         the local GPG runtime.
+        :param armor: Boolean, if False the output is binary OpenPGP rather
+        than ASCII-armored.
         """
         self.tarf = t
         self.fp = fp
         self.out = out
         self.gpg = gpg
+        self.armor = armor
 
     def __call__(self):
         path, tapped = os.path.split(self.tarf)
-        tapped = tapped.strip(".bz2")
-        tapped = tapped.replace(".tar", ".tap")
+        tapped = os.path.splitext(compression.strip_extension(tapped))[0] + ".tap"
         tgt_output = os.path.join(self.out, tapped)
         with open(self.tarf, "rb") as tgt:
-            k = self.gpg.encrypt_file(tgt, self.fp, output=tgt_output, armor=True, always_trust=True)
+            k = self.gpg.encrypt_file(tgt, self.fp, output=tgt_output, armor=self.armor, always_trust=True)
         if k.ok:
             return "Encryption Success for %s." % self.tarf
         elif not k.ok:
@@ -238,7 +799,8 @@ class TaskEncrypt(object):
 class TaskDecrypt(object):
     """This task contains both the information and method to take a Tapestry
     blockfile and decrypt it. This task is naive in that it relies on another
-    task to do signature verification.
+    task to do signature verification. Both armored and binary blocks are
+    accepted; gpg identifies which it has been given by itself.
 
     """
     def __init__(self, block, working_directory, gpg):
@@ -301,39 +863,66 @@ class TaskSign(object):
                 return "Signing Failed for %s, status: %s" % (tapped, k.status)
 
 
-class TaskCheckIntegrity(object):
-    """A task, to be completed by ChildProcess, which contains the information
-    and operations needed to check the integrity of a file in the archive
-    against it's known-good composition, based on the MD5 hash.
+class TaskVerify(object):
+    """This task checks the detached signature of a Tapestry blockfile. It
+    does not decide whether the signer is to be trusted; that is left to the
+    caller, so that each signer need only be approved once.
+
     """
+    def __init__(self, block, gpg):
+        """This object expects the path of a block, whose signature is at the
+        same path with ".sig" appended, and a gnupg.GPG object.
 
-    def __init__(self, tar_file, fid, kg_hash):
-        """Provided with a tarfile, an FID found within it, and a known good
-        hash, returns True or False if the file matches, as well as a string
-        used in debugging.
+        :param block: Absolute path to the block to be verified.
+        :param gpg: An gnupg.GPG object provided to allow an interface with
+        the local GPG runtime.
+        """
+        self.block = block
+        self.gpg = gpg
+
+    def __call__(self):
+        if not os.path.exists(self.block + ".sig"):  # Unsigned, so it can't be valid.
+            return [self.block, False, None, None]
+        with open(self.block + ".sig", "rb") as k:
+            result = self.gpg.verify_file(k, self.block)
+        return [self.block, bool(result.valid), result.fingerprint, result.username]
+
+
+class TaskCheckBlock(object):
+    """A task which checks the integrity of every file in a block in a single
+    pass through the tarball, hashing each member in fixed-size chunks as it
+    goes, so that memory use stays the same however large the files are.
+    """
+
+    def __init__(self, tar_file, known_hashes):
+        """Provided with a tarfile and the known good hashes of the files in
+        it, returns True or False if every file matches, as well as a string
+        describing every file that did not.
 
         :param tar_file: string denoting absolute path to the tarball
-        :param fid: GUID file identifier of the file in question.
-        :param hash: the output of md5.hexdigest(), as found (e.g) in the RIFF
+        :param known_hashes: a dictionary of FID: sha256 hexdigest, as found
+        (e.g) in the RIFF. It may list files held by other blocks.
         """
         self.tarf = tar_file
-        self.fid = fid
-        self.hash_good = kg_hash
+        self.known_hashes = known_hashes
 
     def __call__(self):
-        hasher = hashlib.sha256()  # Had to change this because switched to sha256 from md5 in functions.py.
-        with tarfile.open(self.tarf, "r:*") as tarball:
-            file_under_test = tarball.extractfile(self.fid)
-            if file_under_test is None:
-                return [False, "File %s not found in block\n" % self.fid]
-            else:
-                hasher.update(file_under_test.read())
-        if hasher.hexdigest() == self.hash_good:
-            return [True, "File %s has a valid hash." % self.fid]
+        checked = 0
+        failures = []
+        with compression.open_tar(self.tarf) as tarball:
+            for member in tarball:
+                if member.name in ["recovery-riff", "recovery-pkl"] or not member.isfile():
+                    continue
+                checked += 1
+                hash_good = self.known_hashes.get(member.name)
+                if hash_good is None:
+                    failures.append("File %s is not in the recovery index.\n" % member.name)
+                elif hash_stream(tarball.extractfile(member)) != hash_good:
+                    failures.append("File %s has an invalid hash.\n" % member.name)
+        if len(failures) == 0:
+            return [True, "All %s files in %s have valid hashes." % (checked, os.path.basename(self.tarf))]
         else:
-            print(hasher.hexdigest())
-            print(self.hash_good)
-            return [False, "File %s has an invalid hash.\n" % self.fid]
+            return [False, "".join(failures)]
 
 
 # Define Package Overrides
@@ -352,6 +941,307 @@ class FTP_TLS(ftplib.FTP_TLS):  # With thanks to hynekcer
 
 # Define Utility Objects
 
+class RiffWriter(object):
+    """Writes a RIFF one index entry at a time, so that the index never has to
+    be serialized as a whole. Each entry is written on a line of its own,
+    which lets iter_riff read it back the same way; the file as a whole is
+    still the single JSON object that json.load expects.
+    """
+
+    def __init__(self, path, block_metadata, run_metadata):
+        """Open the RIFF and write its metadata.
+
+        :param path: the absolute path of the RIFF to write.
+        :param block_metadata: the dictionary to write as "metaBlock".
+        :param run_metadata: the dictionary to write as "metaRun".
+        """
+        self.path = path
+        self.file = open(path, "w")
+        self.file.write('{"metaBlock": %s, "metaRun": %s, "index": {\n'
+                        % (json.dumps(block_metadata), json.dumps(run_metadata)))
+        self.count = 0
+
+    def add(self, fid, entry):
+        """Writes one entry of the index."""
+        if self.count > 0:
+            self.file.write(",\n")
+        self.file.write("%s: %s" % (json.dumps(fid), json.dumps(dict(entry))))  # Such as a FileRecord.
+        self.count += 1
+
+    def close(self):
+        """Ends the index and closes the RIFF."""
+        self.file.write("\n}}\n")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:  # Leave no RIFF which looks complete but isn't.
+            self.file.close()
+            os.remove(self.path)
+
+
+class FileTable(collections.abc.MutableMapping):
+    """Mapping of FID: index entry which holds the ops list of a run, as built
+    by build_ops_list. Rather than a dictionary per file, each file is a row
+    of a set of columns: its size, block and offsets in arrays, its category
+    and run as numbers into a table of interned strings, its fpath as an
+    interned directory and its fname, and its SHA256 hash as 32 raw bytes.
+    Keys which fit no column, such as "ref" or "segment", are kept in a
+    dictionary for just the rows which have them.
+
+    Looking up a FID returns a FileRecord, which reads and writes the row in
+    place, so that the ops list can be handled as the dictionaries it used to
+    be. Deleting a FID leaves its row behind, so a record still in use keeps
+    working, and a record of this table stored under another FID shares its
+    row rather than being copied, just as a dictionary would be.
+    """
+
+    def __init__(self, entries=None):
+        """
+        :param entries: optionally, a mapping of FID: entry to start with.
+        """
+        self.rows = {}  # FID: row number.
+        self.strings = []  # Interned categories, directories and run names.
+        self.string_numbers = {}
+        self.names = bytearray()  # Every fname, encoded, one after another.
+        self.name_starts = array.array("q")  # Where each row's fname starts in names, or -1 for none.
+        self.name_ends = array.array("q")
+        self.directories = array.array("i")  # Each row's fpath, less its fname.
+        self.numbers = dict((key, array.array("q")) for key in file_table_numbers)
+        self.interned = dict((key, array.array("i")) for key in file_table_strings)
+        self.digests = bytearray()
+        self.flags = bytearray()
+        self.extra = {}  # Row number: dictionary of the row's keys which fit no column.
+        if entries is not None:
+            self.update(entries)
+
+    def __getitem__(self, fid):
+        return FileRecord(self, self.rows[fid])
+
+    def __setitem__(self, fid, entry):
+        if isinstance(entry, FileRecord) and entry.table is self:
+            self.rows[fid] = entry.row
+        else:
+            row = len(self.flags)
+            self.name_starts.append(-1)
+            self.name_ends.append(-1)
+            self.directories.append(-1)
+            for column in itertools.chain(self.numbers.values(), self.interned.values()):
+                column.append(-1)
+            self.digests.extend(bytes(32))
+            self.flags.append(0)
+            for key, value in entry.items():
+                self.put(row, key, value)
+            self.rows[fid] = row
+
+    def __delitem__(self, fid):
+        del self.rows[fid]
+
+    def __contains__(self, fid):
+        return fid in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def intern(self, string):
+        """Returns the number of a string in the table of interned strings,
+        adding it if it is new."""
+        number = self.string_numbers.get(string)
+        if number is None:
+            number = len(self.strings)
+            self.strings.append(string)
+            self.string_numbers.update({string: number})
+        return number
+
+    def has(self, row, key):
+        """Returns True if the row holds key."""
+        if key in self.extra.get(row, {}):  # Including values which didn't fit the key's column.
+            return True
+        elif key == "fname":
+            return self.name_starts[row] != -1
+        elif key == "fpath":
+            return self.directories[row] != -1
+        elif key == "sha256":
+            return self.flags[row] & (file_table_digest | file_table_unhashed) != 0
+        elif key in self.numbers:
+            return self.numbers[key][row] != -1
+        elif key in self.interned:
+            return self.interned[key][row] != -1
+        else:
+            return False
+
+    def get_value(self, row, key):
+        """Returns the value of key in a row, raising KeyError if the row
+        does not hold it."""
+        if not self.has(row, key):
+            raise KeyError(key)
+        if key in self.extra.get(row, {}):
+            return self.extra[row][key]
+        elif key == "fname":
+            return self.name_of(row)
+        elif key == "fpath":
+            directory = self.strings[self.directories[row]]
+            return directory if self.flags[row] & file_table_full_path else directory + self.name_of(row)
+        elif key == "sha256":
+            return self.digests[32 * row:32 * (row + 1)].hex() if self.flags[row] & file_table_digest else None
+        elif key in self.numbers:
+            return self.numbers[key][row]
+        else:
+            return self.strings[self.interned[key][row]]
+
+    def put(self, row, key, value):
+        """Sets key to value in a row, in its column if the value fits one and
+        with the row's extra keys otherwise."""
+        if self.has(row, key):
+            self.remove(row, key)
+        digest = self.digest_of(value) if key == "sha256" else None
+        if key in ["fname", "fpath"] and isinstance(value, str):
+            fname = value if key == "fname" else self.name_of(row)
+            fpath = value if key == "fpath" else self.get_value(row, "fpath") if self.has(row, "fpath") else None
+            self.place(row, fname, fpath)
+        elif key == "sha256" and value is None:
+            self.flags[row] |= file_table_unhashed
+        elif digest is not None:
+            self.digests[32 * row:32 * (row + 1)] = digest
+            self.flags[row] |= file_table_digest
+        elif key in self.numbers and isinstance(value, int) and not isinstance(value, bool) and \
+                0 <= value < 2 ** 63:
+            self.numbers[key][row] = value
+        elif key in self.interned and isinstance(value, str):
+            self.interned[key][row] = self.intern(value)
+        else:
+            self.extra.setdefault(row, {}).update({key: value})
+
+    @staticmethod
+    def digest_of(value):
+        """Returns the raw bytes of a SHA256 hexdigest, or None if value is
+        anything else, including a digest which .hex() wouldn't give back."""
+        try:
+            digest = bytes.fromhex(value)
+        except (TypeError, ValueError):
+            return None
+        return digest if len(digest) == 32 and digest.hex() == value else None
+
+    def remove(self, row, key):
+        """Deletes key from a row, raising KeyError if the row does not hold
+        it."""
+        if not self.has(row, key):
+            raise KeyError(key)
+        if key in self.extra.get(row, {}):
+            del self.extra[row][key]
+            if len(self.extra[row]) == 0:
+                del self.extra[row]
+        elif key == "fname":  # The fpath, if any, can no longer be split around it.
+            self.place(row, None, self.get_value(row, "fpath") if self.has(row, "fpath") else None)
+        elif key == "fpath":
+            self.place(row, self.name_of(row), None)
+        elif key == "sha256":
+            self.flags[row] &= ~(file_table_digest | file_table_unhashed)
+        elif key in self.numbers:
+            self.numbers[key][row] = -1
+        else:
+            self.interned[key][row] = -1
+
+    def place(self, row, fname, fpath):
+        """Stores the fname and fpath of a row. Where the fpath ends in the
+        fname, as it does for every file crawled, only the directory before
+        it is stored, and is interned, as it is shared by its neighbours."""
+        if fname is None:
+            self.name_starts[row] = -1
+        else:  # Any name it had before is left unused in names, which only grows.
+            self.name_starts[row] = len(self.names)
+            self.names.extend(fname.encode("utf-8", "surrogateescape"))  # As os.walk decodes file names.
+            self.name_ends[row] = len(self.names)
+        self.flags[row] &= ~file_table_full_path
+        if fpath is None:
+            self.directories[row] = -1
+        elif fname is not None and fpath.endswith(fname):
+            self.directories[row] = self.intern(fpath[:len(fpath) - len(fname)])
+        else:
+            self.directories[row] = self.intern(fpath)
+            self.flags[row] |= file_table_full_path
+
+    def name_of(self, row):
+        """Returns the fname of a row, or None if it has none."""
+        if self.name_starts[row] == -1:
+            return None
+        return self.names[self.name_starts[row]:self.name_ends[row]].decode("utf-8", "surrogateescape")
+
+    def keys_of(self, row):
+        """Returns the keys held by a row, in the order they are written to
+        the index."""
+        extra = self.extra.get(row, {})
+        keys = [key for key in ["fname", "sha256", "category", "fpath"] + file_table_numbers + ["run"]
+                if key not in extra and self.has(row, key)]
+        return keys + list(extra)
+
+
+class FileRecord(collections.abc.MutableMapping):
+    """The entry of one file in a FileTable, which reads and writes the
+    table's row in place. json can't serialize a record as it stands, so
+    anything writing one out should write dict(record) instead.
+    """
+    __slots__ = ["table", "row"]
+
+    def __init__(self, table, row):
+        """
+        :param table: the FileTable holding the entry.
+        :param row: the number of the entry's row in the table.
+        """
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.table.get_value(self.row, key)
+
+    def __setitem__(self, key, value):
+        self.table.put(self.row, key, value)
+
+    def __delitem__(self, key):
+        self.table.remove(self.row, key)
+
+    def __contains__(self, key):
+        return self.table.has(self.row, key)
+
+    def __iter__(self):
+        return iter(self.table.keys_of(self.row))
+
+    def __len__(self):
+        return len(self.table.keys_of(self.row))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class HashingReader(object):
+    """Wraps a binary file object so that everything read through it is also
+    hashed, letting a file be checked while it is being copied elsewhere.
+    """
+
+    def __init__(self, stream):
+        """
+        :param stream: a binary file object open for reading.
+        """
+        self.stream = stream
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.hasher.update(chunk)
+        return chunk
+
+    def hexdigest(self):
+        """Returns the SHA256 hexdigest of everything read so far."""
+        return self.hasher.hexdigest()
+
+
 class Block(object):
     """Class representation of a tapestry block object. Exposes a method "put"
     to add a file to the block, and another, "meta" method, for adding the
@@ -392,9 +1282,14 @@ class Block(object):
         else:  # This file won't fit and has to be placed somewhere else.
             return False
 
-    def meta(self, sum_blocks, sum_size, sum_files, datestamp, comment_string, full_index, drop_dir):
+    def meta(self, sum_blocks, sum_size, sum_files, datestamp, comment_string, full_index, drop_dir,
+             extra_metadata=None, run_index=None):
         """Provided these arguments, populate the runMetadata portion of a RIFF,
-        then create the corresponding RIFF file.
+        then create the corresponding RIFF file. Any extra_metadata, such as
+        the details of an incremental run, is added to the runMetadata too.
+        If a run_index reference is given, it is recorded in the runMetadata,
+        and unless this block is one of the reference's "fullBlocks" the RIFF
+        holds only the index entries of this block's own files.
         """
         meta_value = {}
         meta_value.update({"sumBlock": sum_blocks})
@@ -404,27 +1299,151 @@ class Block(object):
         if comment_string is None:
             comment_string = "No Comment"
         meta_value.update({"comment": comment_string})
+        if extra_metadata is not None:
+            meta_value.update(extra_metadata)
+        compact = False
+        if run_index is not None:
+            meta_value.update({"runIndex": run_index})
+            compact = self.num_block not in run_index["fullBlocks"]
         self.run_metadata = meta_value
 
         self.block_metadata = {
-            "numBlock": self.num_block, "sizeLarge": self.size, "countFiles": self.files
+            "numBlock": self.num_block, "sizeLarge": self.size, "countFiles": self.files, "indexCompact": compact
         }
 
-        self.global_index = full_index
-
-        dict_riff = {"metaBlock": self.block_metadata, "metaRun": self.run_metadata,
-                     "index": self.global_index}
+        if compact:
+            self.global_index = {fid: full_index[fid] for fid in self.file_index}
+        else:
+            self.global_index = full_index
 
-        with open(os.path.join(drop_dir, self.name+".riff"), "w") as riff:
-            json.dump(dict_riff, riff)
+        with RiffWriter(os.path.join(drop_dir, self.name+".riff"), self.block_metadata, self.run_metadata) as riff:
+            for fid, entry in self.global_index.items():
+                riff.add(fid, entry)
 
         return os.path.join(drop_dir, (self.name+".riff"))
 
 
+class BinaryIndex(collections.abc.Mapping):
+    """Read-only mapping of FID: index entry over a binary recovery index, as
+    written by write_binary_index. Entries are decoded only when they are
+    looked up, so the index can be far larger than would fit in memory as
+    dictionaries.
+    """
+
+    def __init__(self, data):
+        """Initialize the mapping over the contents of a binary index.
+
+        :param data: the whole binary index, as an mmap or a bytes object.
+        """
+        self.data = data
+        try:
+            magic, version, spare, self.count, strings, meta_offset, meta_length, self.table_offset, \
+                self.records_offset = trix_header.unpack_from(data, 0)
+        except struct.error:
+            raise RecoveryIndexError("The binary recovery index is truncated.")
+        if magic != trix_magic:
+            raise RecoveryIndexError("The recovery index is not a binary index.")
+        if version > trix_version:
+            raise RecoveryIndexError("The binary recovery index is version %s, which this version of Tapestry "
+                                     "cannot read." % version)
+        if len(data) < self.records_offset + self.count * trix_record.size:
+            raise RecoveryIndexError("The binary recovery index is truncated.")
+        self.metadata = json.loads(bytes(data[meta_offset:meta_offset + meta_length]).decode("utf-8"))
+        self.last = None  # (FID, entry) of the most recent lookup.
+
+    def string(self, number):
+        """Returns a string from the string table, as bytes."""
+        start, end = struct.unpack_from("<QQ", self.data, self.table_offset + 8 * number)
+        return bytes(self.data[start:end])
+
+    def record(self, position):
+        """Returns the unpacked record at a position in the FID order."""
+        return trix_record.unpack_from(self.data, self.records_offset + position * trix_record.size)
+
+    def fid_at(self, position):
+        """Returns the FID of the record at a position in the FID order, as bytes."""
+        return self.string(struct.unpack_from("<I", self.data, self.records_offset + position * trix_record.size)[0])
+
+    def search(self, file_key):
+        """Returns the position of a FID's record by binary search, or None."""
+        if not isinstance(file_key, str):
+            return None
+        target = file_key.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.fid_at(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.fid_at(low) == target:
+            return low
+        return None
+
+    def decode(self, record):
+        """Turns an unpacked record back into a FID and an index entry."""
+        columns = record[:len(trix_strings)]
+        extra, flags = record[len(trix_strings):len(trix_strings) + 2]
+        fsize, block, segments, segment, spare, offset, offset_data, seg_offset, digest = record[8:]
+        entry = {}
+        for key, number in zip(trix_strings, columns):
+            if number != trix_none:
+                entry.update({key: self.string(number).decode("utf-8")})
+        for bit, (key, value) in enumerate(zip([key for key, limit in trix_numbers],
+                                               [fsize, block, segments, segment, offset, offset_data, seg_offset])):
+            if flags & (1 << bit):
+                entry.update({key: value})
+        if flags & trix_sha256:
+            entry.update({"sha256": digest.hex()})
+        if extra != trix_none:
+            entry.update(json.loads(self.string(extra).decode("utf-8")))
+        return entry.pop("fid"), entry
+
+    def __getitem__(self, file_key):
+        if self.last is not None and self.last[0] == file_key:  # Recovery asks several things of each file in turn.
+            return self.last[1]
+        position = self.search(file_key)
+        if position is None:
+            raise KeyError(file_key)
+        self.last = (file_key, self.decode(self.record(position))[1])
+        return self.last[1]
+
+    def __contains__(self, file_key):
+        return self.search(file_key) is not None
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self.fid_at(position).decode("utf-8")
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        """Iterates over (FID, entry) pairs in FID order, decoding each record
+        once rather than searching for it again."""
+        for position in range(self.count):
+            yield self.decode(self.record(position))
+
+    def locations(self):
+        """Iterates over (FID, run, block, header offset) for every file whose
+        block is recorded, reading only the columns needed to do so. The run
+        and offset are None where the index doesn't record them.
+        """
+        block_bit, offset_bit = 1 << 1, 1 << 4  # The positions of "block" and "offset" in trix_numbers.
+        for position in range(self.count):
+            record = self.record(position)
+            flags = record[7]
+            if flags & block_bit:
+                run = self.string(record[4]).decode("utf-8") if record[4] != trix_none else None
+                yield (self.string(record[0]).decode("utf-8"), run, record[9],
+                       record[13] if flags & offset_bit else None)
+
+
 class RecoveryIndex(object):
     """Special utility class for loading and translating Tapestry recovery
     index files and presenting them back to the script in a universal way. Made
-    for both the old Recovery Pickle design as well as the NewRIFF format.
+    for both the old Recovery Pickle design as well as the NewRIFF format, and
+    for the binary index format, which is read through mmap where it can be.
     """
 
     def __init__(self, index_file):
@@ -432,35 +1451,73 @@ class RecoveryIndex(object):
 
         :param index_file: a reader object containing the file in question.
         """
-        self.pickle_failed = False
-        self.json_failed = False
-
-        try:
-            self.pickled_data = pickle.load(index_file)
-        except pickle.UnpicklingError:  # In this case we must have a newRiff:
-            self.pickle_failed = True
-
-        try:
-            self.unpacked_json = json.load(index_file)
-        except json.JSONDecodeError:
-            self.json_failed = True
-
-        if self.pickle_failed and self.json_failed:
-            raise RecoveryIndexError("The recovery index is not a valid file type, or corrupt.")
-        elif self.pickle_failed:
-            self.mode = "json"
+        head = index_file.read(len(trix_magic))
+        if head == trix_magic:
+            raw = getattr(index_file, "raw", index_file)
+            if isinstance(raw, io.FileIO) and os.fstat(raw.fileno()).st_size > 0:  # A file on disk can be mapped.
+                data = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+            else:  # Such as a member of a tarfile.
+                data = head + index_file.read()
+            self.mode = "trix"
+            self.file_index = BinaryIndex(data)
+            self.unpacked_json = self.file_index.metadata
         else:
-            self.mode = "pkl"
-
-        if self.mode == "json":
+            first = head + index_file.readline()
+            if first.lstrip()[:1] == b"{":  # Checked first, so that JSON is never handed to the unpickler.
+                try:  # Read an entry at a time, so the text of the index is never held whole.
+                    self.unpacked_json, entries = iter_riff(itertools.chain([first], index_file))
+                    self.file_index = dict(entries)
+                except (json.JSONDecodeError, UnicodeDecodeError, KeyError):
+                    raise RecoveryIndexError("The recovery index is not a valid file type, or corrupt.")
+                self.unpacked_json.update({"index": self.file_index})
+                self.mode = "json"
+            else:
+                try:
+                    self.pickled_data = pickle.loads(first + index_file.read())
+                except (pickle.UnpicklingError, EOFError):
+                    raise RecoveryIndexError("The recovery index is not a valid file type, or corrupt.")
+                self.mode = "pkl"
+
+        self.located = None  # (block contents, earlier contents), gathered the first time they are needed.
+        self.signer = None  # The approved fingerprint of its signer, if it was read from an index sidecar.
+        self.compact = False  # True if the index holds only the files of the block it came from.
+        if self.mode in ["json", "trix"]:
             self.run_metadata = self.unpacked_json["metaRun"]
-            self.file_index = self.unpacked_json["index"]
+            self.compact = self.unpacked_json.get("metaBlock", {}).get("indexCompact", False)
             self.blocks = self.unpacked_json["metaRun"]["sumBlock"]
         elif self.mode == "pkl":
             self.blocks, self.rec_paths, self.rec_sections = self.pickled_data
         else:  # We have entered a cursed state...
             raise RecoveryIndexError("The self.mode variable is an unexpected value. Are you hacking?")
 
+    def locate_all(self):
+        """Gathers which block holds each file, for contents and runs. This
+        reads the whole index, so it is only done once, when first needed.
+
+        :return: a tuple of two dictionaries: block number: {FID: header
+        offset} for the indexed run's own blocks, and run name: the same, for
+        files held by an earlier run.
+        """
+        if self.located is None:
+            block_contents = {}
+            earlier_contents = {}
+            if self.mode == "trix":
+                locations = self.file_index.locations()
+            elif self.mode == "json":
+                locations = ((fid, entry.get("run"), entry["block"], entry.get("offset"))
+                             for fid, entry in self.file_index.items() if "block" in entry)
+            else:
+                locations = []
+            for fid, run, block, offset in locations:
+                if run is not None:  # Unchanged since an earlier run, and packed by that run.
+                    contents = earlier_contents.setdefault(run, {})
+                else:
+                    contents = block_contents
+                contents.setdefault(block, {}).update({fid: offset})
+            self.located = block_contents, earlier_contents
+
+        return self.located
+
     def find(self, file_key):
         """Expectes a FID value as the argument and will return the
         category and sub-path accordingly.
@@ -471,7 +1528,7 @@ class RecoveryIndex(object):
             category = "skip"
             sub_path = "skip"
             return category, sub_path
-        elif self.mode == "json":
+        elif self.mode in ["json", "trix"]:
             try:
                 category = self.file_index[file_key]["category"]
                 sub_path = self.file_index[file_key]["fpath"]
@@ -489,3 +1546,140 @@ class RecoveryIndex(object):
             raise RecoveryIndexError("The self.mode variable is an unexpected value. Are you hacking?")
 
         return category, sub_path
+
+    def stored_as(self, file_key):
+        """Expects a FID value as the argument and returns the FID under which
+        that file's contents were packed. This is the file's own FID, unless
+        it was identical to another file and was packed only once, as that
+        file.
+
+        :param file_key: A string representing a valid file ID.
+        """
+        if self.mode in ["json", "trix"]:
+            return self.file_index.get(file_key, {}).get("ref", file_key)
+        return file_key
+
+    def is_split(self, file_key):
+        """Expects a FID value as the argument and returns True if that file
+        was too large for one block and was packed as separate segments, each
+        with its own FID. The file's own FID then holds no data.
+
+        :param file_key: A string representing a valid file ID.
+        """
+        if self.mode in ["json", "trix"]:
+            return "segments" in self.file_index.get(file_key, {})
+        return False
+
+    def segment_offset(self, file_key):
+        """Expects a FID value as the argument and returns the position, in
+        bytes, of that segment within the file it was split from, or None if
+        the FID is not a segment.
+
+        :param file_key: A string representing a valid file ID.
+        """
+        if self.mode in ["json", "trix"]:
+            return self.file_index.get(file_key, {}).get("seg_offset")
+        return None
+
+    def fids(self):
+        """Lists every file ID in the index."""
+        if self.mode in ["json", "trix"]:
+            return list(self.file_index.keys())
+        else:
+            return list(self.rec_paths.keys())
+
+    def locate(self, file_key):
+        """Expects a FID value as the argument and returns where that file
+        was packed, as far as the index records it.
+
+        :param file_key: A string representing a valid file ID.
+        :return: a tuple of the block number, the offset of the file's header
+        and the offset of its data in the block's uncompressed tarball. Any
+        value the index doesn't record is None.
+        """
+        entry = {}
+        if self.mode in ["json", "trix"]:
+            entry = self.file_index.get(self.stored_as(file_key), {})
+        return entry.get("block"), entry.get("offset"), entry.get("offset_data")
+
+    def contents(self, block, run=None):
+        """Lists the files held in a block, according to the index.
+
+        :param block: the block number.
+        :param run: the name of the earlier run the block belongs to, if it
+        is not one of the indexed run's own blocks.
+        :return: a dictionary of FID: header offset, with the offset None if
+        it isn't recorded; or None if the index doesn't record which block
+        holds each file.
+        """
+        block_contents, earlier_contents = self.locate_all()
+        if run is None:
+            return block_contents.get(block)
+        return earlier_contents.get(run, {}).get(block, {})
+
+    def runs(self):
+        """Lists the earlier runs holding files which this run, being an
+        incremental run, did not pack again.
+
+        :return: a sorted list of run names, such as "host-2020-01-01".
+        """
+        return sorted(self.locate_all()[1])
+
+    def run_of(self, file_key):
+        """Expects a FID value as the argument and returns the name of the
+        earlier run which holds that file, or None if the file is held by the
+        indexed run itself.
+
+        :param file_key: A string representing a valid file ID.
+        """
+        if self.mode in ["json", "trix"]:
+            return self.file_index.get(self.stored_as(file_key), {}).get("run")
+        return None
+
+    def blocks_holding(self, file_keys):
+        """Works out which blocks hold a collection of files.
+
+        :param file_keys: an iterable of valid file IDs.
+        :return: a set of (run, block number) tuples, where run is None for
+        the indexed run's own blocks and otherwise names an earlier run; or
+        None if the index doesn't record which block holds each file.
+        """
+        holding = set()
+        for file_key in file_keys:
+            if self.is_split(file_key):  # Its segments are listed in their own right.
+                continue
+            block = self.locate(file_key)[0]
+            if block is None:
+                return None
+            holding.add((self.run_of(file_key), block))
+
+        return holding
+
+    def select(self, patterns):
+        """Finds every file whose path matches one of a list of glob patterns,
+        for partial restores. Paths are matched both as recorded, relative to
+        their category, and with the category label in front, so that either
+        "taxes/*" or "Documents/taxes/*" will find the same files.
+
+        :param patterns: a list of glob patterns, as understood by fnmatch.
+        :return: a dictionary of FID: block number for the matching files. The
+        block number is None for indices which predate it being recorded.
+        """
+        if self.mode in ["json", "trix"]:
+            candidates = [(fid, entry["category"], entry["fpath"], self.locate(fid)[0])
+                          for fid, entry in self.file_index.items()]
+        elif self.mode == "pkl":
+            candidates = [(fid, self.rec_sections[fid], self.rec_paths[fid], None) for fid in self.rec_paths]
+        else:
+            raise RecoveryIndexError("The self.mode variable is an unexpected value. Are you hacking?")
+
+        selected = {}
+        for fid, category, sub_path, block in candidates:
+            sub_path = sub_path.replace("\\", "/")  # The index may have been written on windows.
+            full_path = "%s/%s" % (category, sub_path)
+            for pattern in patterns:
+                if fnmatch.fnmatchcase(sub_path, pattern) or fnmatch.fnmatchcase(full_path, pattern):
+                    selected.update({fid: block})
+                    break
+
+        return selected
@@ -0,0 +1,215 @@
+"""Defines the compression codecs Tapestry can apply to its blocks. bz2 and xz
+are always available from the standard library; zstd and lz4 are used if the
+zstandard and lz4 packages are installed, and bz2 is used in their place if
+they are not.
+
+Blocks are recognised by the magic bytes at the start of the stream, so the
+codec used to build a block never needs to be recorded anywhere else.
+
+"""
+
+import bz2
+import io
+import lzma
+import os
+import tarfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+# Each codec's file extension and the magic bytes that open its stream.
+known_codecs = {
+    "bz2": (".bz2", b"BZh"),
+    "xz": (".xz", b"\xfd7zXZ\x00"),
+    "zstd": (".zst", b"\x28\xb5\x2f\xfd"),
+    "lz4": (".lz4", b"\x04\x22\x4d\x18")
+}
+default_codec = "bz2"
+
+
+def codec_available(codec):
+    """Returns True if the named codec can be used on this system."""
+    if codec == "zstd":
+        return zstandard is not None
+    elif codec == "lz4":
+        return lz4frame is not None
+    else:
+        return codec in known_codecs
+
+
+def resolve_codec(codec):
+    """Returns the name of the codec to actually use for a requested one,
+    which is the default (bz2) if the requested codec is unknown or its
+    package is not installed.
+
+    :param codec: the codec name, as given in the config file.
+    :return: a key of known_codecs.
+    """
+    codec = str(codec).strip().lower()
+    if codec_available(codec):
+        return codec
+    else:
+        return default_codec
+
+
+def codec_extension(codec):
+    """Returns the file extension for a codec, including the leading dot."""
+    return known_codecs[codec][0]
+
+
+def strip_extension(filename):
+    """Removes a compression extension from the end of a filename, if it has
+    one.
+    """
+    for extension, magic in known_codecs.values():
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+    return filename
+
+
+def detect_codec(header):
+    """Identifies the codec of a stream from its first few bytes.
+
+    :param header: bytes read from the start of the file; 6 is enough.
+    :return: the name of the codec, or None if the data is not compressed.
+    """
+    for codec, (extension, magic) in known_codecs.items():
+        if header.startswith(magic):
+            return codec
+    return None
+
+
+def open_compressor(fileobj, codec, level, threads=0):
+    """Wraps a writable binary file object so that everything written to the
+    wrapper is compressed into it. Closing the wrapper finishes the stream.
+
+    :param fileobj: a binary file object opened for writing.
+    :param codec: a codec name, as returned by resolve_codec.
+    :param level: Integer between 1 and 9 which determines the compression level
+    :param threads: the number of threads zstd may use; 0 compresses on the
+    calling thread and -1 uses one thread per core. Ignored by other codecs.
+    :return: a writable file object.
+    """
+    if codec == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        return compressor.stream_writer(fileobj)
+    elif codec == "lz4":
+        return lz4frame.LZ4FrameFile(fileobj, "wb", compression_level=level)
+    elif codec == "xz":
+        return lzma.LZMAFile(fileobj, "wb", preset=level)
+    else:
+        return bz2.BZ2File(fileobj, "wb", compresslevel=level)
+
+
+def open_decompressor(path, codec):
+    """Opens a compressed file for reading as its decompressed contents. The
+    returned object can seek, though seeking backwards is done by starting
+    over from the beginning of the file.
+
+    :param path: the absolute path to the compressed file.
+    :param codec: the codec of the file, as returned by detect_codec.
+    :return: a readable binary file object.
+    """
+    if codec == "zstd":
+        return io.BufferedReader(RewindingReader(path, zstandard.ZstdDecompressor().stream_reader))
+    elif codec == "lz4":
+        return lz4frame.LZ4FrameFile(path, "rb")
+    elif codec == "xz":
+        return lzma.LZMAFile(path, "rb")
+    else:
+        return bz2.BZ2File(path, "rb")
+
+
+def open_tar(path):
+    """Opens a tarball for reading whether or not it is compressed, and with
+    whichever codec. This is a drop-in replacement for tarfile.open(path,
+    "r:*"), which does not recognise zstd or lz4.
+
+    :param path: the absolute path to the tarball.
+    :return: a tarfile.TarFile open for reading.
+    """
+    with open(path, "rb") as f:
+        codec = detect_codec(f.read(6))
+    if codec in (None, "bz2", "xz"):  # tarfile handles these itself.
+        return tarfile.open(path, "r:*")
+    if not codec_available(codec):
+        raise tarfile.CompressionError("%s is compressed with %s, which is not installed." % (path, codec))
+    stream = open_decompressor(path, codec)
+    try:
+        tar = tarfile.open(fileobj=stream, mode="r:")
+    except Exception:
+        stream.close()
+        raise
+    tar._extfileobj = False  # As tarfile's own bz2open does, so that closing the tar closes the stream.
+    return tar
+
+
+class RewindingReader(io.RawIOBase):
+    """Presents a forward-only decompression stream as a seekable raw file.
+    Seeking forward reads and discards data; seeking backward reopens the file
+    and starts decompressing again from the top.
+    """
+
+    def __init__(self, path, reader_factory):
+        """
+        :param path: the absolute path to the compressed file.
+        :param reader_factory: a callable that takes a binary file object and
+        returns a readable object yielding the decompressed data.
+        """
+        super().__init__()
+        self.path = path
+        self.factory = reader_factory
+        self.raw = None
+        self.reader = None
+        self.position = 0
+        self.rewind()
+
+    def rewind(self):
+        if self.raw is not None:
+            self.raw.close()
+        self.raw = open(self.path, "rb")
+        self.reader = self.factory(self.raw)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.reader.read(len(b))
+        length = len(data)
+        b[:length] = data
+        self.position += length
+        return length
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence != os.SEEK_SET:
+            raise io.UnsupportedOperation("Cannot seek relative to the end of a compressed stream.")
+        if offset < self.position:
+            self.rewind()
+        while self.position < offset:
+            skipped = len(self.reader.read(min(offset - self.position, 2 ** 20)))
+            if skipped == 0:
+                break
+            self.position += skipped
+        return self.position
+
+    def close(self):
+        if self.raw is not None:
+            self.raw.close()
+        super().close()
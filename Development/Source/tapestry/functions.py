@@ -8,23 +8,23 @@ github: https://www.github.com/ZAdamMac/Tapestry
 """
 
 from . import classes as tapestry
+from . import blocksort
+from . import compression
 import argparse
 import configparser
 import datetime
 import getpass
 import gnupg
-import hashlib
-import io
-import multiprocessing as mp
+import json
 import os
 import paramiko.ssh_exception as sshe
 import platform
 import pysftp
-from random import shuffle
+import queue
 import shutil
 import sys
-import tarfile
 import textwrap
+import threading
 import uuid
 
 __version__ = "2.0.2"
@@ -46,19 +46,123 @@ def announce():
     debug_print("The current OS is: " + platform.system())
 
 
+def block_members(namespace, block):
+    """Lists the files held by a block in the form the packing tasks expect.
+
+    :param namespace: the tapestry namespace object.
+    :param block: a tapestry.Block, as returned by the blocksort.
+    :return: a list of (fid, absolute path) tuples.
+    """
+    members = []
+    for fid, file_metadata in block.file_index.items():
+        path = os.path.join(namespace.category_paths[file_metadata["category"]],
+                            file_metadata['fpath'])
+        members.append((fid, path))
+
+    return members
+
+
+def block_segments(block):
+    """Lists the members of a block which are segments of larger files, in the
+    form the packing tasks expect.
+
+    :param block: a tapestry.Block, as returned by the blocksort.
+    :return: a dictionary of fid: (offset, length).
+    """
+    segments = {}
+    for fid, file_metadata in block.file_index.items():
+        if "seg_offset" in file_metadata:
+            segments.update({fid: (file_metadata["seg_offset"], file_metadata["fsize"])})
+
+    return segments
+
+
+def member_hashes(ops_list, members):
+    """Gathers the known-good hashes of a block's members, so that the packer
+    can check each file against its hash as the file is written.
+
+    :param ops_list: The full ops list prepared by build_ops_list.
+    :param members: a list of (fid, path) tuples, as from block_members.
+    :return: a dictionary of fid: SHA256 hash.
+    """
+    return dict((fid, ops_list[fid]['sha256']) for fid, path in members)
+
+
+def split_pack_failures(message):
+    """Separates a message from a packing task that checked its files as it
+    wrote them into its first line and the files which failed, if any.
+
+    :param message: the string returned by TaskPackBlock or TaskStreamBlock.
+    :return: a tuple of the first line and the (possibly empty) failure lines.
+    """
+    head, sep, failures = message.partition("\n")
+    return head, failures.strip()
+
+
+def block_number(filename):
+    """Reads the block number from the name of a block or its signature, such
+    as "host-2020-01-01-3.tap.sig".
+
+    :param filename: the name or path of the file.
+    :return: the block number as an integer, or None if it has none.
+    """
+    number = os.path.basename(filename).rsplit("-", 1)[-1].split(".")[0]
+    try:
+        return int(number)
+    except ValueError:
+        return None
+
+
+def block_key(filename, run_name):
+    """Identifies a block by the run it belongs to and its number, in the
+    form used by select_restore_blocks.
+
+    :param filename: the name or path of a block or its signature.
+    :param run_name: the name of the run being recovered, such as
+    "host-2020-01-01".
+    :return: a tuple of the block's run name, which is None if that is
+    run_name, and the block number.
+    """
+    name = os.path.basename(filename)
+    if name.endswith(".sig"):  # So that a signature gets the same key as its block, even if it has no number.
+        name = name[:-len(".sig")]
+    run = name.rsplit("-", 1)[0]
+    if run == run_name:
+        run = None
+
+    return run, block_number(filename)
+
+
 def build_ops_list(namespace):
     """A simple function which performs the crawling we need to do, and returns
     the findex of a RIFF). The returned index is not sorted by size and has to
     be sorted to do the blocksort.
 
+    Files whose device, inode, size and modification time match an entry in
+    the hash cache reuse the cached digest; everything else is hashed in
+    parallel by hash_files.
+
+    Files larger than a block are split into block-sized segments. The file's
+    own entry records its hash and size and the number of segments, and holds
+    no data; each segment gets an entry of its own, with its own hash, which
+    is packed like any other file.
+
+    The entries are held by a tapestry.FileTable, in columns rather than as a
+    dictionary per file, since a large run can hold millions of them.
+
     :param namespace: The namespace object, which by this point should be fully
     populated after passing through parse_config and parse_args
     :return:
     """
     ns = namespace
     # Step 1: Index Everything for the Blocksort
-    files_index = {}  # This comes out the same as the 'findex' key in a NewRIFF JSON
+    files_index = tapestry.FileTable()  # This comes out the same as the 'findex' key in a NewRIFF JSON
     node = uuid.getnode()
+    hash_cache_path = getattr(ns, "hash_cache_path", None)  # Test namespaces may not define this.
+    old_cache = load_hash_cache(hash_cache_path)
+    new_cache = {}
+    to_hash = []
+    to_split = []
     run_list = ns.categories_default
     if ns.inc:
         for category in ns.categories_inclusive:
@@ -68,25 +172,49 @@ def build_ops_list(namespace):
             for file in files:
                 absolute_path = os.path.join(dir_path, file)
                 sub_path = os.path.relpath(absolute_path, ns.category_paths[category])
-                size = os.path.getsize(absolute_path)
+                stat = os.stat(absolute_path)
+                size = stat.st_size
+                fid = str(uuid.uuid1(node))
+                cache_key = "%s:%s:%s:%s" % (stat.st_dev, stat.st_ino, size, stat.st_mtime_ns)
+                files_index.update({fid: {
+                    'fname': file, 'sha256': None, 'category': category,
+                    'fpath': sub_path, 'fsize': size
+                    }})
                 if size <= ns.block_size_raw:  # We'll be handling this file.
-                    hasher = hashlib.new('sha256')
-                    with open(absolute_path, "rb") as contents:
-                        chunk = contents.read(io.DEFAULT_BUFFER_SIZE)
-                        while chunk != b"":
-                            hasher.update(chunk)
-                            chunk = contents.read(io.DEFAULT_BUFFER_SIZE)
-                    hash_digest = hasher.hexdigest()
-                    file_descriptor = {
-                        'fname': file, 'sha256': hash_digest, 'category': category,
-                        'fpath': sub_path, 'fsize': size
-                        }
-                    files_index.update({str(uuid.uuid1(node)): file_descriptor})
-                else:
-                    size_pretty = size / 1048576
-                    block_size_pretty = ns.block_size_raw / 1048576
-                    print("{%s} %s is larger than %s (%s) and is being excluded" %
-                          (category, file, size_pretty, block_size_pretty))
+                    hash_digest = old_cache.get(cache_key)
+                    if hash_digest is None:
+                        to_hash.append((fid, absolute_path, cache_key))
+                    else:
+                        new_cache.update({cache_key: hash_digest})
+                        files_index[fid]['sha256'] = hash_digest
+                else:  # Too large for one block, so it will be split into segments.
+                    cache_key += ":%s" % ns.block_size_raw  # Segment hashes depend on the block size.
+                    hash_digests = old_cache.get(cache_key)
+                    if hash_digests is None:
+                        to_split.append((fid, absolute_path, cache_key))
+                    else:
+                        new_cache.update({cache_key: hash_digests})
+                        split_file(files_index, fid, hash_digests[0], hash_digests[1:], ns.block_size_raw, node)
+
+    debug_print("%s files needed hashing, %s were found in the hash cache." %
+                (len(to_hash) + len(to_split), len(new_cache)))
+    digests = hash_files(ns, [(fid, path) for fid, path, key in to_hash])
+    for fid, path, cache_key in to_hash:
+        if fid not in digests:  # It was deleted, or can't be read, since the walk found it.
+            print("WARNING: %s could not be read and will not be backed up." % path)
+            del files_index[fid]
+            continue
+        files_index[fid]['sha256'] = digests[fid]
+        new_cache.update({cache_key: digests[fid]})
+    tasks = [tapestry.TaskHashSegments(fid, path, ns.block_size_raw) for fid, path, key in to_split]
+    for (fid, path, cache_key), result in zip(to_split, run_tasks(ns, tasks, "Hashing Large Files")):
+        if not isinstance(result, list):  # The task failed, and says why.
+            print("WARNING: %s; it will not be backed up." % result)
+            del files_index[fid]
+            continue
+        split_file(files_index, fid, result[1], result[2], ns.block_size_raw, node)
+        new_cache.update({cache_key: [result[1]] + result[2]})
+    save_hash_cache(hash_cache_path, new_cache)  # Only files seen in this run are kept.
 
     return files_index
 
@@ -100,9 +228,11 @@ def build_recovery_index(ops_list):
     """
     dict_sizes = {}
     sum_size = 0
-    for findex in ops_list.keys():
-        sum_size += ops_list[findex]['fsize']
-        dict_sizes.update({findex: ops_list[findex]['fsize']})
+    for findex, entry in ops_list.items():
+        if "segments" in entry:  # Split into segments, which are sorted in its place.
+            continue
+        sum_size += entry['fsize']
+        dict_sizes.update({findex: entry['fsize']})
 
     working_index = sorted(dict_sizes, key=dict_sizes.__getitem__)
     working_index.reverse()
@@ -110,56 +240,45 @@ def build_recovery_index(ops_list):
     return working_index, sum_size
 
 
+def carry_entry(entry, old_entry, previous_run):
+    """Points an ops list entry at the copy of the file packed by an earlier
+    run, as recorded in that run's index.
+
+    :param entry: the entry in this run's ops list.
+    :param old_entry: the entry for the packed copy in the earlier run's
+    index.
+    :param previous_run: the name of the earlier run.
+    """
+    entry.update({"run": old_entry.get("run", previous_run)})  # Always the run which actually packed it.
+    for key in ("block", "offset", "offset_data"):
+        if key in old_entry:
+            entry.update({key: old_entry[key]})
+
+
 def clean_up(working_directory):
     """Releases the memory space used up by temp, because we're polite."""
     if os.path.exists(working_directory):
         shutil.rmtree(working_directory, ignore_errors=True)
 
 
-def compress_blocks(ns, targets, do_compression=True, compression_level=1):
+def compress_blocks(ns, targets, do_compression=True, compression_level=1, codec="bz2", threads=0):
     """Iterates over a list of files, and then compresses them, using the
     multiprocessing framework.
     :param ns: a tapestry namespace object
     :param targets: list of absolute paths to the files to be compressed.
     :param do_compression: boolean value indicting if we should use compression
     :param compression_level: integer value from 1-9 denoting the number of passes
+    :param codec: the compression codec, as returned by compression.resolve_codec
+    :param threads: the number of threads zstd may use for each block
     :return: list of absolute paths of the resulting files.
     """
     if do_compression:
-        worker_count = os.cpu_count()
-        compress_queue = mp.JoinableQueue()
-        for target in targets:
-            task = tapestry.TaskCompress(target, compression_level)
-            compress_queue.put(task)
-        workers = []
-        sum_jobs = int(compress_queue.qsize())
-        done = mp.JoinableQueue()
-        for i in range(worker_count):
-            workers.append(tapestry.ChildProcess(compress_queue, done, ns.workDir, ns.debug))
-        rounds_complete = 0
         debug_print(str(targets)+"\n")
-        for w in workers:
-            w.start()
-        working = True
-        status_print(0, sum_jobs, "Compressing", "Working...")  # We need an initial status print
-        while working:
-            message = done.get()
-            if message is None:
-                working = False
-            else:
-                if not ns.debug:
-                    message = "Working..."
-                rounds_complete += 1
-                status_print(rounds_complete, sum_jobs, "Compressing", message)
-                if rounds_complete == sum_jobs:
-                    done.put(None)  # Use none as a poison pill to kill the queue.
-                done.task_done()
-        compress_queue.join()
-        for w in workers:
-            compress_queue.put(None)
+        tasks = [tapestry.TaskCompress(target, compression_level, codec, threads) for target in targets]
+        run_tasks(ns, tasks, "Compressing")
         replacement_list = []
         for target in targets:
-            out = target+".bz2"
+            out = target + compression.codec_extension(codec)
             replacement_list.append(out)
     else:
         replacement_list = targets
@@ -197,36 +316,8 @@ def decompress_blocks(namespace):
             if file.endswith(".decrypted"):
                 found_decrypted.append(os.path.join(foo, file))
 
-    tasks = mp.JoinableQueue()  # Let's populate the queue
-    for file in found_decrypted:
-        tasks.put(tapestry.TaskDecompress(file))
-    sum_jobs = tasks.qsize()
-
-    workers = []
-    done = mp.JoinableQueue()
-    for i in range(os.cpu_count()):
-        workers.append(tapestry.ChildProcess(tasks, done, ns.workDir, ns.debug))
-    rounds_complete = 0
-    status_print(rounds_complete, sum_jobs, "Decompressing", "Working...")
-    for w in workers:
-        w.start()
-    working = True
-    while working:
-        message = done.get()
-        if message is None:
-            working = False
-        else:
-            if not ns.debug:
-                message = "Working..."
-            rounds_complete += 1
-            status_print(rounds_complete, sum_jobs, "Decompressing", message)
-            if rounds_complete == sum_jobs:
-                done.put(None)  # Use none as a poison pill to kill the queue.
-            done.task_done()
-    tasks.join()
-    for w in workers:
-        tasks.put(None)
-    tasks.join()
+    tasks = [tapestry.TaskDecompress(file) for file in found_decrypted]
+    run_tasks(ns, tasks, "Decompressing")
 
 
 def decrypt_blocks(ns, verified_blocks, gpg_agent):
@@ -240,69 +331,154 @@ def decrypt_blocks(ns, verified_blocks, gpg_agent):
     :param gpg_agent: A python-gnupg GPG object.
     :return:
     """
-    worker_count = os.cpu_count()
-    """It should be noted this method of obtaining the maximum number of
-    processes to spawn is highly simplistic. Performance enhancements in
-    Tapestry's future will likely focus around finding a more elegant way
-    to do this.
-    """
-    tasks = mp.JoinableQueue()  # This queue provides jobs to be done.
-    done = mp.JoinableQueue()  # This queue provides jobs which ARE done.
-    workers = []
-    for i in range(worker_count):
-        workers.append(tapestry.ChildProcess(tasks, done, ns.workDir, ns.debug))
+    tasks = []
     for block in verified_blocks:
         if not os.path.exists(block+".decrypted"):  # No sense repeating
-            tasks.put(tapestry.TaskDecrypt(block, ns.workDir, gpg_agent))
-    sum_jobs = tasks.qsize()
-    rounds_complete = 0
-    for w in workers:
-        w.start()
-    working = True
-    if sum_jobs > 0:  # This would be the case if the block fails.
-        status_print(rounds_complete, sum_jobs, "Decrypting", "Working...")
-        while working:
-            message = done.get()
-            if message is None:
-                working = False
-            else:
-                if not ns.debug:
-                    message = "Working..."
-                rounds_complete += 1
-                status_print(rounds_complete, sum_jobs, "Decrypting", message)
-                if rounds_complete == sum_jobs:
-                    done.put(None)  # Use none as a poison pill to kill the queue.
-                done.task_done()
-        tasks.join()
-        for w in workers:
-            tasks.put(None)
-        tasks.join()
+            tasks.append(tapestry.TaskDecrypt(block, ns.workDir, gpg_agent))
+    if len(tasks) > 0:  # This would be the case if the block fails.
+        run_tasks(ns, tasks, "Decrypting")
     else:
         print("""Skipping Decryption as the current backup was decrypted during initial preparation.""")
-        for w in workers:
-            tasks.put(None)
-        tasks.join()
+
+
+def diff_previous_run(ops_list, previous_run, previous_index):
+    """Compares a freshly built ops list with the index of an earlier run,
+    for an incremental run. Files whose path, size and hash are unchanged are
+    not packed again; their entries are instead pointed at the block of the
+    run which already holds them, so that the new run's index still describes
+    every file.
+
+    :param ops_list: The full ops list prepared by build_ops_list. Unchanged
+    entries are renamed to the file identifier they were packed under, and
+    gain "run" and "block" keys and the offsets recorded for them.
+    :param previous_run: the name of the earlier run, such as
+    "host-2020-01-01".
+    :param previous_index: the earlier run's tapestry.RecoveryIndex.
+    :return: a tuple of the ops list of the files to pack, and a sorted list
+    of the "category/path" of each file deleted since the earlier run.
+    """
+    earlier = {}  # (category, path, segment): (FID, entry) for the file in the earlier run.
+    for fid, entry in previous_index.file_index.items():
+        earlier.update({(entry["category"], entry["fpath"], entry.get("segment")): (fid, entry)})
+
+    to_pack = {}
+    unchanged = {}  # FID in this run: FID the file was packed under.
+    for fid, entry in ops_list.items():
+        old_fid, old = earlier.pop((entry["category"], entry["fpath"], entry.get("segment")), (None, None))
+        if old is not None and "ref" not in old and old["sha256"] == entry["sha256"] and \
+                old["fsize"] == entry["fsize"]:
+            carry_entry(entry, old, previous_run)
+            unchanged.update({fid: old_fid})
+        else:  # Including unchanged duplicates, which dedupe_files points at their packed copy again.
+            to_pack.update({fid: entry})
+    for fid, old_fid in unchanged.items():  # The member is named by its FID within the earlier run's block.
+        ops_list.update({old_fid: ops_list.pop(fid)})
+    deleted = sorted("%s/%s" % (category, sub_path) for category, sub_path, segment in earlier if segment is None)
+
+    return to_pack, deleted
+
+
+def dedupe_files(ops_list, to_pack, previous_run=None, previous_index=None):
+    """Arranges for files with identical contents to be packed only once. The
+    first file with a given size and SHA256 hash is packed, and the others are
+    recorded in the index with a "ref" key naming its FID, so that recovery
+    can restore them from it. For an incremental run, files already packed by
+    an earlier run are not packed again either.
+
+    :param ops_list: The full ops list prepared by build_ops_list. Duplicate
+    entries gain a "ref" key; files found in an earlier run are renamed to
+    the FID they were packed under, as by diff_previous_run.
+    :param to_pack: the entries of ops_list which would otherwise be packed.
+    :param previous_run: for an incremental run, the name of the earlier run.
+    :param previous_index: for an incremental run, the earlier run's
+    tapestry.RecoveryIndex, whose packed files serve as a catalog by hash.
+    :return: the ops list of the files which are to be packed.
+    """
+    packed = {}  # (SHA256, size): the FID under which those contents are, or will be, packed.
+    catalog = {}  # (SHA256, size): (FID, entry) for contents packed by an earlier run.
+    if previous_index is not None:
+        for fid, entry in previous_index.file_index.items():
+            if "block" in entry and "ref" not in entry:  # Split files have no block.
+                catalog.update({(entry["sha256"], entry["fsize"]): (fid, entry)})
+    for fid, entry in ops_list.items():
+        if fid not in to_pack and "ref" not in entry:  # Already carried over from the earlier run.
+            packed.update({(entry["sha256"], entry["fsize"]): fid})
+
+    deduped = {}
+    found_earlier = {}  # FID in this run: FID the contents were packed under by an earlier run.
+    for fid, entry in to_pack.items():
+        digest = (entry["sha256"], entry["fsize"])
+        if "segments" in entry:  # A split file holds no data of its own; its segments are deduplicated instead.
+            deduped.update({fid: entry})
+        elif digest in packed:
+            entry.update({"ref": packed[digest]})
+        elif digest in catalog:  # Such as a file which was moved or renamed since the earlier run.
+            old_fid, old = catalog[digest]
+            carry_entry(entry, old, previous_run)
+            found_earlier.update({fid: old_fid})
+            packed.update({digest: old_fid})
+        else:
+            deduped.update({fid: entry})
+            packed.update({digest: fid})
+    for fid, old_fid in found_earlier.items():
+        ops_list.update({old_fid: ops_list.pop(fid)})
+
+    return deduped
 
 
 def do_main(namespace, gpg_agent):
     """Basic function that holds the runtime for the entire build process."""
     debug_print("Entering do_main")
     ns = namespace
-    print("Gathering a list of files to archive - this could take a few minutes.")
-    ops_list = build_ops_list(namespace)
-    debug_print("Have ops list")
-    print("Sorting the files to be archived - this could take a few minutes")
-    raw_recovery_index, namespace.sum_size = build_recovery_index(ops_list)
-    debug_print("Have RI, Proceeding to Pack")
-    if sys.platform == "win32":
-        list_blocks = windows_pack_blocks(raw_recovery_index, ops_list, namespace)
-    else:
-        list_blocks = unix_pack_blocks(raw_recovery_index, ops_list, namespace)
-    list_blocks = compress_blocks(ns, list_blocks, ns.compress, ns.compressLevel)
-    prevalidate_blocks(ns, list_blocks, ops_list)
-    encrypt_blocks(list_blocks, gpg_agent, ns.activeFP, ns)
-    sign_blocks(namespace, gpg_agent)
-    if namespace.modeNetwork.lower() == "sftp":
+    ns.pool = tapestry.WorkerPool(ns.workDir, os.cpu_count(), ns.debug)  # Shared by every stage below.
+    try:
+        print("Gathering a list of files to archive - this could take a few minutes.")
+        ops_list = build_ops_list(namespace)
+        debug_print("Have ops list")
+        to_pack = ops_list
+        previous_run, previous_index = None, None
+        ns.incremental_meta = None
+        if ns.incremental:
+            previous_run, previous_index = load_previous_index(ns)
+            if previous_index is not None:
+                to_pack, deleted = diff_previous_run(ops_list, previous_run, previous_index)
+                ns.incremental_meta = {"basedOn": previous_run, "deleted": deleted}
+                print("%s of %s files are new or changed since %s, and %s have been deleted."
+                      % (len(to_pack), len(ops_list), previous_run, len(deleted)))
+            else:
+                print("WARNING: --incremental was given, but there is no earlier run to build on, so this run "
+                      "will be a full backup.")
+        count_to_pack = len(to_pack)
+        to_pack = dedupe_files(ops_list, to_pack, previous_run, previous_index)
+        if len(to_pack) < count_to_pack:
+            print("%s files are duplicates of other files and will not be packed again."
+                  % (count_to_pack - len(to_pack)))
+        print("Sorting the files to be archived - this could take a few minutes")
+        raw_recovery_index, namespace.sum_size = build_recovery_index(to_pack)
+        debug_print("Have RI, Proceeding to Pack")
+        pipelined = False
+        if ns.stream_blocks:
+            stream_blocks(raw_recovery_index, ops_list, namespace, gpg_agent)
+        elif sys.platform == "win32":
+            list_blocks = windows_pack_blocks(raw_recovery_index, ops_list, namespace)
+            if len(list_blocks) > 0:
+                first_block = os.path.splitext(os.path.basename(list_blocks[0]))[0]
+                emit_index_sidecar(ns, first_block.rsplit("-", 1)[0],
+                                   os.path.join(ns.workDir, first_block + ".riff"), gpg_agent)
+            list_blocks = compress_blocks(ns, list_blocks, ns.compress, ns.compressLevel,
+                                          ns.compressCodec, ns.compressThreads)
+            if not getattr(ns, "validate_inline", False):  # Otherwise the files were checked as they were packed.
+                prevalidate_blocks(ns, list_blocks, ops_list)
+            encrypt_blocks(list_blocks, gpg_agent, ns.activeFP, ns)
+        else:
+            pipeline_blocks(raw_recovery_index, ops_list, namespace, gpg_agent)  # Signs and uploads as it goes.
+            pipelined = True
+        if not pipelined:
+            sign_blocks(namespace, gpg_agent)
+    finally:
+        ns.pool.close()
+        ns.pool = None
+    if namespace.modeNetwork.lower() == "sftp" and not pipelined:
         sftp_deposit_files(namespace)
     clean_up(namespace.workDir)
     print("The temporary working directories have been cleared and your files")
@@ -320,18 +496,62 @@ def do_recovery(namespace, gpg_agent):
         print("FTP Fetch Completed")
     else:
         rec_index = media_retrieve_files(namespace.recovery_path, namespace.workDir,
-                                         gpg_agent)
+                                         gpg_agent, getattr(namespace, "restore_paths", None))
         namespace.rec_index = rec_index
         debug_print("DoRecovery: namespace after MRF: %s" % namespace)
-    verified_blocks = verify_blocks(namespace, gpg_agent)
-    decrypt_blocks(namespace, verified_blocks, gpg_agent)
-    decompress_blocks(namespace)
-    unpack_blocks(namespace)
+    namespace.pool = tapestry.WorkerPool(namespace.workDir, os.cpu_count(), namespace.debug)  # Verification uses it too.
+    try:
+        verified_blocks = verify_blocks(namespace, gpg_agent)
+        decrypt_blocks(namespace, verified_blocks, gpg_agent)
+        decompress_blocks(namespace)
+        unpack_blocks(namespace)
+    finally:
+        namespace.pool.close()
+        namespace.pool = None
     clean_up(namespace.workDir)
     debug_print("REC: Got this far, so I should terminate")
     exit()
 
 
+def emit_index_sidecar(namespace, run_name, riff, gpg_agent):
+    """Writes an encrypted and signed copy of the run's recovery index next
+    to the blocks, so that recovery can read the index without decrypting a
+    whole block first. If "Binary Index" is set, the index is converted to the
+    binary index format first, which recovery can search without loading it.
+
+    :param namespace: the tapestry namespace object.
+    :param run_name: the block name less its number; the sidecar will be
+    run_name+".tapidx".
+    :param riff: the absolute path to a RIFF file for the run.
+    :param gpg_agent: a python-gnupg gpg_agent object to do the encryption
+    and signing.
+    :return: a list of the absolute paths of the sidecar and its signature,
+    which is empty if the sidecar could not be written. In manifest signing
+    mode the sidecar is not signed itself, and is listed alone; it is covered
+    by the run's manifest instead.
+    """
+    ns = namespace
+    sidecar = os.path.join(ns.drop, run_name + ".tapidx")
+    if getattr(ns, "binary_index", False):  # Test namespaces may not define this.
+        with open(riff, "r") as f:
+            metadata, entries = tapestry.iter_riff(f)
+            riff = tapestry.write_binary_index(metadata, entries, riff + ".trix")
+    with open(riff, "rb") as index:
+        k = gpg_agent.encrypt_file(index, ns.activeFP, output=sidecar, armor=not ns.binary_output,
+                                   always_trust=True)
+    if not k.ok:
+        print("Unable to write the index sidecar, status: %s" % k.status)
+        print("Recovery will read the index from the first block instead.")
+        return []
+    if getattr(ns, "sign_manifest", False):  # Test namespaces may not define this.
+        return [sidecar]
+    signed = tapestry.TaskSign(sidecar, ns.sigFP, ns.drop, gpg_agent)()
+    if not signed.startswith("Signing Success"):
+        print(signed)
+
+    return [sidecar, sidecar + ".sig"]
+
+
 def encrypt_blocks(targets, gpg_agent, fingerprint, namespace):
     """Does the needful to take an argued list of packaged blocks and encrypt.
     Returns a list of the output files.
@@ -344,36 +564,8 @@ def encrypt_blocks(targets, gpg_agent, fingerprint, namespace):
     """
     ns = namespace
     out = ns.drop
-    jobs = mp.JoinableQueue()
-    for target in targets:
-        job = tapestry.TaskEncrypt(target, fingerprint, out, gpg_agent)
-        jobs.put(job)
-    workers = []
-    sum_jobs = int(jobs.qsize())
-    done = mp.JoinableQueue()
-    for i in range(os.cpu_count()):
-        workers.append(tapestry.ChildProcess(jobs, done, ns.workDir, ns.debug))
-    rounds_complete = 0
-    for w in workers:
-        w.start()
-    working = True
-    status_print(rounds_complete, sum_jobs, "Encrypting", "Working...")
-    while working:
-        message = done.get()
-        if message is None:
-            working = False
-        if not ns.debug:
-            message = "Working..."
-        rounds_complete += 1
-        if rounds_complete == sum_jobs:
-            done.put(None)  # Use none as a poison pill to kill the queue.
-        if rounds_complete <= sum_jobs:
-            status_print(rounds_complete, sum_jobs, "Encrypting", message)
-        done.task_done()
-    jobs.join()
-    for w in workers:
-        jobs.put(None)
-    jobs.join()
+    tasks = [tapestry.TaskEncrypt(target, fingerprint, out, gpg_agent, not ns.binary_output) for target in targets]
+    run_tasks(ns, tasks, "Encrypting")
 
 
 def format_table(dict_data, list_column_order, output_width):
@@ -516,20 +708,250 @@ def get_user_input(message, dict_data, resp_column, list_column_order):
     return lookup_list[response]
 
 
-def media_retrieve_files(mountpoint, temp_path, gpg_agent):
-    """Iterates over mountpoint, moving .tap files and their signatures to the
+def hash_files(namespace, targets, batch_bytes=2 ** 26, batch_files=256):
+    """Computes the SHA256 digest of every file in targets, spreading the work
+    over a pool of worker processes. Files are grouped into batches of up to
+    batch_files files or batch_bytes bytes, whichever is reached first.
+
+    :param namespace: the tapestry namespace object.
+    :param targets: a list of (fid, absolute path) tuples.
+    :param batch_bytes: the approximate number of bytes to hash per task.
+    :param batch_files: the maximum number of files to hash per task.
+    :return: a dictionary of fid:hexdigest pairs. Files which could not be
+    read have no entry.
+    """
+    ns = namespace
+    digests = {}
+    if len(targets) == 0:
+        return digests
+    tasks = []
+    batch = []
+    size_batch = 0
+    for fid, path in targets:
+        batch.append((fid, path))
+        try:
+            size_batch += os.path.getsize(path)
+        except OSError:  # TaskHashFiles leaves it out of the result.
+            pass
+        if len(batch) >= batch_files or size_batch >= batch_bytes:
+            tasks.append(tapestry.TaskHashFiles(batch))
+            batch = []
+            size_batch = 0
+    if len(batch) > 0:
+        tasks.append(tapestry.TaskHashFiles(batch))
+    for result in run_tasks(ns, tasks, "Hashing"):
+        if isinstance(result, list):
+            digests.update(dict(result))
+        else:  # Anything other than a list of digests is a message from the worker.
+            print(result)
+
+    return digests
+
+
+def load_index_sidecar(sidecar, temp_path, gpg_agent, testing=False):
+    """Verifies and decrypts an index sidecar written by emit_index_sidecar.
+    As the sidecar decides which blocks are fetched and where their files are
+    restored, its signer must be approved by the user, as a block's signer is
+    by verify_blocks, before it is used.
+
+    :param sidecar: the absolute path to the .tapidx file; its signature, or
+    the run's signed manifest, is expected alongside it.
+    :param temp_path: absolute path to the system's working directory.
+    :param gpg_agent: a python-gnupg gpg agent object
+    :param testing: if True, the signer is approved without asking.
+    :return: a tapestry.RecoveryIndex, or None if the sidecar can't be used.
+    Its signer attribute is set to the approved fingerprint, so that
+    verify_blocks need not ask about it again.
+    """
+    signed = sidecar + ".sig"
+    manifest = sidecar[:-len(".tapidx")] + ".tapsum"
+    if not os.path.exists(signed) and os.path.exists(manifest + ".sig"):  # Written in manifest signing mode.
+        signed = manifest + ".sig"
+        with open(sidecar, "rb") as f:
+            if read_manifest(manifest).get(os.path.basename(sidecar)) != tapestry.hash_stream(f):
+                print("The index sidecar %s does not match its manifest and will not be used."
+                      % os.path.basename(sidecar))
+                return None
+    if not os.path.exists(signed):
+        print("The index sidecar %s is not signed and will not be used." % os.path.basename(sidecar))
+        return None
+    with open(signed, "rb") as k:
+        result = gpg_agent.verify_file(k, signed[:-len(".sig")])
+    if not result.valid:
+        print("The index sidecar %s has an invalid signature and will not be used." % os.path.basename(sidecar))
+        return None
+    if not approve_signer(result.fingerprint, result.username, "the run's index sidecar", testing):
+        print("The index sidecar %s will not be used." % os.path.basename(sidecar))
+        return None
+    index_path = os.path.join(temp_path, os.path.basename(sidecar) + ".riff")
+    with open(sidecar, "rb") as f:
+        k = gpg_agent.decrypt_file(f, output=index_path, always_trust=True)
+    if not k.ok:
+        print("The index sidecar %s could not be decrypted." % os.path.basename(sidecar))
+        return None
+    with open(index_path, "rb") as index_file:
+        try:
+            rec_index = tapestry.RecoveryIndex(index_file)
+        except tapestry.RecoveryIndexError:
+            return None
+    rec_index.signer = result.fingerprint
+
+    return rec_index
+
+
+def warn_compact_index(rec_index, block):
+    """Warns the user if the index read from a block holds only the files of
+    that block, because the blocks which carry the whole index were missing.
+
+    :param rec_index: the tapestry.RecoveryIndex read from the block.
+    :param block: the name of the block it was read from.
+    :return:
+    """
+    if rec_index.compact:
+        print("The block %s holds the index of its own files only, so only those files can be restored." % block)
+        print("The whole index is held by the run's index sidecar, by %s, and by these blocks of the run: %s"
+              % (rec_index.run_metadata["runIndex"]["name"],
+                 ", ".join(str(number) for number in rec_index.run_metadata["runIndex"]["fullBlocks"])))
+
+
+def load_previous_index(namespace):
+    """Finds the RIFF of the most recent earlier run in the output path, which
+    an incremental run is built against.
+
+    :param namespace: the tapestry namespace object.
+    :return: a tuple of the earlier run's name and its tapestry.RecoveryIndex,
+    or (None, None) if there is no earlier run that can be used.
+    """
+    ns = namespace
+    runs = {}  # Run name: (rank, RIFF name) of the RIFF holding its whole index, preferring the run's own RIFF.
+    if os.path.isdir(ns.drop):
+        for file in os.listdir(ns.drop):
+            if not (file.startswith(ns.compid + "-") and file.endswith(".riff")):
+                continue
+            name = file[:-len(".riff")]
+            if is_run_riff(file):
+                run_name, rank = name, 0
+            else:
+                run_name, rank = name.rsplit("-", 1)[0], block_number(file)  # Older runs have only block RIFFs.
+            if rank is not None and (run_name not in runs or rank < runs[run_name][0]):
+                runs.update({run_name: (rank, file)})
+    if len(runs) == 0:
+        print("No earlier run was found in %s, so every file will be backed up." % ns.drop)
+        return None, None
+    previous_run = max(runs)  # Run names end in an ISO date, so they sort by age.
+    if previous_run == ns.compid + "-" + str(datetime.date.today()):
+        print("A run has already been made today, and this run's blocks would replace its blocks, so every file "
+              "will be backed up.")
+        return None, None
+    with open(os.path.join(ns.drop, runs[previous_run][1]), "rb") as index_file:
+        try:
+            previous_index = tapestry.RecoveryIndex(index_file)
+        except tapestry.RecoveryIndexError:
+            previous_index = None
+    if previous_index is None or previous_index.mode == "pkl" or previous_index.compact or \
+            previous_index.blocks_holding(previous_index.fids()) is None:
+        print("The index of %s does not record which block holds each file, so every file will be backed up."
+              % previous_run)
+        return None, None
+    if os.path.exists(os.path.join(ns.drop, previous_run + ".failed")):  # Their files were never packed.
+        print("Some blocks of %s could not be built, so every file will be backed up." % previous_run)
+        return None, None
+
+    return previous_run, previous_index
+
+
+def is_run_riff(filename):
+    """Says whether a RIFF is a run's own RIFF, as written by write_run_index,
+    such as "host-2020-01-01.riff", rather than the RIFF of one of its
+    blocks, such as "host-2020-01-01-3.riff".
+
+    :param filename: the name or path of the file.
+    :return: True if it is a run's RIFF, False otherwise.
+    """
+    name = os.path.basename(filename)
+    if not name.endswith(".riff"):
+        return False
+    try:  # Only the run's RIFF ends in the date rather than a block number.
+        datetime.date.fromisoformat(name[-len("2020-01-01.riff"):-len(".riff")])
+    except ValueError:
+        return False
+    return True
+
+
+def load_hash_cache(path):
+    """Loads the persistent hash cache used by build_ops_list. The cache maps a
+    "device:inode:size:mtime_ns" key to the SHA256 hexdigest of the file which
+    had those properties when it was last hashed.
+
+    :param path: path to the cache file, or None if caching is disabled.
+    :return: dictionary of cache_key:hexdigest pairs, empty if unavailable.
+    """
+    if not path or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, "r") as cache_file:
+            return json.load(cache_file)
+    except (ValueError, OSError):
+        print("The hash cache at %s could not be read and will be rebuilt." % path)
+        return {}
+
+
+def link_block(source, temp_path):
+    """Places a block, or its signature, found on the recovery media in the
+    working directory. Where it can be, the file is linked to rather than
+    copied, so that recovery reads it in place instead of writing it out
+    again first; otherwise, as on Windows without the right to make
+    symbolic links, it is copied.
+
+    :param source: absolute path to the file on the media.
+    :param temp_path: absolute path to the system's working directory.
+    :return: True if the file was linked, False if it was copied.
+    """
+    target = os.path.join(temp_path, os.path.basename(source))
+    if os.path.lexists(target):  # Left by an earlier attempt; shutil.copy refuses to copy a file onto itself.
+        os.remove(target)
+    try:
+        os.symlink(os.path.abspath(source), target)
+        return True
+    except (OSError, NotImplementedError):
+        shutil.copy(source, target)
+        return False
+
+
+def copy_linked_blocks(temp_path, linked):
+    """Replaces links made by link_block with copies of the files they point
+    to, so that the media they are on can be removed.
+
+    :param temp_path: absolute path to the system's working directory.
+    :param linked: a list of the names of the linked files.
+    """
+    for file in linked:
+        target = os.path.join(temp_path, file)
+        source = os.readlink(target)
+        os.remove(target)
+        shutil.copy(source, target)
+
+
+def media_retrieve_files(mountpoint, temp_path, gpg_agent, restore_paths=None):
+    """Iterates over mountpoint, placing .tap files and their signatures in the
     temporary working directory. Early in operation, will retrieve the recovery
-    pickle or NewRIFF index from the first block it finds.
+    pickle or NewRIFF index from the index sidecar or the first block it finds.
+
+    Blocks are linked into the working directory by link_block, and so read
+    in place from the media, rather than copied. If the blocks span several
+    disks, those linked from a disk are copied after all before the user is
+    asked to change it.
 
     :param mountpoint: absolute path to the media mountpoint.
     :param temp_path: absolute path to the system's working directory.
     :param gpg_agent: a python-gnupg gpg agent object
+    :param restore_paths: an optional list of glob patterns. If provided, only
+    the blocks holding matching files are moved to the working directory.
     :return:
     """
-    print("Now searching local media for the first block. This includes decrypting")
-    print("the first block in order to obtain the recovery index. Please wait.")
-    found_blocks = []
-    found_sigs = []
+    print("Now searching local media for the first block and the recovery index. Please wait.")
+    found_blocks = {}  # Filename: location, for blocks and their signatures; they are placed once the index is read.
+    found_sidecars = []
     initial_block_hunt = True
 
     while initial_block_hunt:
@@ -538,156 +960,102 @@ def media_retrieve_files(mountpoint, temp_path, gpg_agent):
             if not os.path.exists(temp_path):  # We must create this explicitly for shutil
                 os.mkdir(temp_path)
             for file in files:
-                if file.endswith(".tap"):
-                    found_blocks.append(file)
-                    shutil.copy(os.path.join(location, file), os.path.join(temp_path, file))
-                elif file.endswith(".tap.sig"):
-                    found_sigs.append(file)
+                if file.endswith(".tap") or file.endswith(".tap.sig"):
+                    found_blocks.update({file: location})
+                elif file.endswith((".tapidx", ".tapidx.sig", ".tapsum", ".tapsum.sig")):  # Small; always copied.
+                    found_sidecars.append(file)
                     shutil.copy(os.path.join(location, file), os.path.join(temp_path, file))
 
-        if len(found_blocks) == 0:
+        list_blocks = [file for file in found_blocks if file.endswith(".tap")]
+        if len(list_blocks) == 0:
             print("The are no recovery files on the mountpoint at %s" % mountpoint)
             print("Check the media is inserted correctly (or that that address is correct) and try again.")
             input("Press enter to continue")
         else:
             initial_block_hunt = False
 
-    # Now we need to obtain a recovery file of some kind.
-    decrypted_first = tapestry.TaskDecrypt(os.path.join(temp_path, found_blocks[0]), temp_path, gpg_agent)
-    decrypted_first = decrypted_first()
-    debug_print("MRF: decrypted_first is: %s" % decrypted_first)
-    debug_print("MRF: The conditional is therefore: %s" % decrypted_first.split(" ")[1].lower())
-    if decrypted_first.split(" ")[1].lower() == "success":
-        tar = tarfile.open(os.path.join(temp_path, decrypted_first.split(" ")[3].rstrip(".")), "r:*")
-        # Hideous string management hack.
-        tapfile_contents = tar.getnames()
-        debug_print("The provided block contains: %s" % str(tapfile_contents))
-
-        if "recovery-pkl" in tapfile_contents:
-            index_file = tar.extractfile("recovery-pkl")
-        elif "recovery-riff" in tapfile_contents:
-            index_file = tar.extractfile("recovery-riff")
+    # Now we need to obtain a recovery file of some kind, preferring the sidecar to decrypting a block.
+    rec_index = None
+    # The newest run is the one recovered, and its lowest-numbered block is the most likely to hold the whole index.
+    first_block = max(list_blocks, key=lambda file: (file.rsplit("-", 1)[0], -(block_number(file) or 0)))
+    run_name = first_block.rsplit("-", 1)[0]
+    copied = []  # Blocks and signatures placed in temp_path, whether linked or copied.
+    linked = []
+    sidecar = first_block.rsplit("-", 1)[0] + ".tapidx"
+    if sidecar in found_sidecars:
+        rec_index = load_index_sidecar(os.path.join(temp_path, sidecar), temp_path, gpg_agent)
+    if rec_index is None:
+        print("Decrypting the first block in order to obtain the recovery index. Please wait.")
+        if link_block(os.path.join(found_blocks[first_block], first_block), temp_path):
+            linked.append(first_block)
+        copied.append(first_block)
+        decrypted_first = tapestry.TaskDecrypt(os.path.join(temp_path, first_block), temp_path, gpg_agent)
+        decrypted_first = decrypted_first()
+        debug_print("MRF: decrypted_first is: %s" % decrypted_first)
+        debug_print("MRF: The conditional is therefore: %s" % decrypted_first.split(" ")[1].lower())
+        if decrypted_first.split(" ")[1].lower() == "success":
+            tar = compression.open_tar(os.path.join(temp_path, decrypted_first.split(" ")[3].rstrip(".")))
+            # Hideous string management hack.
+            tapfile_contents = tar.getnames()
+            debug_print("The provided block contains: %s" % str(tapfile_contents))
+
+            if "recovery-pkl" in tapfile_contents:
+                index_file = tar.extractfile("recovery-pkl")
+            elif "recovery-riff" in tapfile_contents:
+                index_file = tar.extractfile("recovery-riff")
+            else:
+                index_file = open("/dev/null", "rb")  # Just for giggles
+                print("Something has gone wrong!")
+                print("One or more blocks are corrupt and missing their recovery index.")
+                print("This is a fatal error.")
+                exit()
         else:
-            index_file = open("/dev/null", "rb")  # Just for giggles
-            print("Something has gone wrong!")
-            print("One or more blocks are corrupt and missing their recovery index.")
-            print("This is a fatal error.")
+            print("Something has gone wrong in initial decryption.")
+            print("Verify you have the key for the blocks provided and try again.")
             exit()
-    else:
-        print("Something has gone wrong in initial decryption.")
-        print("Verify you have the key for the blocks provided and try again.")
-        exit()
 
-    # If we made it this far, we have a recovery file, so let's return a recovery index
-    rec_index = tapestry.RecoveryIndex(index_file)
+        # If we made it this far, we have a recovery file, so let's return a recovery index
+        rec_index = tapestry.RecoveryIndex(index_file)
+        tar.close()
+        warn_compact_index(rec_index, first_block)
 
-    while len(found_blocks) < rec_index.blocks:
+    wanted = select_restore_blocks(rec_index, restore_paths)
+    if wanted is None:
+        blocks_needed = rec_index.blocks
+    else:
+        blocks_needed = len(wanted)
+        if first_block in copied and block_key(first_block, run_name) not in wanted:  # Only needed for the index.
+            os.remove(os.path.join(temp_path, first_block))
+            os.remove(os.path.join(temp_path, first_block + ".decrypted"))
+            copied.remove(first_block)
+            if first_block in linked:
+                linked.remove(first_block)
+
+    def needed(file):
+        if wanted is None:
+            return block_key(file, run_name)[0] is None
+        return block_key(file, run_name) in wanted
+
+    while True:
+        for file, location in found_blocks.items():
+            if file not in copied and needed(file):
+                if link_block(os.path.join(location, file), temp_path):
+                    linked.append(file)
+                copied.append(file)
+        if len([file for file in copied if file.endswith(".tap") and needed(file)]) >= blocks_needed:
+            break
+        copy_linked_blocks(temp_path, [file for file in linked if os.path.islink(os.path.join(temp_path, file))])
+        linked = []
         print("One or more blocks are missing. Please insert the next disk")
         input("Press enter to continue")
         for location, sub_directories, files in os.walk(mountpoint):
             for file in files:
-                if file.endswith(".tap"):
-                    found_blocks.append(file)
-                    shutil.copy(file, os.path.join(temp_path, file))
-                elif file.endswith(".tap.sig"):
-                    found_sigs.append(file)
-                    shutil.copy(file, os.path.join(temp_path, file))
+                if file.endswith(".tap") or file.endswith(".tap.sig"):
+                    found_blocks.update({file: location})
 
     return rec_index
 
 
-def unix_pack_blocks(sizes, ops_list, namespace):
-    """Processes files by creating the individual tarred tapblock files, and
-    returns a list of those files and their absolute paths to be processed by
-    the next stage of events. This version is specific to unix systems (defined
-    as all non-windows systems in this case) and uses the multiprocessing
-    module to gain about a 20% performance increase on average compared to the
-    windows version.
-
-    :param sizes: a list object returned by build_recovery_index, made up of
-    strings indicating file identifier values sorted by the size of the file.
-    :param ops_list: The full ops list prepared by build_ops_list, which is
-    equivalent to the third portion of a recovery index file.
-    :param namespace: the entire namespace object.
-    :return:
-    """
-    ns = namespace
-    collection_blocks = []
-    block_final_paths = []
-    block_name_base = ns.compid+"-"+str(datetime.date.today())
-    counter = 1  # Remember to increment this later
-    smallest = ops_list[sizes[-1]]['fsize']
-    working_block = tapestry.Block(
-        (block_name_base+"-"+str(counter)), ns.block_size_raw, counter, smallest
-    )
-    packing = True
-    while packing:
-        for item in sizes:
-            placed = working_block.put(item, ops_list[item])
-            if placed:
-                sizes.remove(item)
-        if working_block.full:  # We need a new block, unpacked items.
-            collection_blocks.append(working_block)
-            counter += 1
-            working_block = tapestry.Block(
-                (block_name_base+"-"+str(counter)), ns.block_size_raw, counter, smallest
-            )
-        elif len(sizes) == 0:
-            collection_blocks.append(working_block)
-            packing = False  # The list is empty and we're therefore done.
-    tarf_queue = mp.JoinableQueue()
-    locks = {}
-    temp_queue = []  # We need a temporary queue to avoid having the blocks all lined up.
-    sum_files = 0
-    for block in collection_blocks:
-        sum_files += block.files
-    sum_sizes = ns.sum_size
-    for block in collection_blocks:
-        this_block_lock = mp.Lock()
-        locks.update({block.name: this_block_lock})
-        tarf = os.path.join(ns.workDir, (block.name+".tar"))
-        block_final_paths.append(tarf)
-        for fid, file_metadata in block.file_index.items():
-            path = os.path.join(ns.category_paths[file_metadata["category"]],
-                                file_metadata['fpath'])
-            this_task = tapestry.TaskTarBuild(tarf, fid, path, block.name)
-            temp_queue.append(this_task)
-        this_riff = block.meta(len(collection_blocks), sum_sizes, sum_files,
-                               str(datetime.date.today()), None, ops_list, ns.drop)
-        this_task = tapestry.TaskTarBuild(tarf, "recovery-riff",
-                                          this_riff, block.name)
-        tarf_queue.put(this_task)
-    shuffle(temp_queue)  # Shuffling these tasks before feeding them into the queue is actually a speed boost.
-    for task in temp_queue:
-        tarf_queue.put(task)
-    sum_jobs = int(tarf_queue.qsize())
-    done = mp.JoinableQueue()
-    workers = []
-    for i in range(os.cpu_count()):
-        workers.append(tapestry.ChildProcess(tarf_queue, done, ns.workDir, locks, ns.debug))
-    rounds_complete = 0
-    for w in workers:
-        w.start()
-    working = True
-    while working:
-        message = done.get()
-        if message is None:
-            working = False
-        else:
-            if not namespace.debug:
-                message = "Working..."
-            rounds_complete += 1
-            status_print(rounds_complete, sum_jobs, "Packing", message)
-            if rounds_complete == sum_jobs:
-                done.put(None)  # Use none as a poison pill to kill the queue.
-            done.task_done()
-    tarf_queue.join()
-    for w in workers:
-        tarf_queue.put(None)
-
-    return block_final_paths
-
-
 def parse_args(namespace):
     """Parse arguments and return the modified namespace object"""
     ns = namespace
@@ -706,6 +1074,10 @@ def parse_args(namespace):
     parser.add_argument('-c', help="absolute or relative path to the config file", action="store")
     parser.add_argument('--validate', help="Expects a path or csv string of paths describing blocks to validate.",
                         action="store")
+    parser.add_argument('--restore-path', help="With --rcv, restore only the files whose paths match this glob. "
+                                               "May be given more than once.", action="append")
+    parser.add_argument('--incremental', help="Back up only the files which are new or changed since the last run.",
+                        action="store_true")
     args = parser.parse_args()
 
     ns.rcv = args.rcv
@@ -715,6 +1087,8 @@ def parse_args(namespace):
     ns.genKey = args.genKey
     ns.config_path = args.c
     ns.validation_target = args.validate
+    ns.restore_paths = args.restore_path
+    ns.incremental = args.incremental
     if ns.validation_target is not None:
         ns.demand_validate = True
     else:
@@ -728,8 +1102,8 @@ def windows_pack_blocks(sizes, ops_list, namespace):
     returns a list of those files and their absolute paths to be processed by
     the next stage of events. This version is meant to be used when the
     detected operating system is windows (sys.platform == "win32"). This runs
-    in a single-process workflow because we've yet to implement an operating
-    locking method under windows.
+    the same per-block packing tasks as the unix version, but calls them one
+    after another in a single process.
 
     :param sizes: a list object returned by build_recovery_index, made up of
     strings indicating file identifier values sorted by the size of the file.
@@ -739,51 +1113,41 @@ def windows_pack_blocks(sizes, ops_list, namespace):
     :return:
     """
     ns = namespace
-    collection_blocks = []
     block_final_paths = []
     block_name_base = ns.compid + "-" + str(datetime.date.today())
-    counter = 1  # Remember to increment this later
-    smallest = ops_list[sizes[-1]]['fsize']
-    working_block = tapestry.Block(
-        (block_name_base + "-" + str(counter)), ns.block_size_raw, counter, smallest
-    )
+    collection_blocks = blocksort.sort_blocks(sizes, ops_list, ns.block_size_raw, block_name_base)
     if not os.path.exists(ns.workDir):
         os.mkdir(ns.workDir)
 
-    packing = True
-    while packing:
-        for item in sizes:
-            placed = working_block.put(item, ops_list[item])
-            if placed:
-                sizes.remove(item)
-        if working_block.full:  # We need a new block, unpacked items.
-            collection_blocks.append(working_block)
-            counter += 1
-            working_block = tapestry.Block(
-                (block_name_base + "-" + str(counter)), ns.block_size_raw, counter, smallest
-            )
-        elif len(sizes) == 0:
-            collection_blocks.append(working_block)
-            packing = False  # The list is empty and we're therefore done.
     sum_files = 0
     for block in collection_blocks:
         sum_files += block.files
     sum_sizes = ns.sum_size
+    run_index = None
+    if len(collection_blocks) > 0:
+        run_index = write_run_index(ns, ops_list, collection_blocks, sum_files)
+    inline = ns.do_validation and getattr(ns, "validate_inline", False)  # Test namespaces may not define this.
+    failed_validation = []
     current_counter = 0
+    status_print(current_counter, len(collection_blocks), "Packing", None)
     for block in collection_blocks:
         tarf = os.path.join(ns.workDir, (block.name + ".tar"))
         block_final_paths.append(tarf)
-        for fid, file_metadata in block.file_index.items():
-            current_counter += 1
-            path = os.path.join(ns.category_paths[file_metadata["category"]],
-                                file_metadata['fpath'])
-            with tarfile.open(tarf, "a:") as tf:
-                tf.add(path, arcname=fid, recursive=False)
-            status_print(current_counter, sum_files, "Packing", None)
+        members = block_members(ns, block)
         this_riff = block.meta(len(collection_blocks), sum_sizes, sum_files,
-                               str(datetime.date.today()), None, ops_list, ns.drop)
-        with tarfile.open(tarf, "a:") as tf:
-            tf.add(this_riff, arcname="recovery-riff", recursive=False)
+                               str(datetime.date.today()), None, ops_list, ns.drop,
+                               getattr(ns, "incremental_meta", None), run_index)
+        hashes = member_hashes(ops_list, members) if inline else None
+        message = tapestry.TaskPackBlock(tarf, members, this_riff, os.path.join(ns.workDir, block.name + ".loc"),
+                                         hashes, block_segments(block))()
+        head, failures = split_pack_failures(message)
+        if failures:
+            failed_validation.append("%s: %s" % (block.name, failures))
+        current_counter += 1
+        status_print(current_counter, len(collection_blocks), "Packing", None)
+    if len(collection_blocks) > 0:
+        record_locations(ns, ops_list, collection_blocks)
+    report_failed_validation(failed_validation)
 
     return block_final_paths
 
@@ -816,6 +1180,12 @@ def parse_config(namespace):
     ns.keysize = config.getint("Environment Variables", "keysize")
     ns.compress = config.getboolean("Environment Variables", "Use Compression")
     ns.compressLevel = config.getint("Environment Variables", "Compression Level")
+    requested_codec = config.get("Environment Variables", "Compression Codec", fallback=compression.default_codec)
+    ns.compressCodec = compression.resolve_codec(requested_codec)
+    if ns.compressCodec != requested_codec.strip().lower():
+        print("The %s compression codec is not available, so %s will be used instead."
+              % (requested_codec, ns.compressCodec))
+    ns.compressThreads = config.getint("Environment Variables", "Compression Threads", fallback=0)
     ns.step = "none"
     ns.sumJobs = 0
     ns.jobsDone = 0
@@ -828,6 +1198,8 @@ def parse_config(namespace):
     ns.network_credential_pass = config.getboolean("Network Configuration", "Credential Has Passphrase")
     ns.dirNet = config.get("Network Configuration", "remote drop location")
     ns.retainLocal = config.getboolean("Network Configuration", "Keep Local Copies")
+    ns.sftp_sessions = config.getint("Network Configuration", "SFTP Sessions", fallback=4)
+    ns.sftp_retries = config.getint("Network Configuration", "SFTP Retries", fallback=3)
     ns.block_size_raw = config.getint("Environment Variables", "blockSize") * (
         2 ** 20)  # The math is necessary to go from MB to Bytes)
     ns.compid = config.get("Environment Variables", "compid")
@@ -835,6 +1207,16 @@ def parse_config(namespace):
     ns.uid = config.get("Environment Variables", "uid")
     ns.drop = config.get("Environment Variables", "Output Path")
     ns.do_validation = config.getboolean("Environment Variables", "Build-Time File Validation")
+    ns.binary_output = config.getboolean("Environment Variables", "Binary Output", fallback=False)
+    ns.stream_blocks = config.getboolean("Environment Variables", "Stream Blocks", fallback=False)
+    ns.validate_inline = config.getboolean("Environment Variables", "Inline Validation", fallback=False)
+    ns.sign_manifest = config.getboolean("Environment Variables", "Manifest Signing", fallback=False)
+    ns.index_redundancy = config.getint("Environment Variables", "Index Redundancy", fallback=0)
+    ns.binary_index = config.getboolean("Environment Variables", "Binary Index", fallback=False)
+    hash_cache_path = config.get("Environment Variables", "Hash Cache Path", fallback="")
+    if hash_cache_path == "":  # The template leaves it empty.
+        hash_cache_path = os.path.join(ns.drop, "tapestry-hashcache.json")
+    ns.hash_cache_path = os.path.abspath(os.path.expanduser(hash_cache_path))  # The workers chdir to workDir.
 
     if ns.currentOS == "Linux":
         ns.workDir = "/tmp/Tapestry/"
@@ -871,6 +1253,173 @@ def parse_config(namespace):
     return ns
 
 
+def pipeline_blocks(sizes, ops_list, namespace, gpg_agent):
+    """Builds every block of the run, moving each block through packing,
+    compression, validation, encryption and signing as soon as it is ready
+    for the next step, rather than waiting for every block to finish each
+    step. Finished blocks are uploaded from a separate thread while the rest
+    are still being built, if the run is in SFTP mode.
+
+    :param sizes: a list object returned by build_recovery_index, made up of
+    strings indicating file identifier values sorted by the size of the file.
+    :param ops_list: The full ops list prepared by build_ops_list, which is
+    equivalent to the third portion of a recovery index file.
+    :param namespace: the entire namespace object, with a WorkerPool as
+    namespace.pool.
+    :param gpg_agent: a python-gnupg gpg_agent object to do the encryption
+    and signing.
+    :return: list of absolute paths to the finished .tap files.
+    """
+    ns = namespace
+    block_final_paths = []
+    block_name_base = ns.compid + "-" + str(datetime.date.today())
+    collection_blocks = blocksort.sort_blocks(sizes, ops_list, ns.block_size_raw, block_name_base)
+    if len(collection_blocks) == 0:  # Nothing was found to back up.
+        return block_final_paths
+    pool = ns.pool
+    stages = ["pack"]
+    if ns.compress:
+        stages.append("compress")
+    inline = ns.do_validation and getattr(ns, "validate_inline", False)  # Test namespaces may not define this.
+    if ns.do_validation and not inline:
+        stages.append("validate")
+    manifest = getattr(ns, "sign_manifest", False)  # Test namespaces may not define this.
+    stages += ["encrypt", "digest" if manifest else "sign"]
+    digests = {}  # Filename: SHA256, for the manifest.
+    sum_files = 0
+    for block in collection_blocks:
+        sum_files += block.files
+    run_index = write_run_index(ns, ops_list, collection_blocks, sum_files)
+    run_riff = os.path.join(ns.drop, run_index["name"])
+    if manifest:
+        digests.update({run_index["name"]: run_index["sha256"]})
+
+    uploads = None
+    if ns.modeNetwork.lower() == "sftp":
+        uploads, uploaders = sftp_start_uploaders(ns, digests)
+        if uploads is not None:
+            uploads.put([run_riff])
+
+    blocks = {}  # block name: the state of that block as it moves through the stages.
+    waiting = list(collection_blocks)
+    waiting.reverse()  # So that pop() takes the blocks in order.
+    in_flight = {}  # ticket: block name
+    window = 2 * len(pool.workers)  # Blocks being built at once; this also bounds the working directory.
+    failed_validation = []
+    failed_blocks = {}  # Block number: why the block could not be built.
+    stages_total = len(collection_blocks) * len(stages)
+    stages_complete = 0
+
+    def submit(name):
+        state = blocks[name]
+        stage = stages[state["stage"]]
+        if stage == "pack":
+            hashes = member_hashes(ops_list, state["members"]) if inline else None
+            tasks = [tapestry.TaskPackBlock(state["path"], state["members"], state["riff"],
+                                            os.path.join(ns.workDir, name + ".loc"), hashes, state["segments"])]
+        elif stage == "compress":
+            tasks = [tapestry.TaskCompress(state["path"], ns.compressLevel, ns.compressCodec, ns.compressThreads)]
+        elif stage == "validate":
+            tasks = [tapestry.TaskCheckBlock(state["path"], member_hashes(ops_list, state["members"]))]
+        elif stage == "encrypt":
+            tasks = [tapestry.TaskEncrypt(state["path"], ns.activeFP, ns.drop, gpg_agent, not ns.binary_output)]
+        elif stage == "digest":  # The RIFF is hashed now too, as uploading it may remove it.
+            tasks = [tapestry.TaskHashFiles([(name + ".tap", state["path"]),
+                                             (os.path.basename(state["riff"]), state["riff"])])]
+        else:
+            tasks = [tapestry.TaskSign(state["path"], ns.sigFP, ns.drop, gpg_agent)]
+        state["outstanding"] = len(tasks)
+        for task in tasks:
+            in_flight[pool.submit(task)] = name
+
+    def admit():
+        while len(waiting) > 0 and len(blocks) < window:
+            block = waiting.pop()
+            blocks[block.name] = {
+                "stage": 0, "outstanding": 0, "failed": False,
+                "path": os.path.join(ns.workDir, block.name + ".tar"),
+                "members": block_members(ns, block),
+                "segments": block_segments(block),
+                "riff": block.meta(len(collection_blocks), ns.sum_size, sum_files,
+                                   str(datetime.date.today()), None, ops_list, ns.drop,
+                                   getattr(ns, "incremental_meta", None), run_index)
+            }
+            submit(block.name)
+
+    status_print(stages_complete, stages_total, "Building Blocks", "Working...")
+    admit()
+    while len(in_flight) > 0:
+        ticket, message = pool.collect()
+        name = in_flight.pop(ticket)
+        state = blocks[name]
+        stage = stages[state["stage"]]
+        state["outstanding"] -= 1
+        if stage == "validate":
+            if isinstance(message, list) and message[0]:
+                message = "Working..."
+            else:  # Reported, but the block still goes ahead, as it always has.
+                message = message[1] if isinstance(message, list) else message
+                failed_validation.append("%s: %s" % (name, message.strip()))
+                print("\n" + message)
+        elif stage == "digest" and isinstance(message, list):  # Otherwise the task failed, and says why.
+            digests.update(dict(message))
+            message = "Hashed %s" % name if ns.debug else "Working..."
+        elif stage == "pack" and split_pack_failures(message)[1]:  # Packed, but some files had changed.
+            message, failures = split_pack_failures(message)
+            failed_validation.append("%s: %s" % (name, failures))
+            print("\n" + failures)
+        elif not message.startswith(("Packed", "Compressed", "Encryption Success", "Signing Success")):
+            print("\n%s; %s will not be completed." % (message, name))  # Failures are always worth reporting.
+            failed_blocks.update({block_number(name): "%s: %s" % (name, message.strip())})
+            state["failed"] = True
+        elif not ns.debug:
+            message = "Working..."
+        if state["outstanding"] > 0:
+            continue
+        stages_complete += 1
+        if state["failed"]:
+            stages_complete += len(stages) - state["stage"] - 1
+            for path in [state["path"], os.path.join(ns.drop, name + ".tap"), os.path.join(ns.drop, name + ".tap.sig"),
+                         os.path.join(ns.workDir, name + ".loc"), state["riff"]]:  # Whatever the stages left behind.
+                if os.path.exists(path):
+                    os.remove(path)
+        else:
+            if stage == "compress":
+                os.remove(state["path"])  # The uncompressed tarball is no longer needed.
+                state["path"] += compression.codec_extension(ns.compressCodec)
+            elif stage == "encrypt":
+                os.remove(state["path"])
+                state["path"] = os.path.join(ns.drop, name + ".tap")
+            state["stage"] += 1
+            if state["stage"] < len(stages):
+                submit(name)
+            else:
+                block_final_paths.append(state["path"])
+                if uploads is not None:
+                    signature = [] if manifest else [state["path"] + ".sig"]
+                    uploads.put([state["path"]] + signature + [state["riff"]])
+        if state["failed"] or state["stage"] == len(stages):
+            del blocks[name]
+            admit()
+        status_print(stages_complete, stages_total, "Building Blocks", message)
+
+    sidecar = emit_index_sidecar(ns, block_name_base, record_locations(ns, ops_list, collection_blocks,
+                                                                       sorted(failed_blocks)), gpg_agent)
+    if manifest:
+        digests.update(hash_files(ns, [(os.path.basename(file), file) for file in sidecar]))
+        sidecar += write_manifest(ns, block_name_base, digests, gpg_agent)
+    if uploads is not None:
+        if len(sidecar) > 0:
+            uploads.put(sidecar)
+        print("Waiting for the remaining uploads to finish.")
+        sftp_finish_uploaders(uploads, uploaders)
+    mark_failed_blocks(ns, block_name_base, sorted(failed_blocks))
+    report_failed_validation(failed_validation)
+    report_failed_blocks([failed_blocks[number] for number in sorted(failed_blocks)])
+
+    return block_final_paths
+
+
 def place_config_template(path):
     """Uses the default configuration dictionary to create a default config file
     at the argued location. If used as part of tapestry this triggers when
@@ -894,7 +1443,16 @@ def place_config_template(path):
             "keysize": 2048,
             "use compression": True,
             "compression level": 2,
-            "Build-Time File Validation": True
+            "compression codec": "bz2",
+            "compression threads": 0,
+            "Build-Time File Validation": True,
+            "Inline Validation": False,
+            "Manifest Signing": False,
+            "Index Redundancy": 0,
+            "Binary Index": False,
+            "Stream Blocks": False,
+            "Binary Output": False,
+            "Hash Cache Path": ""
         },
         "Network Configuration": {
             "mode": "none",
@@ -903,6 +1461,8 @@ def place_config_template(path):
             "username": "ftptest",
             "remote drop location": "path on the ftp to which to drop files",
             "keep local copies": True,
+            "SFTP Sessions": 4,
+            "SFTP Retries": 3,
             "Auth Type": "key",
             "Credential Path": "~/.ssh/id_rsa",
             "Credential Has Passphrase": True
@@ -927,14 +1487,35 @@ def place_config_template(path):
         config.add_section(section)
         for option in options:
             value = options[option]
-            config.set(section, option, value)
+            config.set(section, option, str(value))  # ConfigParser only accepts strings.
 
     with open(path, "w") as file_config:
         config.write(file_config)
 
 
+def save_hash_cache(path, cache):
+    """Writes the hash cache back to disk. The file is replaced atomically so
+    that an interrupted run cannot leave a truncated cache behind.
+
+    :param path: path to the cache file, or None if caching is disabled.
+    :param cache: dictionary of cache_key:hexdigest pairs.
+    :return:
+    """
+    if not path:
+        return
+    path_temp = path + ".temp"
+    try:
+        with open(path_temp, "w") as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(path_temp, path)
+    except OSError:
+        print("Unable to save the hash cache to %s; the next run will rehash every file." % path)
+
+
 def sign_blocks(namespace, gpg_agent):
-    """Locates and signs tapestry blocks.
+    """Locates and signs tapestry blocks. In manifest signing mode, the blocks,
+    RIFFs and index sidecar of today's run are instead hashed and listed in a
+    manifest, and only the manifest is signed.
 
     :param namespace: A namespace object
     :param gpg_agent: the python-gnupg GPG agent
@@ -942,41 +1523,88 @@ def sign_blocks(namespace, gpg_agent):
     """
     ns = namespace
     out = ns.drop
-    jobs = mp.JoinableQueue()
+    if getattr(ns, "sign_manifest", False):  # Test namespaces may not define this.
+        run_name = ns.compid + "-" + str(datetime.date.today())
+        targets = [(file, os.path.join(ns.drop, file)) for file in os.listdir(ns.drop)
+                   if file.startswith(run_name) and file.endswith((".tap", ".riff", ".tapidx"))]
+        write_manifest(ns, run_name, hash_files(ns, targets), gpg_agent)
+        return
+    tasks = []
     for root, bar, files in os.walk(namespace.drop):
         debug_print(str(files)+"\n")
         for file in files:
             if file.endswith(".tap"):
                 target = os.path.join(root, file)
-                job = tapestry.TaskSign(target, ns.sigFP, out, gpg_agent)
-                jobs.put(job)
-    workers = []
-    sum_jobs = int(jobs.qsize())
-    debug_print(sum_jobs)
-    done = mp.JoinableQueue()
-    for i in range(os.cpu_count()):
-        workers.append(tapestry.ChildProcess(jobs, done, ns.workDir, ns.debug))
-    rounds_complete = 0
-    for w in workers:
-        w.start()
-    working = True
-    status_print(rounds_complete, sum_jobs, "Signing", "Working...")
-    while working:
-        message = done.get()
-        if message is None:
-            working = False
-        if not ns.debug:
-            message = "Working..."
-        rounds_complete += 1
-        if rounds_complete == sum_jobs:
-            done.put(None)  # Use none as a poison pill to kill the queue.
-        if rounds_complete <= sum_jobs:  # Patches the 200% bug.
-            status_print(rounds_complete, sum_jobs, "Signing", message)
-        done.task_done()
-    jobs.join()
-    for w in workers:
-        jobs.put(None)
-    jobs.join()
+                tasks.append(tapestry.TaskSign(target, ns.sigFP, out, gpg_agent))
+    debug_print(len(tasks))
+    run_tasks(ns, tasks, "Signing")
+
+
+def read_manifest(manifest):
+    """Reads a manifest written by write_manifest. Its signature is not
+    checked here.
+
+    :param manifest: the absolute path to the .tapsum file.
+    :return: a dictionary of filename: SHA256 hexdigest, which is empty if
+    the manifest does not exist.
+    """
+    digests = {}
+    if os.path.exists(manifest):
+        with open(manifest, "r") as f:
+            for line in f:
+                digest, sep, file = line.rstrip("\n").partition("  ")
+                if sep:
+                    digests.update({file: digest})
+
+    return digests
+
+
+def write_manifest(namespace, run_name, digests, gpg_agent):
+    """Writes and signs the manifest of a run, for manifest signing mode. The
+    manifest lists the SHA256 hash of each file the run placed in the output
+    path, in the format used by sha256sum, so a single signature covers them
+    all.
+
+    :param namespace: the tapestry namespace object.
+    :param run_name: the block name less its number; the manifest will be
+    run_name+".tapsum".
+    :param digests: a dictionary of filename: SHA256 hexdigest.
+    :param gpg_agent: a python-gnupg gpg_agent object to do the signing.
+    :return: a list of the absolute paths of the manifest and its signature.
+    """
+    ns = namespace
+    manifest = os.path.join(ns.drop, run_name + ".tapsum")
+    with open(manifest, "w") as f:
+        for file in sorted(digests):
+            f.write("%s  %s\n" % (digests[file], file))
+    signed = tapestry.TaskSign(manifest, ns.sigFP, ns.drop, gpg_agent)()
+    if not signed.startswith("Signing Success"):
+        print(signed)
+
+    return [manifest, manifest + ".sig"]
+
+
+def split_file(files_index, fid, whole_digest, segment_digests, segment_size, node):
+    """Records a file too large for one block as a series of block-sized
+    segments, each of which is packed as a file in its own right.
+
+    :param files_index: the ops list being built by build_ops_list, which
+    already holds the file's entry.
+    :param fid: the file's identifier.
+    :param whole_digest: the SHA256 hash of the whole file.
+    :param segment_digests: a list of the SHA256 hashes of each segment, in
+    order, as returned by TaskHashSegments.
+    :param segment_size: the size of every segment but the last, in bytes.
+    :param node: the node used to generate file identifiers.
+    """
+    entry = files_index[fid]
+    entry.update({"sha256": whole_digest, "segments": len(segment_digests)})
+    for number, digest in enumerate(segment_digests):
+        offset = number * segment_size
+        files_index.update({str(uuid.uuid1(node)): {
+            "fname": entry["fname"], "sha256": digest, "category": entry["category"], "fpath": entry["fpath"],
+            "fsize": min(segment_size, entry["fsize"] - offset), "segment": number, "seg_offset": offset
+        }})
 
 
 def start_gpg(ns):
@@ -991,6 +1619,78 @@ def start_gpg(ns):
     return gpg
 
 
+def stream_blocks(sizes, ops_list, namespace, gpg_agent):
+    """Builds every block of the run as a single streaming task, in which the
+    tarfile is piped through the compressor and into gpg. Unlike the pack,
+    compress and encrypt stages this replaces, the only files written are the
+    final .tap blocks, so the working directory never has to hold the backup.
+
+    :param sizes: a list object returned by build_recovery_index, made up of
+    strings indicating file identifier values sorted by the size of the file.
+    :param ops_list: The full ops list prepared by build_ops_list, which is
+    equivalent to the third portion of a recovery index file.
+    :param namespace: the entire namespace object.
+    :param gpg_agent: a python-gnupg gpg_agent object to do the encryption
+    :return: list of absolute paths to the finished .tap files.
+    """
+    ns = namespace
+    block_final_paths = []
+    block_name_base = ns.compid + "-" + str(datetime.date.today())
+    collection_blocks = blocksort.sort_blocks(sizes, ops_list, ns.block_size_raw, block_name_base)
+    if len(collection_blocks) == 0:  # Nothing was found to back up.
+        return block_final_paths
+    tasks = []
+    riffs = []
+    failed_validation = []
+    failed_blocks = {}  # Block number: why the block could not be built.
+    sum_files = 0
+    for block in collection_blocks:
+        sum_files += block.files
+    run_index = write_run_index(ns, ops_list, collection_blocks, sum_files)
+    for block in collection_blocks:
+        this_riff = block.meta(len(collection_blocks), ns.sum_size, sum_files,
+                               str(datetime.date.today()), None, ops_list, ns.drop,
+                               getattr(ns, "incremental_meta", None), run_index)
+        riffs.append(this_riff)
+        members = block_members(ns, block)
+        hashes = member_hashes(ops_list, members) if ns.do_validation else None  # No tarfile to check afterwards.
+        tasks.append(tapestry.TaskStreamBlock(block.name, members, this_riff, ns.activeFP,
+                                              ns.drop, gpg_agent, ns.compress, ns.compressLevel,
+                                              not ns.binary_output, ns.compressCodec, ns.compressThreads,
+                                              os.path.join(ns.workDir, block.name + ".loc"), hashes,
+                                              block_segments(block)))
+
+    def describe(message):
+        if not message.startswith("Encryption Success"):  # Failures are always worth reporting.
+            print("\n" + message)
+            return message
+        message, failures = split_pack_failures(message)
+        if failures:
+            failed_validation.append(failures)
+            print("\n" + failures)
+        if not ns.debug:
+            return "Working..."
+        return message
+
+    results = run_tasks(ns, tasks, "Building Blocks", describe)
+    for block, this_riff, result in zip(collection_blocks, riffs, results):
+        tap = os.path.join(ns.drop, block.name + ".tap")
+        if str(result).startswith("Encryption Success"):
+            block_final_paths.append(tap)
+            continue
+        failed_blocks.update({block.num_block: "%s: %s" % (block.name, str(result).strip())})
+        for path in [tap, os.path.join(ns.workDir, block.name + ".loc"), this_riff]:  # So they aren't signed or sent.
+            if os.path.exists(path):
+                os.remove(path)
+    emit_index_sidecar(ns, block_name_base, record_locations(ns, ops_list, collection_blocks,
+                                                             sorted(failed_blocks)), gpg_agent)
+    mark_failed_blocks(ns, block_name_base, sorted(failed_blocks))
+    report_failed_validation(failed_validation)
+    report_failed_blocks([failed_blocks[number] for number in sorted(failed_blocks)])
+
+    return block_final_paths
+
+
 def status_print(done, total, job, message):
     """Prints a basic status message. If not interrupted, prints it on one line"""
     length_bar = 15.0
@@ -1019,92 +1719,175 @@ def unpack_blocks(namespace):
     for foo, bar, files in os.walk(ns.workDir):
         for file in files:
             if file.endswith(".decrypted"):
-                found_decrypted.append(file)
+                found_decrypted.append(os.path.join(foo, file))
 
-    files_to_unpack = {}  # Now we need to iterate over each of those blocks for files
-    for block in found_decrypted:
-        with tarfile.open(block, "r:*") as tap:
-            members = tap.getnames()
-            for file in members:
-                # debug_print("UB: Trying to unblock %s" % str({file: block}))
-                files_to_unpack.update({file: block})
-
-    tasks = mp.JoinableQueue()  # Let's populate the queue
-    for file in files_to_unpack:
-        skip = False
+    restore_paths = getattr(ns, "restore_paths", None)  # Test namespaces may not define this.
+    if restore_paths:
+        selected = ns.rec_index.select(restore_paths)
+    else:
+        selected = None
+
+    destinations = {}  # FID: where the file belongs, for every packed file we want back.
+    copies = {}  # FID: the further places its contents belong, for files which were only packed once.
+    split_files = {}  # FID: (path, size, SHA256) for files packed as segments, which are reassembled in place.
+    for file in ns.rec_index.fids():
         category_label, sub_path = ns.rec_index.find(file)
         if category_label == b"404":
-            skip = True
-        elif category_label == "skip":
-            skip = True
+            continue
+        elif selected is not None and file not in selected:  # Not asked for in a partial restore.
+            continue
         try:
             category_dir = ns.category_paths[category_label]
         except KeyError:
             category_dir = os.path.join(ns.drop, str(category_label))
             # Because cat_label sometimes comes back as b"404", we need to smash it back to strings.
-        if not skip:
-            tap_absolute = os.path.join(ns.workDir, files_to_unpack[file])
-            tasks.put(tapestry.TaskTarUnpack(tap_absolute, file, category_dir, sub_path))
-    sum_jobs = tasks.qsize()
-
-    workers = []
-    done = mp.JoinableQueue()
-    for i in range(os.cpu_count()):
-        workers.append(tapestry.ChildProcess(tasks, done, ns.workDir, ns.debug))
-    rounds_complete = 0
-    status_print(rounds_complete, sum_jobs, "Unpacking", "Working...")
-    for w in workers:
-        w.start()
-    working = True
-    while working:
-        message = done.get()
-        if message is None:
-            working = False
+        path = os.path.join(category_dir, sub_path.strip('~/'))
+        if ns.rec_index.is_split(file):
+            entry = ns.rec_index.file_index[file]
+            split_files.update({file: (path, entry["fsize"], entry["sha256"])})
+            continue
+        offset = ns.rec_index.segment_offset(file)
+        if offset is not None:
+            path = (path, offset)  # Written into the reassembled file, rather than extracted as a file.
+        stored = ns.rec_index.stored_as(file)
+        if stored not in destinations:
+            destinations.update({stored: path})
         else:
-            if not ns.debug:
-                message = "Working..."
-            rounds_complete += 1
-            status_print(rounds_complete, sum_jobs, "Unpacking", message)
-            if rounds_complete >= sum_jobs:
-                done.put(None)  # Use none as a poison pill to kill the queue.
-            done.task_done()
-    tasks.join()
-    for w in workers:
-        tasks.put(None)
-    tasks.join()
+            copies.setdefault(stored, []).append(path)
+
+    earlier_runs = ns.rec_index.runs()
+    tasks = []  # One task per block, each of which reads its tarball once.
+    for block in found_decrypted:
+        run = os.path.basename(block).rsplit("-", 1)[0]
+        if run not in earlier_runs:  # One of the recovered run's own blocks.
+            run = None
+        contents = ns.rec_index.contents(block_number(block), run)
+        if contents is None:  # The index doesn't say what the block holds, so it will look for everything.
+            tasks.append(tapestry.TaskUnpackBlock(block, destinations, None, copies))
+        else:
+            block_destinations = {}
+            block_copies = {}
+            offsets = {}
+            for file, offset in contents.items():
+                if file in destinations:
+                    block_destinations.update({file: destinations[file]})
+                    if file in copies:
+                        block_copies.update({file: copies[file]})
+                    if offset is not None:
+                        offsets.update({file: offset})
+            if len(block_destinations) > 0:
+                tasks.append(tapestry.TaskUnpackBlock(block, block_destinations, offsets, block_copies))
+
+    for path, size, digest in split_files.values():  # Segments can then be written in any order, from any block.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+    def describe(message):
+        if "; failed: " in message:  # Failures are always worth reporting.
+            print("\n" + message)
+            return message
+        elif not ns.debug:
+            return "Working..."
+        return message
+
+    run_tasks(ns, tasks, "Unpacking", describe)
+
+    digests = hash_files(ns, [(fid, split[0]) for fid, split in split_files.items()])
+    for fid, (path, size, digest) in split_files.items():
+        if digests[fid] != digest:
+            print("%s was reassembled from its segments, but does not match its recorded hash." % path)
+
+
+def approve_signer(fingerprint, username, signed, testing=False):
+    """Puts a signing fingerprint to the user for approval, so that trust in
+    a signature doesn't rest on the local keyring alone.
+
+    :param fingerprint: the fingerprint of the signing key.
+    :param username: the user the key claims to belong to.
+    :param signed: a description of what the key signed, for the prompt.
+    :param testing: if True, the fingerprint is approved without asking.
+    :return: True if the fingerprint was approved, False otherwise.
+    """
+    print("This fingerprint requires approval: %s" % fingerprint)
+    print("The fingerprint claims to be for: %s" % username)
+    print("It has signed %s." % signed)
+    print("Compare to a known-good fingerprint for this user.")
+    if not testing:
+        resume = input("Approve this fingerprint? (y/n)")
+    else:
+        resume = "y"
+
+    return "y" in resume.lower()
 
 
 def verify_blocks(ns, gpg_agent, testing=False):
-    """Verifies blocks and returns a list of verified blocks as a result"""
+    """Verifies blocks and returns a list of verified blocks as a result.
+
+    Signatures are checked in parallel by TaskVerify. Blocks without a
+    signature of their own are checked against their run's manifest instead,
+    if it has one: the manifest's signature is verified, and the blocks are
+    hashed and compared with it. Once all of this is done, each distinct
+    signing fingerprint is put to the user for approval once, and the blocks
+    it signed are accepted or rejected together.
+    """
     gpg = gpg_agent
     debug_print("VB: We think that ns = %s" % ns)
     found_blocks = []
-    approved_fingerprints = []
-    valid_blocks = []
     for root, bar, files in os.walk(ns.workDir):
         for file in files:
             if file.endswith(".tap"):
                 found_blocks.append(os.path.join(root, file))
+    manifests = {}  # Manifest path: the blocks without a signature of their own, which it must cover.
+    tasks = []
     for block in found_blocks:
-        with open(block+".sig", "rb") as k:
-            result = gpg.verify_file(k, block)
-        if not result.valid:
-            print("Rejecting %s; invalid signature." % (os.path.split(block)[1]))
+        manifest = block.rsplit("-", 1)[0] + ".tapsum"
+        if not os.path.exists(block + ".sig") and os.path.exists(manifest + ".sig"):
+            manifests.setdefault(manifest, []).append(block)
         else:
-            fingerprint = result.fingerprint
-            if fingerprint in approved_fingerprints:
-                valid_blocks.append(block)
+            tasks.append(tapestry.TaskVerify(block, gpg))
+    tasks += [tapestry.TaskVerify(manifest, gpg) for manifest in manifests]
+    digests = hash_files(ns, [(block, block) for blocks in manifests.values() for block in blocks])
+
+    def describe(result):
+        if not isinstance(result, list):  # The task failed, and says why.
+            return str(result)
+        if not getattr(ns, "debug", False):  # Test namespaces may not define this.
+            return "Working..."
+        return "%s signed by %s, valid: %s" % (os.path.split(result[0])[1], result[2], result[1])
+
+    signers = {}  # Fingerprint: (username, [blocks it signed]), in the order the fingerprints were first seen.
+    for task, result in zip(tasks, run_tasks(ns, tasks, "Verifying", describe)):
+        blocks = manifests.get(task.block, [task.block])
+        if not isinstance(result, list):
+            for block in blocks:
+                print("Rejecting %s; its signature could not be checked: %s" % (os.path.split(block)[1], result))
+            continue
+        signed, valid, fingerprint, username = result
+        if not valid:
+            for block in blocks:
+                print("Rejecting %s; invalid signature." % (os.path.split(block)[1]))
+            continue
+        listed = read_manifest(signed) if signed in manifests else {}
+        for block in blocks:
+            if signed in manifests and block not in digests:
+                print("Rejecting %s; it could not be hashed." % (os.path.split(block)[1]))
+            elif signed in manifests and listed.get(os.path.basename(block)) != digests[block]:
+                print("Rejecting %s; it does not match its signed manifest." % (os.path.split(block)[1]))
             else:
-                print("This fingerprint requires approval: %s" % fingerprint)
-                print("The fingerprint claims to be for: %s" % result.username)
-                print("Compare to a known-good fingerprint for this user.")
-                if not testing:
-                    resume = input("Approve this fingerprint? (y/n)")
-                else:
-                    resume = "y"
-                if "y" in resume.lower():
-                    valid_blocks.append(block)
-                    approved_fingerprints.append(fingerprint)
+                signers.setdefault(fingerprint, (username, []))[1].append(block)
+
+    valid_blocks = []
+    approved = getattr(getattr(ns, "rec_index", None), "signer", None)  # Approved already, for the index sidecar.
+    for fingerprint, (username, blocks) in signers.items():
+        if fingerprint == approved:
+            print("%s of the blocks found were signed by %s, as approved for the index sidecar."
+                  % (len(blocks), fingerprint))
+            valid_blocks += blocks
+        elif approve_signer(fingerprint, username, "%s of the blocks found" % len(blocks), testing):
+            valid_blocks += blocks
+        else:
+            print("Rejecting the %s blocks signed by %s." % (len(blocks), fingerprint))
 
     debug_print("VB: We've verified the following blocks: %s" % valid_blocks)
     return valid_blocks
@@ -1130,6 +1913,153 @@ def verify_keys(ns, gpg):
     debug_print(ns.activeFP)
 
 
+def write_run_index(namespace, ops_list, collection_blocks, sum_files):
+    """Writes the run's full index once, as run_name+".riff" in the output
+    path, and builds the reference to it which every block's RIFF carries.
+    Only the first block, and every k-th block after it when "Index
+    Redundancy" is set to k, carries the full index as well; the rest carry
+    the entries of their own files alone.
+
+    :param namespace: the tapestry namespace object.
+    :param ops_list: the full ops list, as returned by build_ops_list.
+    :param collection_blocks: the list of tapestry.Block objects for the run.
+    :param sum_files: the number of files packed by the run.
+    :return: the run index reference, to be passed to Block.meta.
+    """
+    ns = namespace
+    run_name = collection_blocks[0].name.rsplit("-", 1)[0]
+    riff = collection_blocks[0].meta(len(collection_blocks), ns.sum_size, sum_files, str(datetime.date.today()),
+                                     None, ops_list, ns.workDir, getattr(ns, "incremental_meta", None))
+    run_riff = os.path.join(ns.drop, run_name + ".riff")
+    shutil.move(riff, run_riff)
+    with open(run_riff, "rb") as f:
+        digest = tapestry.hash_stream(f)
+    redundancy = getattr(ns, "index_redundancy", 0)  # Test namespaces may not define this.
+    full_blocks = [block.num_block for block in collection_blocks
+                   if block.num_block == 1 or (redundancy > 0 and (block.num_block - 1) % redundancy == 0)]
+
+    return {"name": os.path.basename(run_riff), "sha256": digest, "fullBlocks": full_blocks}
+
+
+def record_locations(namespace, ops_list, collection_blocks, failed_blocks=None):
+    """Gathers the offsets that the packing tasks recorded for each file into
+    the ops list, then writes a RIFF for the whole run, which is used for the
+    index sidecar. The RIFFs inside the blocks are written before packing
+    and so cannot hold the offsets.
+
+    :param namespace: the tapestry namespace object.
+    :param ops_list: the full ops list, as returned by build_ops_list.
+    :param collection_blocks: the list of tapestry.Block objects for the run.
+    :param failed_blocks: optionally, a sorted list of the numbers of blocks
+    which could not be built, which the RIFF records as "failedBlocks".
+    :return: the absolute path of the run's RIFF, in the working directory.
+    """
+    ns = namespace
+    extra_metadata = getattr(ns, "incremental_meta", None)
+    if failed_blocks:
+        extra_metadata = dict(extra_metadata or {}, failedBlocks=failed_blocks)
+    sum_files = 0
+    for block in collection_blocks:
+        sum_files += block.files
+        locations = os.path.join(ns.workDir, block.name + ".loc")
+        if os.path.exists(locations):  # A block which failed to pack won't have any.
+            with open(locations, "r") as f:
+                for fid, (header_offset, data_offset) in json.load(f).items():
+                    ops_list[fid].update({"offset": header_offset, "offset_data": data_offset})
+            os.remove(locations)
+
+    return collection_blocks[0].meta(len(collection_blocks), ns.sum_size, sum_files, str(datetime.date.today()),
+                                     None, ops_list, ns.workDir, extra_metadata)
+
+
+def mark_failed_blocks(namespace, run_name, failed_blocks):
+    """Records the blocks of the run which could not be built in a file of
+    their own, run_name+".failed" in the output path, so that an incremental
+    run based on it doesn't take the files they held to be backed up already.
+    The run's RIFF can't be marked instead, as every block records its hash.
+
+    :param namespace: the tapestry namespace object.
+    :param run_name: the block name less its number.
+    :param failed_blocks: a sorted list of the numbers of the failed blocks.
+    If it is empty, any such file left by an earlier attempt at the run is
+    removed.
+    :return:
+    """
+    marker = os.path.join(namespace.drop, run_name + ".failed")
+    if len(failed_blocks) > 0:
+        with open(marker, "w") as f:
+            json.dump(failed_blocks, f)
+    elif os.path.exists(marker):
+        os.remove(marker)
+
+
+def report_failed_blocks(failed_blocks):
+    """Lists the blocks which could not be built, if there were any.
+
+    :param failed_blocks: a list of strings, each naming a block and why it
+    failed.
+    """
+    if len(failed_blocks) > 0:
+        print("The following blocks could not be built, so the files in them have NOT been backed up:")
+        for line in failed_blocks:
+            print(line)
+        print("These blocks are recorded as failed. Please correct the cause and run the backup again.")
+
+
+def report_failed_validation(failed_validation):
+    """Lists the files which failed build-time validation, if there were any.
+
+    :param failed_validation: a list of strings, each naming a block and the
+    files in it which failed.
+    """
+    if len(failed_validation) > 0:
+        print("The following files did not validate:")
+        for line in failed_validation:
+            print(line)
+        print("Please review the above lines for any failed files, and capture that information for your records.")
+
+
+def run_tasks(namespace, tasks, job, describe=None):
+    """Runs a list of tasks on the run's worker pool, printing a status line
+    as each one finishes. If the namespace has no pool (such as when a stage
+    is called on its own during testing), a temporary one is used.
+
+    :param namespace: the tapestry namespace object, which may carry a
+    tapestry.WorkerPool as namespace.pool.
+    :param tasks: a list of callable task objects.
+    :param job: the name of the stage, for the status line.
+    :param describe: optional callable which turns a task's result into the
+    status message. By default results are shown only in debug mode.
+    :return: a list of the results, in the same order as tasks.
+    """
+    ns = namespace
+    if len(tasks) == 0:
+        return []
+    debug = getattr(ns, "debug", False)  # Test namespaces may not define these.
+    pool = getattr(ns, "pool", None)
+    temporary = pool is None
+    if temporary:
+        pool = tapestry.WorkerPool(getattr(ns, "workDir", os.getcwd()), min(os.cpu_count(), len(tasks)), debug)
+
+    def progress(done, total, result):
+        if describe is not None:
+            message = describe(result)
+        elif debug:
+            message = str(result)
+        else:
+            message = "Working..."
+        status_print(done, total, job, message)
+
+    status_print(0, len(tasks), job, "Working...")  # We need an initial status print
+    try:
+        results = pool.map(tasks, progress)
+    finally:
+        if temporary:
+            pool.close()
+
+    return results
+
+
 def runtime():
     global state
     state = Namespace()
@@ -1155,6 +2085,38 @@ def runtime():
     exit()
 
 
+def select_restore_blocks(rec_index, restore_paths):
+    """Works out which blocks a restore needs, so that only those are fetched
+    and decrypted. For an incremental run, these include the blocks of the
+    earlier runs holding the files it did not pack again.
+
+    :param rec_index: the tapestry.RecoveryIndex for the run being recovered.
+    :param restore_paths: a list of glob patterns, or None for a full restore.
+    :return: a set of (run, block number) tuples as from block_key, or None
+    if every block of the run being recovered is needed.
+    """
+    if restore_paths:
+        selected = rec_index.select(restore_paths)
+        if len(selected) == 0:
+            print("No files in this backup match %s; nothing will be restored." % ", ".join(restore_paths))
+            return set()
+    elif len(rec_index.runs()) > 0:
+        selected = rec_index.fids()
+    else:
+        return None
+    wanted = rec_index.blocks_holding(selected)
+    if wanted is None:  # Indexes from older versions don't say which block holds each file.
+        print("This backup's index does not record which block holds each file, so every block will be fetched.")
+        return None
+    if restore_paths:
+        files = [fid for fid in selected if rec_index.segment_offset(fid) is None]  # Not counting segments.
+        print("%s matching files were found in %s blocks." % (len(files), len(wanted)))
+    if len(rec_index.runs()) > 0:
+        print("This is an incremental backup; blocks from %s will also be needed." % ", ".join(rec_index.runs()))
+
+    return wanted
+
+
 def sftp_connect(namespace):  # TODO: Rework to make conformant with test expectations
     """Attempts to grab a pysftp.Connection() object for the relevant
     config information stored in tapestry.cfg. In the event of any failures the
@@ -1224,34 +2186,145 @@ def sftp_deposit_files(namespace):
     server while operating in that mode. This function also handles any errors
     that can be raised by the child functions and exits gracefully as needed.
 
+    Files are uploaded over namespace.sftp_sessions connections at once. Any
+    manifests in the output path supply the hashes the uploads are checked
+    against.
+
     :param namespace:
     :return:
     """
     ns = namespace  # For Brevity
-    allowed_files = ["tap", "sig", "riff"]  # We don't need to or want to send just anything.
+    allowed_files = ["tap", "tapidx", "tapsum", "sig", "riff"]  # We don't need to or want to send just anything.
 
-    conn, error = sftp_connect(ns)
+    digests = {}
+    for file in os.listdir(ns.drop):
+        if file.endswith(".tapsum"):
+            digests.update(read_manifest(os.path.join(ns.drop, file)))
+    uploads, uploaders = sftp_start_uploaders(ns, digests)
 
-    if error:
+    if uploads is None:
         print("Tapestry has encountered an error with the SFTP connection and is exiting.")
-        print("Your files will be retained locally.")
-        print("Error: %s" % error)
         clean_up(ns.workDir)
         exit(1)
 
     for cwd, dirs, files in os.walk(ns.drop):
         for file in files:
-            fname, suffix = file.split(".")
+            suffix = os.path.splitext(file)[1].lstrip(".")
             if suffix in allowed_files:
-                sending = os.path.join(cwd, file)
-                error = sftp_place(conn, sending, ns.dirNet)
-                if error:
-                    print(error)
-                    if not ns.retainLocal:
-                        print("Switching to local retention for this and future files.")
-                        ns.retainLocal = True
-                if not ns.retainLocal:
-                    os.remove(sending)
+                uploads.put([os.path.join(cwd, file)])
+    sftp_finish_uploaders(uploads, uploaders)
+
+
+def sftp_deposit_file(namespace, connection, sending, digest=None):
+    """Places one file on the sftp server and, unless local copies are being
+    retained, removes the local copy. A run's own RIFF is always kept, as the
+    next incremental run is built against it. If the transfer is interrupted, this
+    reconnects and resumes it from the end of the partial remote copy, up to
+    namespace.sftp_retries times. If it still fails, local retention is
+    switched on for this and all later files.
+
+    :param namespace:
+    :param connection: a connection object as returned by sftp_connect
+    :param sending: the absolute path of the file to upload.
+    :param digest: optionally, the SHA256 hash the file is recorded with in
+    the run's manifest, which the remote copy is checked against.
+    :return: the connection to use for later files, which is a new one if
+    the old one had to be replaced.
+    """
+    ns = namespace
+    attempts = getattr(ns, "sftp_retries", 0) + 1  # Test namespaces may not define this.
+    for attempt in range(attempts):
+        placed, error = sftp_place(connection, sending, ns.dirNet, digest, resume=attempt > 0)
+        if not error:
+            break
+        print("%s (attempt %s of %s)" % (error, attempt + 1, attempts))
+        if attempt + 1 < attempts:
+            try:
+                connection.close()
+            except Exception:  # The connection may already be gone, which is often why we are here.
+                pass
+            replacement, connect_error = sftp_connect(ns)
+            if connect_error:
+                print(connect_error)
+                break
+            connection = replacement
+    if error:
+        if not ns.retainLocal:
+            print("Switching to local retention for this and future files.")
+            ns.retainLocal = True
+    if not ns.retainLocal and not is_run_riff(sending):
+        os.remove(sending)
+
+    return connection
+
+
+def sftp_deposit_queue(namespace, connection, uploads, digests=None):
+    """Uploads files from a queue until it yields None. Each of the threads
+    started by sftp_start_uploaders runs this on a connection of its own,
+    taking each list of files from the queue as soon as it is put there.
+
+    :param namespace:
+    :param connection: a connection object as returned by sftp_connect
+    :param uploads: a queue.Queue of lists of absolute paths.
+    :param digests: an optional dictionary of filename: SHA256 hash, from the
+    run's manifest, which is read as files are taken from the queue.
+    :return:
+    """
+    while True:
+        files = uploads.get()
+        if files is None:
+            break
+        for sending in files:
+            digest = digests.get(os.path.basename(sending)) if digests else None
+            connection = sftp_deposit_file(namespace, connection, sending, digest)
+    connection.close()
+
+
+def sftp_finish_uploaders(uploads, uploaders):
+    """Waits for the threads started by sftp_start_uploaders to upload
+    everything put on their queue, and then closes their connections.
+
+    :param uploads: the queue.Queue returned by sftp_start_uploaders.
+    :param uploaders: the list of threads returned by sftp_start_uploaders.
+    :return:
+    """
+    for uploader in uploaders:
+        uploads.put(None)  # One each; every thread stops at the first it takes.
+    for uploader in uploaders:
+        uploader.join()
+
+
+def sftp_start_uploaders(namespace, digests=None):
+    """Opens namespace.sftp_sessions connections to the SFTP server and
+    starts a thread uploading on each, so that several files are in flight
+    at once. A single session seldom fills a fast link.
+
+    :param namespace:
+    :param digests: an optional dictionary of filename: SHA256 hash, as for
+    sftp_deposit_queue. It may still be filled in after the threads start.
+    :return: a tuple of the queue.Queue to put lists of files to upload on,
+    and the list of threads; or (None, []) if no connection could be made.
+    """
+    ns = namespace
+    sessions = max(getattr(ns, "sftp_sessions", 1), 1)  # Test namespaces may not define this.
+    uploads = queue.Queue()
+    uploaders = []
+    for session in range(sessions):
+        connection, error = sftp_connect(ns)
+        if error:
+            print("Tapestry has encountered an error with the SFTP connection.")
+            print("Error: %s" % error)
+            break
+        uploader = threading.Thread(target=sftp_deposit_queue, args=(ns, connection, uploads, digests))
+        uploader.start()
+        uploaders.append(uploader)
+    if len(uploaders) == 0:
+        print("Your files will be retained locally.")
+        return None, []
+    elif len(uploaders) < sessions:
+        print("Only %s of %s SFTP sessions could be opened; uploads will use those." % (len(uploaders), sessions))
+
+    return uploads, uploaders
 
 
 def sftp_fetch(connection, remote_path, tgt, work_path):
@@ -1291,24 +2364,59 @@ def sftp_find(sftp, storagedir):
     # Paramiko and pysftp return unicode strings; we want to bash to local.
     list_returned = []
     for each in list_remote_files:
-        if each.endswith(".tap") or each.endswith(".sig"):  # We are interested in only these extensions.
+        if each.endswith((".tap", ".tapidx", ".tapsum", ".sig")):  # We are interested in only these extensions.
             list_returned.append(str(each))
 
     return list_returned
 
 
-def sftp_place(connection, tgt, remote_path):
+def sftp_place(connection, tgt, remote_path, digest=None, resume=False):
+    """Uploads one file to the SFTP server and checks that it arrived whole.
+
+    :param connection: a connection object as returned by sftp_connect
+    :param tgt: the absolute path of the file to upload.
+    :param remote_path: the remote directory to place it in.
+    :param digest: optionally, the SHA256 hash of the file. If given, the
+    remote copy is read back and hashed, and removed if it does not match.
+    :param resume: if True, an earlier attempt at this upload was cut off,
+    and it is continued from the end of the partial remote copy.
+    :return: a tuple of tgt (or False, if it failed) and an error string, or
+    None if the file was placed.
+    """
     error = None
+    name = os.path.basename(tgt)
+    size = os.path.getsize(tgt)
     try:
         if str(connection.pwd) != remote_path:
             connection.chdir(remote_path)
-        connection.put(tgt)
-    except IOError as e:
-        error = "Couldn't place file at %s; no such directory on remote host" % remote_path
-        tgt = False
+        placed = 0
+        if resume and connection.exists(name):
+            placed = connection.stat(name).st_size
+        if placed > size:  # Not part of this file, so it is sent again from the start.
+            placed = 0
+        if placed < size or size == 0:
+            with open(tgt, "rb") as local, connection.open(name, "r+" if placed > 0 else "wb") as remote:
+                local.seek(placed)
+                remote.seek(placed)
+                remote.set_pipelined(True)
+                shutil.copyfileobj(local, remote, tapestry.hash_buffer_size)
+        if connection.stat(name).st_size != size:
+            error = "%s was not placed completely" % name
+            tgt = False
+        elif digest is not None:
+            with connection.open(name, "rb") as remote:
+                remote.prefetch()
+                matched = tapestry.hash_stream(remote) == digest
+            if not matched:
+                connection.remove(name)  # So that the next attempt starts afresh.
+                error = "%s does not match its manifest once placed" % name
+                tgt = False
     except PermissionError:
         error = "Permission Denied"
         tgt = False
+    except (IOError, EOFError, sshe.SSHException) as e:
+        error = "Couldn't place %s at %s: %s" % (name, remote_path, e)
+        tgt = False
 
     return tgt, error
 
@@ -1329,9 +2437,80 @@ def sftp_retrieve_files(namespace, gpg_agent):
     list_target_files = sftp_select_retrieval_target(list_all_files)  # Get the files the user actually wants
 
     list_found_files = []
+    rec_index = None
+    for file in list_target_files:  # The manifest and index sidecar, if there are any, come first.
+        if file.endswith((".tapsum", ".tapsum.sig", ".tapidx.sig")):
+            sftp_fetch(conn, ns.dirNet, file, ns.workDir)
+    for file in list_target_files:
+        if file.endswith(".tapidx") and sftp_fetch(conn, ns.dirNet, file, ns.workDir) is None:
+            rec_index = load_index_sidecar(os.path.join(ns.workDir, file), ns.workDir, gpg_agent)
+    list_target_files = [file for file in list_target_files if ".tapidx" not in file and ".tapsum" not in file]
+    run_name = [file for file in list_target_files if file.endswith(".tap")][0].rsplit("-", 1)[0]
+
+    # Now we need to obtain a recovery file of some kind, if the sidecar didn't provide one.
+    if rec_index is None:
+        first_block = min([file for file in list_target_files if file.endswith(".tap")],
+                          key=lambda file: block_number(file) or 0)
+        error = sftp_fetch(conn, ns.dirNet, first_block, ns.workDir)
+        if error is not None:
+            print(error)
+            clean_up(ns.workDir)
+            exit(1)
+        list_found_files.append(os.path.join(ns.workDir, first_block))
+        decrypted_first = tapestry.TaskDecrypt(list_found_files[0], ns.workDir, gpg_agent)
+        decrypted_first = decrypted_first()
+        debug_print("SRF: decrypted_first is: %s" % decrypted_first)
+        debug_print("SRF: The conditional is therefore: %s" % decrypted_first.split(" ")[1].lower())
+        if decrypted_first.split(" ")[1].lower() == "success":
+            tar = compression.open_tar(os.path.join(ns.workDir, decrypted_first.split(" ")[3].rstrip(".")))
+            # Hideous string management hack.
+            tapfile_contents = tar.getnames()
+            debug_print("The provided block contains: %s" % str(tapfile_contents))
+
+            if "recovery-pkl" in tapfile_contents:
+                index_file = tar.extractfile("recovery-pkl")
+            elif "recovery-riff" in tapfile_contents:
+                index_file = tar.extractfile("recovery-riff")
+            else:
+                index_file = open("/dev/null", "rb")  # Just for giggles
+                print("Something has gone wrong!")
+                print("One or more blocks are corrupt and missing their recovery index.")
+                print("This is a fatal error.")
+                clean_up(ns.workDir)
+                exit(1)
+        else:
+            print("Something has gone wrong in initial decryption.")
+            print("Verify you have the key for the blocks provided and try again.")
+            clean_up(ns.workDir)
+            exit(1)
+
+        # If we made it this far, we have a recovery file, so let's return a recovery index
+        rec_index = tapestry.RecoveryIndex(index_file)
+        tar.close()
+        warn_compact_index(rec_index, first_block)
+
+    wanted = select_restore_blocks(rec_index, getattr(ns, "restore_paths", None))
+    if wanted is None:
+        blocks_needed = rec_index.blocks
+    else:
+        blocks_needed = len(wanted)
+        for run in rec_index.runs():  # The earlier runs an incremental run's unchanged files are held by.
+            list_target_files += [file for file in list_all_files
+                                  if file.startswith(run + "-") and file.endswith((".tap", ".tap.sig"))]
+            for file in (run + ".tapsum", run + ".tapsum.sig"):
+                if file in list_all_files:
+                    sftp_fetch(conn, ns.dirNet, file, ns.workDir)
+        list_target_files = [file for file in list_target_files if block_key(file, run_name) in wanted]
+        for file in list_found_files:  # The first block was only needed for the index.
+            if block_key(file, run_name) not in wanted:
+                os.remove(file)
+                os.remove(file + ".decrypted")
+        list_found_files = [file for file in list_found_files if block_key(file, run_name) in wanted]
 
     is_error_notfound = False
     for file in list_target_files:  # physically retrieve those files.
+        if os.path.join(ns.workDir, file) in list_found_files:
+            continue
         error = sftp_fetch(conn, ns.dirNet, file, ns.workDir)
         if error is not None:
             is_error_notfound = True
@@ -1344,37 +2523,8 @@ def sftp_retrieve_files(namespace, gpg_agent):
         print("If you wish do not wish to continue with only a partial restore, press ctrl+c now.")
         foo = input("Press enter to continue.")
 
-    # Now we need to obtain a recovery file of some kind.
-    decrypted_first = tapestry.TaskDecrypt(os.path.join(ns.workDir, list_found_files[0]), ns.workDir, gpg_agent)
-    decrypted_first = decrypted_first()
-    debug_print("SRF: decrypted_first is: %s" % decrypted_first)
-    debug_print("SRF: The conditional is therefore: %s" % decrypted_first.split(" ")[1].lower())
-    if decrypted_first.split(" ")[1].lower() == "success":
-        tar = tarfile.open(os.path.join(ns.workDir, decrypted_first.split(" ")[3].rstrip(".")), "r:*")
-        # Hideous string management hack.
-        tapfile_contents = tar.getnames()
-        debug_print("The provided block contains: %s" % str(tapfile_contents))
-
-        if "recovery-pkl" in tapfile_contents:
-            index_file = tar.extractfile("recovery-pkl")
-        elif "recovery-riff" in tapfile_contents:
-            index_file = tar.extractfile("recovery-riff")
-        else:
-            index_file = open("/dev/null", "rb")  # Just for giggles
-            print("Something has gone wrong!")
-            print("One or more blocks are corrupt and missing their recovery index.")
-            print("This is a fatal error.")
-            clean_up(ns.workDir)
-            exit(1)
-    else:
-        print("Something has gone wrong in initial decryption.")
-        print("Verify you have the key for the blocks provided and try again.")
-        clean_up(ns.workDir)
-        exit(1)
-
-    # If we made it this far, we have a recovery file, so let's return a recovery index
-    rec_index = tapestry.RecoveryIndex(index_file)
-    if len(list_found_files) != rec_index.blocks:
+    list_found_blocks = [file for file in list_found_files if file.endswith(".tap")]
+    if len(list_found_blocks) != blocks_needed:
         print("There is a a mismatch in the number of recovered blocks and the amount of blocks listed in the"
               " recovery index. Would you like to continue?")
         input("Press enter to continue or ctrl+c to cancel.")
@@ -1392,11 +2542,8 @@ def sftp_select_retrieval_target(list_available):
     :param list_available:
     :return:
     """
-    list_working = list_available.copy()  # We need a clone because we are going to break it up.
-    # Then to kick out all the sigs (as duplicates)
-    for file in list_working:
-        if file.endswith(".sig"):
-            list_working.remove(file)
+    # Only the blocks themselves are counted; sigs are duplicates and the index sidecar is not a block.
+    list_working = [file for file in list_available if file.endswith(".tap")]
     # Then we need a list of available machines
     dict_availability = {}
     for file in list_working:
@@ -1439,44 +2586,25 @@ def sftp_select_retrieval_target(list_available):
 def prevalidate_blocks(namespace, list_blocks, index):
     if namespace.do_validation:
         ns = namespace
-        jobs = mp.JoinableQueue()
-        for file in list_blocks:
-            with tarfile.open(file, mode="r:*") as tf:
-                list_members = tf.getnames()
-                for member in list_members:
-                    if member != "recovery-riff":  #Obviously we can't validate this noise.
-                        task = tapestry.TaskCheckIntegrity(file, member, index[member]['sha256'])
-                        jobs.put(task)
-        workers = []
-        sum_jobs = int(jobs.qsize())
-        debug_print(sum_jobs)
-        done = mp.JoinableQueue()
-        for i in range(os.cpu_count()):
-            workers.append(tapestry.ChildProcess(jobs, done, ns.workDir, ns.debug))
-        rounds_complete = 0
-        for w in workers:
-            w.start()
-        working = True
-        status_print(rounds_complete, sum_jobs, "Checking Block Integrity", "Working...")
-        # We removed the "... Working" message issue because this task returns useful messages.
-        # This might get replaced when/if we include runtime logging again.
-        while working:
-            message = done.get()
-            if message is None:
-                working = False
-            else:
-                if message[0]:  # We only need to output the actual output if the job fails.
-                    message[1] = "Working"
-            rounds_complete += 1
-            if rounds_complete == sum_jobs:
-                done.put(None)  # Use none as a poison pill to kill the queue.
-            if rounds_complete <= sum_jobs:  # Patches the 200% bug.
-                status_print(rounds_complete, sum_jobs, "Checking Block Integrity", message[1])
-            done.task_done()
-        jobs.join()
-        for w in workers:  # Make extra certain all the children are dead.
-            jobs.put(None)
-        jobs.join()  # TODO replace lines below with better logic during the improved logging process.
+        tasks = []
+        for file in list_blocks:  # One task per block, which reads through the block once.
+            number = block_number(file)
+            known_hashes = {}
+            for fid, entry in index.items():
+                if entry.get("block", number) == number:  # Older indexes don't say which block holds a file.
+                    known_hashes.update({fid: entry["sha256"]})
+            tasks.append(tapestry.TaskCheckBlock(file, known_hashes))
+        debug_print(len(tasks))
+
+        def describe(message):
+            # We only need to output the actual output if the job fails.
+            if isinstance(message, list):
+                if message[0]:
+                    return "Working..."
+                return message[1]
+            return message
+
+        run_tasks(ns, tasks, "Checking Block Integrity", describe)
         print("Please review the above lines for any failed files, and capture that information for your records.")
         foo = input("Press Enter to Continue")  # Pausing for input here is not long-term acceptable; breaks automation
 
@@ -1512,7 +2640,7 @@ def demand_validate(ns, gpg):
         with open(path, "rb") as f:
             print("Decrypting the Block.")
             gpg.decrypt_file(f, always_trust=True, output=path_out)
-        with tarfile.open(path_out, "r:*") as tf:
+        with compression.open_tar(path_out) as tf:
             if "recovery-riff" in tf.getnames():
                 rec_file = tf.extractfile("recovery-riff")
                 rec_index = tapestry.RecoveryIndex(rec_file)
@@ -1522,7 +2650,7 @@ def demand_validate(ns, gpg):
                 print("The file may be damaged, or have been created by a Pre-2.0 version of Tapestry.")
                 do_validate = False
         if do_validate:  # We step out at this level to close the tarfile in advance.
-            prevalidate_blocks(ns, [path_out], rec_index)  # This allows multithreaded
+            prevalidate_blocks(ns, [path_out], rec_index.file_index)  # This allows multithreaded
 
         clean_up(ns.workDir)
 
@@ -78,7 +78,7 @@ def runtime(dict_config, do_network):
     # Populate this list with all tests to be run locally.
     list_local_tests = [test_block_invalid_put, test_verify_invalid_block,
                         test_recovery_index_invalid, test_decompress_uncompressed,
-                        test_TaskCheckIntegrity]
+                        test_TaskCheckBlock_single, test_TaskCheckBlock]
     # Populate this list with all the network tests (gated by do_network)
     list_network_tests = [test_sftp_connect_invalid, test_sftp_connect_down, test_sftp_find,
                           test_sftp_place, test_sftp_fetch]
@@ -219,11 +219,11 @@ def test_verify_invalid_block(config):
     return errors
 
 
-def test_TaskCheckIntegrity(config):
+def test_TaskCheckBlock_single(config):
     """This test creates a random string, inserting it into a file, then
     tarring that file into a tarball in the temporary directory. The path to
     the tarfile and the hash of the random string are then provided to an
-    instance of tapestry.TaskCheckIntegrity and the return value used to
+    instance of tapestry.TaskCheckBlock and the return value used to
     determine if the class is responding correctly.
 
     :param config: dict_config
@@ -243,14 +243,45 @@ def test_TaskCheckIntegrity(config):
     with tarfile.open(test_tar, "w:") as tf:
         tf.add(test_file, arcname="hash_test")
 
-    test_task = tapestry.TaskCheckIntegrity(test_tar, "hash_test", control_hash)
+    test_task = tapestry.TaskCheckBlock(test_tar, {"hash_test": control_hash})
     check_passed, foo = test_task()
     del foo
 
     if not check_passed:  # Since we passed in a known-bad hash, we can expect a failure.
         pass
     else:
-        errors.append("[ERROR] The test article failed to pass TaskCheckIntegrity's test.")
+        errors.append("[ERROR] TaskCheckBlock passed a file it should have failed.")
+
+    return errors
+
+
+def test_TaskCheckBlock(config):
+    """Tars two members into a tarball in the temporary directory, then hands
+    tapestry.TaskCheckBlock a nonsense hash for the first and no hash at all
+    for the second. Both should be reported, not just the first.
+
+    :param config: dict_config
+    :return:
+    """
+    errors = []
+    dir_temp = config["path_temp"]
+    test_file = os.path.join(dir_temp, "hash_test")
+    test_tar = os.path.join(dir_temp, "test_block_tar")
+    with open(test_file, "w") as f:
+        f.write(''.join(choice(printable) for i in range(2048)))
+    with tarfile.open(test_tar, "w:") as tf:
+        tf.add(test_file, arcname="member_1")
+        tf.add(test_file, arcname="member_2")
+    hasher = hashlib.sha256()
+    hasher.update("this is not right".encode('utf-8'))  # We just want a nonsense hash.
+
+    check_passed, message = tapestry.TaskCheckBlock(test_tar, {"member_1": hasher.hexdigest()})()
+
+    if check_passed:
+        errors.append("[ERROR] TaskCheckBlock passed a block it should have failed.")
+    for member in ["member_1", "member_2"]:
+        if member not in message:
+            errors.append("[ERROR] TaskCheckBlock did not report the problem with %s." % member)
 
     return errors
 
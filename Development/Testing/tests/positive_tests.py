@@ -18,6 +18,7 @@ https://github.com/ZAdamMac/Tapestry
 from . import framework
 import tapestry
 from datetime import date
+import filecmp
 import gnupg
 import hashlib
 import json
@@ -77,15 +78,22 @@ def runtime(dict_config, do_network):
     # The following two lists should be populated with the function variables
     # Populate this list with all tests to be run locally.
     list_local_tests = [test_block_valid_put, test_block_yield_full, test_block_meta,
-                        test_riff_find, test_riff_compliant, test_pkl_find,
-                        test_TaskCheckIntegrity_call, test_TaskCompress, test_TaskDecompress,
-                        test_TaskEncrypt, test_TaskDecrypt, test_TaskSign,
-                        test_TaskTarBuild, test_TaskTarUnpack, test_build_ops_list,
-                        test_build_recovery_index, test_media_retrieve_files,
+                        test_riff_find, test_riff_select, test_run_index, test_binary_index, test_iter_riff,
+                        test_file_table,
+                        test_diff_previous_run, test_dedupe_files, test_riff_compliant, test_pkl_find,
+                        test_TaskCheckBlock_single, test_TaskCheckBlock, test_TaskCompress, test_TaskDecompress, test_compression_codecs,
+                        test_TaskEncrypt, test_TaskDecrypt, test_TaskSign, test_TaskVerify, test_manifest, test_TaskEncrypt_binary,
+                        test_TaskPackBlock, test_TaskPackBlock_inline, test_TaskStreamBlock, test_index_sidecar, test_TaskHashFiles, test_WorkerPool,
+                        test_TaskUnpackBlock_single, test_TaskUnpackBlock_located, test_TaskUnpackBlock, test_TaskUnpackBlock_copies,
+                        test_TaskUnpackBlock_segments,
+                        test_build_ops_list,
+                        test_build_recovery_index, test_sort_blocks, test_pipeline_blocks, test_media_retrieve_files,
+                        test_pipeline_blocks_failed, test_link_block,
                         test_parse_config, test_verify_blocks
                         ]
     # Populate this list with all the network tests (gated by do_network)
-    list_network_tests = [test_sftp_connect, test_sftp_place, test_sftp_find, test_sftp_fetch]
+    list_network_tests = [test_sftp_connect, test_sftp_place, test_sftp_place_resume, test_sftp_find,
+                          test_sftp_fetch]
 
     if can_run:
         log = establish_logger(dict_config)
@@ -462,6 +470,478 @@ def test_build_recovery_index(config):
     return errors
 
 
+def test_sort_blocks(config):
+    """Sorts a known set of file sizes into blocks and confirms that every file
+    was placed exactly once, no block was overfilled, and the best-fit packing
+    used the expected (minimal) number of blocks.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    ops_list = {}
+    for size in [60, 50, 40, 30, 20]:
+        ops_list.update({"file%s" % size: {"fname": "b", "fpath": "b", "fsize": size,
+                                            "sha256": "aabb", "category": "a"}})
+    sizes, sum_sizes = tapestry.build_recovery_index(ops_list)
+    blocks = tapestry.sort_blocks(sizes, ops_list, 100, "test")
+
+    placed = []
+    for block in blocks:
+        placed.extend(block.file_index.keys())
+        if block.size > block.max_size:
+            errors.append("[ERROR] Block %s holds %s bytes, more than its maximum." % (block.name, block.size))
+    if sorted(placed) != sorted(ops_list.keys()):
+        errors.append("[ERROR] The blocks did not hold each file exactly once: %s" % placed)
+    if len(blocks) != 2:
+        errors.append("[ERROR] Expected 2 blocks, but the files were sorted into %s." % len(blocks))
+
+    return errors
+
+
+def test_pipeline_blocks(config):
+    """Builds a small run with pipeline_blocks and confirms that every block
+    comes out encrypted and signed, and that the intermediate tarballs were
+    removed from the working directory along the way.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    source = os.path.join(temp, "pipeline_src")
+    if not os.path.isdir(source):
+        os.mkdir(source)
+    for i in range(3):
+        with open(os.path.join(source, "file_%s" % i), "w") as f:
+            f.write("".join(choice(printable) for j in range(2000)))
+    namespace = tapestry.Namespace()
+    namespace.categories_default = ["a"]
+    namespace.categories_inclusive = []
+    namespace.inc = False
+    namespace.category_paths = {"a": source}
+    namespace.block_size_raw = 30000000
+    namespace.compid = "pipeline"
+    namespace.workDir = os.path.join(temp, "pipeline_work")
+    namespace.drop = os.path.join(temp, "pipeline_out")
+    namespace.hash_cache_path = os.path.join(temp, "pipeline_cache.json")
+    namespace.debug = False
+    namespace.compress = True
+    namespace.compressLevel = 1
+    namespace.compressCodec = "bz2"
+    namespace.compressThreads = 0
+    namespace.do_validation = True
+    namespace.binary_output = False
+    namespace.modeNetwork = "none"
+    namespace.activeFP = config["test_fp"]
+    namespace.sigFP = config["test_fp"]
+    if not os.path.isdir(namespace.drop):
+        os.mkdir(namespace.drop)
+
+    ops_list = tapestry.build_ops_list(namespace)
+    sizes, namespace.sum_size = tapestry.build_recovery_index(ops_list)
+    with tapestry.WorkerPool(namespace.workDir, 2) as namespace.pool:
+        taps = tapestry.pipeline_blocks(sizes, ops_list, namespace, gnupg.GPG())
+
+    if len(taps) == 0:
+        errors.append("[ERROR] pipeline_blocks did not report any finished blocks.")
+    for tap in taps:
+        if not os.path.isfile(tap):
+            errors.append("[ERROR] Block %s was reported but not found." % tap)
+        if not os.path.isfile(tap + ".sig"):
+            errors.append("[ERROR] Block %s was not signed." % tap)
+    leftovers = [f for f in os.listdir(namespace.workDir) if ".tar" in f]
+    if len(leftovers) > 0:
+        errors.append("[ERROR] Intermediate files were left in the working directory: %s" % leftovers)
+
+    return errors
+
+
+def test_pipeline_blocks_failed(config):
+    """Builds a small run with pipeline_blocks, encrypting to a key which
+    doesn't exist, so that every block fails. No block should be reported,
+    nothing the stages made should be left behind, and the run's RIFF should
+    mark every block as failed, so that no incremental run is based on it.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    source = os.path.join(temp, "failed_src")
+    if not os.path.isdir(source):
+        os.mkdir(source)
+    for i in range(3):
+        with open(os.path.join(source, "file_%s" % i), "w") as f:
+            f.write("".join(choice(printable) for j in range(2000)))
+    namespace = tapestry.Namespace()
+    namespace.categories_default = ["a"]
+    namespace.categories_inclusive = []
+    namespace.inc = False
+    namespace.category_paths = {"a": source}
+    namespace.block_size_raw = 30000000
+    namespace.compid = "failed"
+    namespace.workDir = os.path.join(temp, "failed_work")
+    namespace.drop = os.path.join(temp, "failed_out")
+    namespace.debug = False
+    namespace.compress = True
+    namespace.compressLevel = 1
+    namespace.compressCodec = "bz2"
+    namespace.compressThreads = 0
+    namespace.do_validation = False
+    namespace.binary_output = False
+    namespace.modeNetwork = "none"
+    namespace.activeFP = "0" * 40  # No such key, so encryption fails.
+    namespace.sigFP = config["test_fp"]
+    if not os.path.isdir(namespace.drop):
+        os.mkdir(namespace.drop)
+
+    ops_list = tapestry.build_ops_list(namespace)
+    sizes, namespace.sum_size = tapestry.build_recovery_index(ops_list)
+    with tapestry.WorkerPool(namespace.workDir, 2) as namespace.pool:
+        taps = tapestry.pipeline_blocks(sizes, ops_list, namespace, gnupg.GPG())
+
+    if len(taps) > 0:
+        errors.append("[ERROR] pipeline_blocks reported blocks which could not have been encrypted: %s" % taps)
+    leftovers = [f for f in os.listdir(namespace.workDir) if ".tar" in f or f.endswith(".loc")]
+    leftovers += [f for f in os.listdir(namespace.drop) if ".tap" in f or (f.endswith(".riff")
+                                                                           and not tapestry.is_run_riff(f))]
+    if len(leftovers) > 0:
+        errors.append("[ERROR] The failed blocks left files behind: %s" % leftovers)
+    with open(os.path.join(namespace.drop, "failed-%s.riff" % date.today()), "rb") as f:
+        run_index = tapestry.RecoveryIndex(f)
+    marker = os.path.join(namespace.drop, "failed-%s.failed" % date.today())
+    if not os.path.exists(marker):
+        errors.append("[ERROR] The run's failed blocks were not recorded.")
+    else:
+        with open(marker, "r") as f:
+            if json.load(f) != list(range(1, run_index.blocks + 1)):
+                errors.append("[ERROR] The run's failed blocks file does not list every block.")
+    shutil.rmtree(namespace.drop)
+
+    return errors
+
+
+def test_riff_select(config):
+    """Sorts a small set of files into blocks, writes a RIFF for them and
+    confirms that RecoveryIndex.select matches the expected files by glob and
+    reports the block that holds each one.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    ops_list = {}
+    for size, path in [(60, "docs/a.txt"), (50, "docs/b.txt"), (40, "pics/c.png"), (30, "docs/old/d.txt")]:
+        ops_list.update({"file%s" % size: {"fname": os.path.basename(path), "fpath": path, "fsize": size,
+                                            "sha256": "aabb", "category": "home"}})
+    sizes, sum_sizes = tapestry.build_recovery_index(ops_list)
+    blocks = tapestry.sort_blocks(sizes, ops_list, 100, "test")
+    riff = blocks[0].meta(len(blocks), sum_sizes, len(ops_list), "today", None, ops_list, config["path_temp"])
+    with open(riff, "rb") as f:
+        index = tapestry.RecoveryIndex(f)
+
+    expected = {}
+    for block in blocks:
+        for fid in block.file_index:
+            if ops_list[fid]["fpath"].startswith("docs/"):
+                expected.update({fid: block.num_block})
+    for patterns in [["docs/*"], ["home/docs/*"], ["docs/*.txt", "nothing/*"]]:
+        selected = index.select(patterns)
+        if selected != expected:
+            errors.append("[ERROR] select(%s) returned %s, expected %s." % (patterns, selected, expected))
+    if index.select(["*.jpg"]) != {}:
+        errors.append("[ERROR] select matched files when none should have matched.")
+
+    return errors
+
+
+def test_run_index(config):
+    """Writes the index of a run once with write_run_index, then the RIFF of
+    each of its blocks. With an index redundancy of 2, every other block
+    should carry the whole index and the rest only their own files, each with
+    a reference to the run's RIFF which matches its hash. The run's RIFF
+    should then be the one load_previous_index reads.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    drop = os.path.join(config["path_temp"], "run_index")
+    os.makedirs(drop, exist_ok=True)
+    ops_list = {}
+    for number in range(5):
+        ops_list.update({"file%s" % number: {"fname": "%s.txt" % number, "fpath": "%s.txt" % number, "fsize": 60,
+                                             "sha256": "aabb", "category": "home"}})
+    sizes, sum_sizes = tapestry.build_recovery_index(ops_list)
+    blocks = tapestry.sort_blocks(sizes, ops_list, 100, "test-2020-01-01")
+    ns = tapestry.Namespace()
+    ns.drop = drop
+    ns.workDir = config["path_temp"]
+    ns.sum_size = sum_sizes
+    ns.index_redundancy = 2
+    ns.compid = "test"
+    run_index = tapestry.write_run_index(ns, ops_list, blocks, len(ops_list))
+
+    with open(os.path.join(drop, "test-2020-01-01.riff"), "rb") as f:
+        if tapestry.hash_stream(f) != run_index["sha256"]:
+            errors.append("[ERROR] The run index reference does not match the hash of the run's RIFF.")
+    if run_index["fullBlocks"] != [1, 3, 5]:
+        errors.append("[ERROR] The blocks carrying the whole index were %s, expected 1, 3 and 5."
+                      % run_index["fullBlocks"])
+    for block in blocks:
+        riff = block.meta(len(blocks), sum_sizes, len(ops_list), "2020-01-01", None, ops_list, drop, None, run_index)
+        with open(riff, "rb") as f:
+            index = tapestry.RecoveryIndex(f)
+        full = block.num_block in run_index["fullBlocks"]
+        expected = sorted(ops_list) if full else sorted(block.file_index)
+        if sorted(index.file_index) != expected or index.compact == full:
+            errors.append("[ERROR] Block %s carries %s, expected %s." % (block.num_block, sorted(index.file_index),
+                                                                          expected))
+        if index.run_metadata.get("runIndex") != run_index:
+            errors.append("[ERROR] Block %s does not refer to the run's RIFF." % block.num_block)
+
+    if not tapestry.is_run_riff(run_index["name"]) or any(tapestry.is_run_riff(block.name + ".riff")
+                                                            for block in blocks):
+        errors.append("[ERROR] is_run_riff did not tell the run's RIFF from those of its blocks.")
+    previous_run, previous_index = tapestry.load_previous_index(ns)
+    if previous_run != "test-2020-01-01" or previous_index is None or previous_index.compact:
+        errors.append("[ERROR] load_previous_index did not read the whole index of the run.")
+    shutil.rmtree(drop)
+
+    return errors
+
+
+def test_binary_index(config):
+    """Writes a RIFF whose entries use every kind of key an index can hold,
+    converts it with write_binary_index, and loads both into RecoveryIndex.
+    The binary index should hold exactly the same entries and answer every
+    lookup the same way as the RIFF.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    ops_list = {}
+    for number in range(6):
+        ops_list.update({"file%s" % number: {"fname": "%s.txt" % number, "fpath": "docs/%s.txt" % number,
+                                             "fsize": 40, "sha256": hashlib.sha256(b"%d" % number).hexdigest(),
+                                             "category": "home"}})
+    ops_list["file1"].update({"ref": "file0"})
+    ops_list["file2"].update({"sha256": "NaN"})  # Not a digest, so it can't use the fixed-width column.
+    ops_list["file3"].update({"segments": 2})
+    ops_list["file4"].update({"segment": 1, "seg_offset": 40})
+    sizes, sum_sizes = tapestry.build_recovery_index({fid: ops_list[fid] for fid in ops_list if fid != "file1"})
+    blocks = tapestry.sort_blocks(sizes, ops_list, 100, "test")
+    ops_list["file5"].update({"run": "test-2020-01-01", "offset": 512, "offset_data": 1024})
+    riff = blocks[0].meta(len(blocks), sum_sizes, len(ops_list), "today", None, ops_list, config["path_temp"])
+    with open(riff, "r") as f:
+        metadata, entries = tapestry.iter_riff(f)
+        trix = tapestry.write_binary_index(metadata, entries, riff + ".trix")
+    with open(riff, "rb") as f:
+        json_index = tapestry.RecoveryIndex(f)
+    with open(trix, "rb") as f:
+        binary_index = tapestry.RecoveryIndex(f)
+
+    if binary_index.mode != "trix":
+        errors.append("[ERROR] The binary index was read as %s." % binary_index.mode)
+    if dict(binary_index.file_index.items()) != json_index.file_index:
+        errors.append("[ERROR] The entries of the binary index differ from those of the RIFF.")
+    if binary_index.run_metadata != json_index.run_metadata or binary_index.blocks != json_index.blocks:
+        errors.append("[ERROR] The run metadata of the binary index differs from that of the RIFF.")
+    for fid in list(ops_list) + ["missing"]:
+        for method in ["find", "stored_as", "is_split", "segment_offset", "locate", "run_of"]:
+            if getattr(binary_index, method)(fid) != getattr(json_index, method)(fid):
+                errors.append("[ERROR] %s(%s) differs between the binary index and the RIFF." % (method, fid))
+    for block in blocks:
+        if binary_index.contents(block.num_block) != json_index.contents(block.num_block):
+            errors.append("[ERROR] The binary index lists different contents for block %s." % block.num_block)
+    if binary_index.runs() != json_index.runs() or binary_index.select(["docs/*"]) != json_index.select(["docs/*"]):
+        errors.append("[ERROR] The binary index lists different runs or selects different files.")
+    os.remove(trix)
+
+    return errors
+
+
+def test_iter_riff(config):
+    """Writes a RIFF of more entries than iter_riff parses at once with
+    RiffWriter, then reads it back with iter_riff, which should return the
+    same entries in order. The canonical RIFF, written as a single line by
+    older versions, should still be read, and a RIFF cut off part way
+    should be refused by RecoveryIndex.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    path = os.path.join(config["path_temp"], "iter.riff")
+    ops_list = {}
+    for number in range(tapestry.riff_batch_lines + 10):
+        ops_list.update({"file%s" % number: {"fname": "%s.txt" % number, "fpath": "docs/%s.txt" % number,
+                                             "fsize": number, "sha256": "aabb", "category": "home"}})
+    with tapestry.RiffWriter(path, {"numBlock": 1}, {"sumBlock": 1}) as riff:
+        for fid, entry in ops_list.items():
+            riff.add(fid, entry)
+
+    with open(path, "r") as f:
+        if json.load(f)["index"] != ops_list:
+            errors.append("[ERROR] The RIFF written by RiffWriter is not the expected JSON.")
+    with open(path, "rb") as f:
+        metadata, entries = tapestry.iter_riff(f)
+        if metadata != {"metaBlock": {"numBlock": 1}, "metaRun": {"sumBlock": 1}}:
+            errors.append("[ERROR] iter_riff returned %s as the metadata." % metadata)
+        if list(entries) != list(ops_list.items()):
+            errors.append("[ERROR] iter_riff did not return the entries which were written, in order.")
+    canonical = os.path.join(config["path_config"], os.path.join("test articles", "testblock.riff"))
+    with open(canonical, "r") as f:
+        metadata, entries = tapestry.iter_riff(f)
+        if [fid for fid, entry in entries] != ["testfile"]:
+            errors.append("[ERROR] iter_riff could not read the canonical single-line RIFF.")
+
+    with open(path, "rb") as f:
+        truncated = f.read(os.path.getsize(path) // 2)
+    with open(path, "wb") as f:
+        f.write(truncated[:truncated.rindex(b"\n") + 1])  # Cut off between entries, which still looks plausible.
+    with open(path, "rb") as f:
+        try:
+            tapestry.RecoveryIndex(f)
+            errors.append("[ERROR] RecoveryIndex accepted a RIFF which was cut off part way.")
+        except tapestry.RecoveryIndexError:
+            pass
+    os.remove(path)
+
+    return errors
+
+
+def test_file_table(config):
+    """Fills a FileTable with entries using every kind of key the ops list
+    can hold, including values which fit none of its columns, and has
+    dedupe_files work on it and on the same entries as dictionaries. The
+    table should hold the same entries as the dictionaries throughout, and
+    a RIFF written from it should be the one written from them.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    ops_list = {}
+    for number in range(6):
+        ops_list.update({"file%s" % number: {"fname": "%s.txt" % number, "fpath": "docs/%s.txt" % (number % 3),
+                                             "fsize": 40, "sha256": hashlib.sha256(b"%d" % (number % 3)).hexdigest(),
+                                             "category": "home"}})
+    ops_list["file0"].update({"sha256": None})  # As it is until the file has been hashed.
+    ops_list["file1"].update({"sha256": "NaN", "fsize": -1})  # Neither fits its column.
+    ops_list["file2"].update({"fpath": "elsewhere", "segment": 1, "seg_offset": 40})
+    table = tapestry.FileTable(ops_list)
+    if dict((fid, dict(entry)) for fid, entry in table.items()) != ops_list:
+        errors.append("[ERROR] The FileTable does not hold the entries it was given.")
+
+    to_pack = tapestry.dedupe_files(ops_list, ops_list)
+    table_to_pack = tapestry.dedupe_files(table, table)
+    if sorted(table_to_pack) != sorted(to_pack) or table != ops_list:
+        errors.append("[ERROR] dedupe_files did not treat the FileTable as it did the dictionaries.")
+    table.update({"renamed": table.pop("file3")})  # As an incremental run renames carried files.
+    ops_list.update({"renamed": ops_list.pop("file3")})
+    if table != ops_list or "file3" in table or table_to_pack.get("file3", {}) != table["renamed"]:
+        errors.append("[ERROR] The FileTable entry was not renamed as a dictionary would be.")
+
+    riffs = []
+    for index in [ops_list, table]:
+        sizes, sum_sizes = tapestry.build_recovery_index(index)
+        blocks = tapestry.sort_blocks(sizes, index, 100, "test")
+        riff = blocks[0].meta(len(blocks), sum_sizes, len(index), "today", None, index, config["path_temp"])
+        with open(riff, "r") as f:
+            riffs.append(json.load(f))
+        os.remove(riff)
+    if riffs[0] != riffs[1]:
+        errors.append("[ERROR] The RIFF written from the FileTable differs from that written from dictionaries.")
+
+    return errors
+
+
+def test_diff_previous_run(config):
+    """Writes the RIFF of an earlier run, then compares a new set of files
+    against it as an incremental run would. Only new and changed files should
+    be left to pack, the deleted file should be reported, and the unchanged
+    file should be pointed at the earlier run's block, where a RIFF of the new
+    run should then say to find it.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    earlier_ops = {}
+    for fid, path, digest in [("old_a", "a.txt", "aaaa"), ("old_b", "b.txt", "bbbb"), ("old_c", "c.txt", "cccc")]:
+        earlier_ops.update({fid: {"fname": path, "fpath": path, "fsize": 10, "sha256": digest, "category": "home"}})
+    sizes, sum_sizes = tapestry.build_recovery_index(earlier_ops)
+    blocks = tapestry.sort_blocks(sizes, earlier_ops, 100, "test-2020-01-01")
+    riff = blocks[0].meta(len(blocks), sum_sizes, len(earlier_ops), "2020-01-01", None, earlier_ops,
+                          config["path_temp"])
+    with open(riff, "rb") as f:
+        earlier_index = tapestry.RecoveryIndex(f)
+
+    ops_list = {}
+    for fid, path, digest in [("new_a", "a.txt", "aaaa"), ("new_b", "b.txt", "b2b2"), ("new_d", "d.txt", "dddd")]:
+        ops_list.update({fid: {"fname": path, "fpath": path, "fsize": 10, "sha256": digest, "category": "home"}})
+    to_pack, deleted = tapestry.diff_previous_run(ops_list, "test-2020-01-01", earlier_index)
+
+    if sorted(to_pack) != ["new_b", "new_d"]:
+        errors.append("[ERROR] The files left to pack were %s, expected new_b and new_d." % sorted(to_pack))
+    if deleted != ["home/c.txt"]:
+        errors.append("[ERROR] The deleted files were reported as %s, expected home/c.txt." % deleted)
+    if "old_a" not in ops_list or ops_list["old_a"].get("run") != "test-2020-01-01":
+        errors.append("[ERROR] The unchanged file was not pointed at the earlier run.")
+    else:
+        sizes, sum_sizes = tapestry.build_recovery_index(to_pack)
+        blocks = tapestry.sort_blocks(sizes, ops_list, 100, "test-2020-01-02")
+        riff = blocks[0].meta(len(blocks), sum_sizes, len(to_pack), "2020-01-02", None, ops_list,
+                              config["path_temp"], {"basedOn": "test-2020-01-01", "deleted": deleted})
+        with open(riff, "rb") as f:
+            index = tapestry.RecoveryIndex(f)
+        earlier_block = earlier_ops["old_a"]["block"]
+        if index.runs() != ["test-2020-01-01"]:
+            errors.append("[ERROR] The new index lists %s as earlier runs." % index.runs())
+        if index.blocks_holding(["old_a"]) != {("test-2020-01-01", earlier_block)}:
+            errors.append("[ERROR] The new index does not place the unchanged file in the earlier run's block.")
+        if "old_a" not in index.contents(earlier_block, "test-2020-01-01"):
+            errors.append("[ERROR] The earlier run's block is not listed as holding the unchanged file.")
+
+    return errors
+
+
+def test_dedupe_files(config):
+    """Builds an ops list holding two identical files and one other, and has
+    dedupe_files arrange for the identical contents to be packed once. The
+    second copy should refer to the first, and a RIFF written from the ops
+    list should then say to find both in the first copy's block.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    ops_list = {}
+    for fid, path, digest in [("file_a", "a.txt", "aaaa"), ("file_b", "copy/a.txt", "aaaa"),
+                              ("file_c", "c.txt", "cccc")]:
+        ops_list.update({fid: {"fname": os.path.basename(path), "fpath": path, "fsize": 10, "sha256": digest,
+                               "category": "home"}})
+    to_pack = tapestry.dedupe_files(ops_list, ops_list)
+
+    if sorted(to_pack) != ["file_a", "file_c"]:
+        errors.append("[ERROR] The files left to pack were %s, expected file_a and file_c." % sorted(to_pack))
+    if ops_list["file_b"].get("ref") != "file_a":
+        errors.append("[ERROR] The duplicate file does not refer to the first copy.")
+    else:
+        sizes, sum_sizes = tapestry.build_recovery_index(to_pack)
+        blocks = tapestry.sort_blocks(sizes, ops_list, 100, "test")
+        riff = blocks[0].meta(len(blocks), sum_sizes, len(to_pack), "today", None, ops_list, config["path_temp"])
+        with open(riff, "rb") as f:
+            index = tapestry.RecoveryIndex(f)
+        if index.stored_as("file_b") != "file_a" or index.locate("file_b") != index.locate("file_a"):
+            errors.append("[ERROR] The index does not place the duplicate file with the first copy.")
+
+    return errors
+
+
 def test_riff_find(config):
     """Takes a test riff object and verifies that it can find an expected file.
     This is run against a loaded canonical riff to avoid a dependancy on
@@ -496,11 +976,11 @@ def test_riff_find(config):
     return errors
 
 
-def test_TaskCheckIntegrity_call(config):
+def test_TaskCheckBlock_single(config):
     """This test creates a random string, inserting it into a file, then
     tarring that file into a tarball in the temporary directory. The path to
     the tarfile and the hash of the random string are then provided to an
-    instance of tapestry.TaskCheckIntegrity and the return value used to
+    instance of tapestry.TaskCheckBlock and the return value used to
     determine if the class is responding correctly.
 
     :param config: dict_config
@@ -520,14 +1000,40 @@ def test_TaskCheckIntegrity_call(config):
     with tarfile.open(test_tar, "w:") as tf:
         tf.add(test_file, arcname="hash_test")
 
-    test_task = tapestry.TaskCheckIntegrity(test_tar, "hash_test", control_hash)
+    test_task = tapestry.TaskCheckBlock(test_tar, {"hash_test": control_hash})
     check_passed, foo = test_task()
     del foo
 
     if check_passed:
         pass
     else:
-        errors.append("[ERROR] The test article failed to pass TaskCheckIntegrity's test.")
+        errors.append("[ERROR] The test article failed to pass TaskCheckBlock's test.")
+
+    return errors
+
+
+def test_TaskCheckBlock(config):
+    """Tars two copies of the file created by test_TaskCheckBlock_single and
+    hands the tarball and the known hashes of both members to an instance of
+    tapestry.TaskCheckBlock, which should find every member valid.
+
+    :param config: dict_config
+    :return:
+    """
+    errors = []
+    dir_temp = config["path_temp"]
+    test_file = os.path.join(dir_temp, "hash_test")
+    test_tar = os.path.join(dir_temp, "test_block_tar")
+    with open(test_file, "rb") as f:
+        control_hash = hashlib.sha256(f.read()).hexdigest()
+    with tarfile.open(test_tar, "w:") as tf:
+        tf.add(test_file, arcname="member_1")
+        tf.add(test_file, arcname="member_2")
+
+    check_passed, message = tapestry.TaskCheckBlock(test_tar, {"member_1": control_hash,
+                                                               "member_2": control_hash})()
+    if not check_passed:
+        errors.append("[ERROR] The test article failed to pass TaskCheckBlock's test: %s" % message)
 
     return errors
 
@@ -585,6 +1091,39 @@ def test_TaskDecompress(config):
     return errors
 
 
+def test_compression_codecs(config):
+    """Round-trips the test tarball through every compression codec available
+    on this system, checking that TaskDecompress detects each codec from its
+    magic bytes and restores the original file.
+
+    :param config: dict_config
+    :return:
+    """
+    errors = []
+    control = os.path.join(config["path_temp"], "test_tar")
+    with open(control, "rb") as c:
+        hash_control = hashlib.sha256(c.read()).hexdigest()
+
+    for codec in tapestry.compression.known_codecs:
+        if not tapestry.compression.codec_available(codec):
+            continue  # Optional codecs are only tested where their package is installed.
+        target = control + "_" + codec
+        shutil.copy(control, target)
+        tapestry.TaskCompress(target, 1, codec)()
+        compressed = target + tapestry.compression.codec_extension(codec)
+        with open(compressed, "rb") as f:
+            detected = tapestry.compression.detect_codec(f.read(6))
+        if detected != codec:
+            errors.append("[FAIL] A %s file was detected as %s." % (codec, detected))
+            continue
+        result = tapestry.TaskDecompress(compressed)()
+        with open(compressed, "rb") as t:
+            if hashlib.sha256(t.read()).hexdigest() != hash_control:
+                errors.append("[FAIL] The %s round trip changed the file: %s" % (codec, result))
+
+    return errors
+
+
 def test_TaskDecrypt(config):
     """Decrypts a test file as previously generated, then validates it matches
     the original file.
@@ -672,48 +1211,293 @@ def test_TaskSign(config):
     return errors
 
 
-def test_TaskTarBuild(config):
-    """Simplified test of the TaskTarBuild class's call.
+def test_TaskVerify(config):
+    """Checks the signature made by test_TaskSign with TaskVerify, which should
+    find it valid and report the fingerprint of the test key.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    tgt = os.path.join(temp, "hash_test.tar")
+
+    block, valid, fingerprint, username = tapestry.TaskVerify(tgt, gnupg.GPG())()
+
+    if not valid:
+        errors.append("[ERROR] TaskVerify did not accept the signature made by TaskSign.")
+    elif fingerprint != config["test_fp"]:
+        errors.append("[ERROR] TaskVerify reported an unexpected fingerprint: %s" % fingerprint)
+
+    return errors
+
+
+def test_manifest(config):
+    """Writes and signs a manifest for the test tarball with write_manifest,
+    then checks that read_manifest gives back the same hash and that the
+    manifest's signature verifies with TaskVerify.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    tgt = os.path.join(temp, "hash_test.tar")
+    ns = tapestry.Namespace()
+    ns.drop = temp
+    ns.sigFP = config["test_fp"]
+
+    with open(tgt, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    manifest, signature = tapestry.write_manifest(ns, "manifest_test", {"hash_test.tar": digest}, gnupg.GPG())
+
+    listed = tapestry.read_manifest(manifest)
+    if listed != {"hash_test.tar": digest}:
+        errors.append("[ERROR] read_manifest did not return what was written. Returned: %s" % listed)
+    if not os.path.isfile(signature):
+        errors.append("[ERROR] The manifest was not signed.")
+    elif not tapestry.TaskVerify(manifest, gnupg.GPG())()[1]:
+        errors.append("[ERROR] The manifest's signature did not verify.")
+
+    return errors
+
+
+def test_TaskEncrypt_binary(config):
+    """Encrypts the test tarball again with armor disabled, and checks that the
+    output is binary OpenPGP rather than an ASCII-armored message.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    tgt = os.path.join(temp, "hash_test.tar")
+    out = os.path.join(temp, "binary")
+    if not os.path.isdir(out):
+        os.mkdir(out)
+    test_task = tapestry.TaskEncrypt(tgt, config["test_fp"], out, gnupg.GPG(), False)
+    response = test_task()
+    out_expected = os.path.join(out, "hash_test.tap")
+
+    if not os.path.isfile(out_expected):
+        errors.append("[ERROR] Test file is not found where expected.")
+        errors.append("Response from TaskEncrypt: %s" % response)
+    else:
+        with open(out_expected, "rb") as f:
+            if f.read(10) == b"-----BEGIN":
+                errors.append("[ERROR] The output was ASCII-armored despite armor being disabled.")
+
+    return errors
+
+
+def test_WorkerPool(config):
+    """Runs a handful of hashing tasks through a WorkerPool, including one
+    which raises, and checks that every result comes back in order and that
+    the failing task did not take its worker down.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    target = os.path.join(config["path_temp"], "hash_test.bak")
+    with open(target, "rb") as f:
+        expected = hashlib.sha256(f.read()).hexdigest()
+    tasks = [tapestry.TaskHashFiles([("fid_%s" % i, target)]) for i in range(4)]
+    tasks.insert(2, tapestry.TaskHashFiles(None))  # Iterating None raises inside the worker.
+
+    with tapestry.WorkerPool(config["path_temp"], 2) as pool:
+        results = pool.map(tasks)
+        after = pool.map([tapestry.TaskHashFiles([("fid_after", target)])])
+
+    if len(results) != 5:
+        errors.append("[FAIL] Expected 5 results from the pool, got %s." % len(results))
+    else:
+        for i, result in enumerate(results):
+            if i == 2:
+                if not str(result).startswith("Something has gone wrong"):
+                    errors.append("[FAIL] The failing task returned %s rather than an error." % result)
+            elif result != [("fid_%s" % (i if i < 2 else i - 1), expected)]:
+                errors.append("[FAIL] Result %s was out of order or wrong: %s" % (i, result))
+    if after != [[("fid_after", expected)]]:
+        errors.append("[FAIL] The pool did not keep working after a task failed: %s" % after)
+
+    return errors
+
+
+def test_index_sidecar(config):
+    """Writes an index sidecar from the test RIFF, then verifies and decrypts
+    it again with load_index_sidecar, confirming the index survives the
+    round trip and that the approved signer is recorded.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    riff = os.path.join(temp, "test_block.riff")
+    namespace = tapestry.Namespace()
+    namespace.drop = temp
+    namespace.activeFP = config["test_fp"]
+    namespace.sigFP = config["test_fp"]
+    namespace.binary_output = False
+    gpg = gnupg.GPG()
+
+    written = tapestry.emit_index_sidecar(namespace, "sidecar_test", riff, gpg)
+    if written != [os.path.join(temp, "sidecar_test.tapidx"), os.path.join(temp, "sidecar_test.tapidx.sig")]:
+        errors.append("[ERROR] The sidecar was not written where expected: %s" % written)
+        return errors
+    rec_index = tapestry.load_index_sidecar(written[0], temp, gpg, testing=True)
+    with open(riff, "r") as f:
+        expected = json.load(f)["index"]
+    if rec_index is None:
+        errors.append("[ERROR] The sidecar could not be loaded.")
+    elif rec_index.file_index != expected:
+        errors.append("[ERROR] The index loaded from the sidecar does not match the RIFF it was made from.")
+    elif rec_index.signer != config["test_fp"]:
+        errors.append("[ERROR] The sidecar's signer was not recorded: %s" % rec_index.signer)
+
+    return errors
+
+
+def test_TaskStreamBlock(config):
+    """Builds a small block with TaskStreamBlock, then decrypts the resulting
+    .tap and confirms that it is a compressed tarball holding the RIFF and
+    every requested member.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    members = [("member_1", os.path.join(temp, "hash_test.bak"))]
+    riff = os.path.join(temp, "test_block.riff")
+    target = os.path.join(temp, "stream_test.tap")
+    gpg = gnupg.GPG()
+
+    test_task = tapestry.TaskStreamBlock("stream_test", members, riff, config["test_fp"], temp, gpg, True, 1)
+    response = test_task()
+
+    if os.path.isfile(target):
+        with open(target, "rb") as f:
+            gpg.decrypt_file(f, output=target+".decrypted", always_trust=True)
+        with tarfile.open(target+".decrypted", "r:bz2") as tf:
+            found = tf.getnames()
+        if sorted(found) != ["member_1", "recovery-riff"]:
+            errors.append("[ERROR] The decrypted block did not contain the expected members.")
+            errors.append("Found: %s" % found)
+    else:
+        errors.append("[ERROR] Test block was not created. See response from TaskStreamBlock below.")
+        errors.append("Response: %s" % response)
+
+    return errors
+
+
+def test_TaskHashFiles(config):
+    """Hashes the known-good backup copy of the test file with TaskHashFiles and
+    compares the result against a digest computed directly with hashlib. A
+    file which does not exist is included in the batch, and should be left
+    out of the result.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    target = os.path.join(config["path_temp"], "hash_test.bak")
+    hash_control = hashlib.sha256()
+    with open(target, "rb") as f:
+        hash_control.update(f.read())
+
+    test_task = tapestry.TaskHashFiles([("control", target), ("missing", target + ".missing")])
+    response = test_task()  # The missing file should be left out, not fail the batch.
+
+    if response != [("control", hash_control.hexdigest())]:
+        errors.append("[ERROR] TaskHashFiles returned an unexpected result.")
+        errors.append("Response: %s" % response)
+
+    return errors
+
+
+def test_TaskPackBlock(config):
+    """Packs a small block using TaskPackBlock and then confirms that the
+    resulting tarball contains the RIFF and every member that was requested,
+    with nothing extra. The file encrypted by test_TaskEncrypt is first kept
+    as hash_test.bak and packed alone into hash_test.tar, for the tests which
+    follow.
 
     :param config:
     :return:
     """
     errors = []
     temp = config["path_temp"]
-    tgt_old = os.path.join(temp, "hash_test.tar")
     tgt = os.path.join(temp, "hash_test")
-    os.rename(tgt_old, tgt)
-    shutil.copy(tgt, tgt+".bak")
+    os.rename(tgt + ".tar", tgt)
+    shutil.copy(tgt, tgt + ".bak")
+    tapestry.TaskPackBlock(tgt + ".tar", [("hash_test", tgt)], os.path.join(temp, "test_block.riff"))()
+    if not os.path.isfile(tgt + ".tar"):
+        errors.append("[ERROR] The test file could not be packed alone.")
+    test_tarf = os.path.join(temp, "pack_test.tar")
+    members = [("member_1", os.path.join(temp, "hash_test.bak")),
+               ("member_2", os.path.join(temp, "hash_test.bak"))]
+    riff = os.path.join(temp, "test_block.riff")
+
+    test_task = tapestry.TaskPackBlock(test_tarf, members, riff)
+    response = test_task()
 
-    test_queue = mp.JoinableQueue()
-    q_response = mp.JoinableQueue()
-    test_task = tapestry.TaskTarBuild(tgt+".tar", "hash_test", tgt, "foo")
-    test_queue.put(test_task)
-    dict_locks = {}
-    dict_locks.update({"foo": mp.Lock()})
+    if os.path.isfile(test_tarf):
+        with tarfile.open(test_tarf, "r:") as tf:
+            found = tf.getnames()
+        expected = ["recovery-riff", "member_1", "member_2"]
+        if sorted(found) != sorted(expected):
+            errors.append("[ERROR] The tarball did not contain the expected members.")
+            errors.append("Found: %s" % found)
+    else:
+        errors.append("[ERROR] Test tarball was not created. See response from TaskPackBlock below.")
+        errors.append("Response: %s" % response)
 
-    worker = tapestry.ChildProcess(test_queue, q_response,
-                                   config["path_temp"], dict_locks, True)
-    # we need to do this to provide the locks dictionary
+    return errors
 
-    worker.start()  # So trigger the worker
-    test_queue.join()  # And wait for it to complete
 
-    response = q_response.get()
-    test_queue.put(None)  # Poison pill to kill the child process.
+def test_TaskPackBlock_inline(config):
+    """Packs a small block using TaskPackBlock while giving it the known hash
+    of each member, one of which is deliberately wrong, and confirms that the
+    packer reports the wrong one, and only that one, without any later
+    re-reading of the tarball.
 
-    if os.path.exists(tgt+".tar"):
-        pass  # doing this here leaves len(errors)=0, which is the test_case pass condition.
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    test_file = os.path.join(temp, "hash_test.bak")
+    test_tarf = os.path.join(temp, "pack_inline_test.tar")
+    members = [("member_1", test_file), ("member_2", test_file)]
+    riff = os.path.join(temp, "test_block.riff")
+    with open(test_file, "rb") as f:
+        control_hash = hashlib.sha256(f.read()).hexdigest()
+
+    response = tapestry.TaskPackBlock(test_tarf, members, riff, None, {"member_1": control_hash,
+                                                                      "member_2": "0" * 64})()
+    head, sep, failures = response.partition("\n")
+
+    if not head.startswith("Packed"):
+        errors.append("[ERROR] TaskPackBlock did not report that it had packed the block.")
+        errors.append("Response: %s" % response)
+    elif failures.strip() != "File member_2 has an invalid hash.":
+        errors.append("[ERROR] TaskPackBlock did not report exactly the member with the wrong hash.")
+        errors.append("Response: %s" % response)
     else:
-        errors.append("[ERROR] Test tarball was not created. See response from TaskTarBuild below.")
-        errors.append("Response: " % response)
+        with tarfile.open(test_tarf, "r:") as tf:
+            packed_hash = hashlib.sha256(tf.extractfile("member_1").read()).hexdigest()
+        if packed_hash != control_hash:
+            errors.append("[ERROR] The member hashed while packing was not packed intact.")
 
     return errors
 
 
-def test_TaskTarUnpack(config):
-    """Simplified test of the TaskTarUnpack class's call. Does hash validation
-    to ensure that what was unpacked matches what was packed.
+def test_TaskUnpackBlock_single(config):
+    """Simplified test of the TaskUnpackBlock class's call, against the
+    tarball packed by test_TaskPackBlock. Does hash validation to ensure that
+    what was unpacked matches what was packed.
 
     :param config:
     :return:
@@ -723,7 +1507,7 @@ def test_TaskTarUnpack(config):
     test_tarf = os.path.join(temp, "hash_test.tar")
     expected = os.path.join(temp, "unpacked")
 
-    test_task = tapestry.TaskTarUnpack(test_tarf, "hash_test", temp, "unpacked")
+    test_task = tapestry.TaskUnpackBlock(test_tarf, {"hash_test": expected})
 
     test_task()
 
@@ -745,6 +1529,166 @@ def test_TaskTarUnpack(config):
     return errors
 
 
+def test_TaskUnpackBlock_located(config):
+    """Packs a block with TaskPackBlock, recording the offsets of its members,
+    and confirms that they match where tarfile finds each member. Then unpacks
+    the second member by seeking straight to its recorded offset and checks
+    that the file is unchanged.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    test_tarf = os.path.join(temp, "located_test.tar")
+    locations_file = os.path.join(temp, "located_test.loc")
+    members = [("member_1", os.path.join(temp, "hash_test.bak")),
+               ("member_2", os.path.join(temp, "hash_test.bak"))]
+    riff = os.path.join(temp, "test_block.riff")
+
+    tapestry.TaskPackBlock(test_tarf, members, riff, locations_file)()
+    if not os.path.isfile(locations_file):
+        errors.append("[ERROR] TaskPackBlock did not write the member locations.")
+        return errors
+    with open(locations_file, "r") as f:
+        locations = json.load(f)
+    with tarfile.open(test_tarf, "r:") as tf:
+        for member in tf.getmembers():
+            if member.name != "recovery-riff" and \
+                    locations.get(member.name) != [member.offset, member.offset_data]:
+                errors.append("[ERROR] %s was recorded at %s, but is at %s." %
+                              (member.name, locations.get(member.name), [member.offset, member.offset_data]))
+
+    expected = os.path.join(temp, "located")
+    tapestry.TaskUnpackBlock(test_tarf, {"member_2": expected}, {"member_2": locations["member_2"][0]})()
+    if os.path.isfile(expected):
+        with open(os.path.join(temp, "hash_test.bak"), "rb") as f:
+            hash_control = hashlib.sha256(f.read()).hexdigest()
+        with open(expected, "rb") as f:
+            hash_test = hashlib.sha256(f.read()).hexdigest()
+        if hash_test != hash_control:
+            errors.append("[ERROR] The file unpacked from its offset has changed from the original.")
+    else:
+        errors.append("[ERROR] The file could not be unpacked from its recorded offset.")
+
+    return errors
+
+
+def test_TaskUnpackBlock(config):
+    """Packs a block with TaskPackBlock and restores both of its members with
+    a single TaskUnpackBlock, giving the recorded offset for one member and
+    not the other, so that both ways of finding a member are exercised. The
+    restored files are compared to the original.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    test_tarf = os.path.join(temp, "unpack_block_test.tar")
+    locations_file = os.path.join(temp, "unpack_block_test.loc")
+    original = os.path.join(temp, "hash_test.bak")
+    tapestry.TaskPackBlock(test_tarf, [("member_1", original), ("member_2", original)],
+                           os.path.join(temp, "test_block.riff"), locations_file)()
+    with open(locations_file, "r") as f:
+        locations = json.load(f)
+
+    destinations = {"member_1": os.path.join(temp, "unpack_block", "one"),
+                    "member_2": os.path.join(temp, "unpack_block", "deeper", "two")}
+    response = tapestry.TaskUnpackBlock(test_tarf, destinations, {"member_2": locations["member_2"][0]})()
+
+    with open(original, "rb") as f:
+        hash_control = hashlib.sha256(f.read()).hexdigest()
+    for fid, destination in destinations.items():
+        if not os.path.isfile(destination):
+            errors.append("[ERROR] %s was not restored to %s. Response: %s" % (fid, destination, response))
+            continue
+        with open(destination, "rb") as f:
+            if hashlib.sha256(f.read()).hexdigest() != hash_control:
+                errors.append("[ERROR] %s has changed from the original." % fid)
+
+    return errors
+
+
+def test_TaskUnpackBlock_copies(config):
+    """Packs a block holding one member and restores it with TaskUnpackBlock,
+    which is also told to copy it to two further places, as it would be for
+    files that were identical to it and so were packed only once. All three
+    restored files are compared to the original.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    test_tarf = os.path.join(temp, "unpack_copies_test.tar")
+    original = os.path.join(temp, "hash_test.bak")
+    tapestry.TaskPackBlock(test_tarf, [("member_1", original)], os.path.join(temp, "test_block.riff"))()
+
+    destination = os.path.join(temp, "unpack_copies", "one")
+    copies = [os.path.join(temp, "unpack_copies", "copy"), os.path.join(temp, "unpack_copies", "deeper", "copy")]
+    response = tapestry.TaskUnpackBlock(test_tarf, {"member_1": destination}, None, {"member_1": copies})()
+    if not response.startswith("Restored 3 files"):
+        errors.append("[ERROR] TaskUnpackBlock did not report restoring all three files. Response: %s" % response)
+
+    with open(original, "rb") as f:
+        hash_control = hashlib.sha256(f.read()).hexdigest()
+    for path in [destination] + copies:
+        if not os.path.isfile(path):
+            errors.append("[ERROR] Nothing was restored to %s." % path)
+            continue
+        with open(path, "rb") as f:
+            if hashlib.sha256(f.read()).hexdigest() != hash_control:
+                errors.append("[ERROR] %s has changed from the original." % path)
+
+    return errors
+
+
+def test_TaskUnpackBlock_segments(config):
+    """Splits a file into three segments with TaskHashSegments, packs the
+    segments as members of a block, and reassembles the file from them with
+    TaskUnpackBlock. The hashes TaskHashSegments reports and the reassembled
+    file are both compared to the original.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    temp = config["path_temp"]
+    test_tarf = os.path.join(temp, "unpack_segments_test.tar")
+    original = os.path.join(temp, "hash_test.bak")
+    with open(original, "rb") as f:
+        data = f.read()
+    segment_size = len(data) // 3 + 1
+
+    fid, whole, digests = tapestry.TaskHashSegments("big_file", original, segment_size)()
+    if whole != hashlib.sha256(data).hexdigest():
+        errors.append("[ERROR] TaskHashSegments returned the wrong hash for the whole file.")
+    expected = [hashlib.sha256(data[i:i + segment_size]).hexdigest() for i in range(0, len(data), segment_size)]
+    if digests != expected:
+        errors.append("[ERROR] TaskHashSegments returned the wrong segment hashes: %s" % digests)
+
+    members = [("segment_%s" % i, original) for i in range(len(expected))]
+    segments = {"segment_%s" % i: (i * segment_size, min(segment_size, len(data) - i * segment_size))
+                for i in range(len(expected))}
+    tapestry.TaskPackBlock(test_tarf, members, os.path.join(temp, "test_block.riff"), segments=segments)()
+
+    destination = os.path.join(temp, "unpack_segments", "reassembled")
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    with open(destination, "wb") as f:
+        f.truncate(len(data))
+    targets = {fid: (destination, offset) for fid, (offset, length) in segments.items()}
+    response = tapestry.TaskUnpackBlock(test_tarf, targets)()
+    if not response.startswith("Restored %s files" % len(expected)):
+        errors.append("[ERROR] TaskUnpackBlock did not report restoring every segment. Response: %s" % response)
+
+    with open(destination, "rb") as f:
+        if hashlib.sha256(f.read()).hexdigest() != whole:
+            errors.append("[ERROR] The reassembled file has changed from the original.")
+
+    return errors
+
+
 def test_media_retrieve_files(config):
     """This is a simple test that uses an expected pair of files to call the
     media_retrieve_files function from tapestry, then inspects the filesystem
@@ -793,6 +1737,43 @@ def test_media_retrieve_files(config):
     return errors
 
 
+def test_link_block(config):
+    """Places a file in a working directory with link_block, as
+    media_retrieve_files does with blocks, and then has copy_linked_blocks
+    replace the link, as it does before asking for the next disk. The file
+    placed should read the same as the original throughout, and be a copy of
+    its own once copy_linked_blocks is done.
+
+    :param config: as usual
+    :return:
+    """
+    errors = []
+    media = os.path.join(config["path_temp"], "media")
+    working = os.path.join(config["path_temp"], "linked")
+    for directory in [media, working]:
+        os.makedirs(directory, exist_ok=True)
+    source = os.path.join(media, "test-1.tap")
+    placed = os.path.join(working, "test-1.tap")
+    with open(source, "wb") as f:
+        f.write(os.urandom(4096))
+
+    linked = tapestry.link_block(source, working)
+    if linked != os.path.islink(placed) or not filecmp.cmp(source, placed, shallow=False):
+        errors.append("[ERROR] link_block did not place the file in the working directory as it said.")
+    tapestry.link_block(source, working)  # Again, as when a block is found twice.
+    if linked:
+        tapestry.copy_linked_blocks(working, ["test-1.tap"])
+    if os.path.islink(placed) or not filecmp.cmp(source, placed, shallow=False):
+        errors.append("[ERROR] The block was not copied in place of its link.")
+    os.remove(source)
+    if not os.path.isfile(placed):
+        errors.append("[ERROR] The copied block depends on the media it came from.")
+    shutil.rmtree(media)
+    shutil.rmtree(working)
+
+    return errors
+
+
 def test_parse_config(ns):
     """Loads an expected control config file, running it through (parse_config),
     then performs validation against the resulting NS object.
@@ -815,7 +1796,8 @@ def test_parse_config(ns):
         "block_size_raw": int(64 * 2 ** 20), "compid": "HAL 9000",
         "recovery_path": "The Obelisk", "uid": "anothermartian", "drop": "area51",
         "numConsumers": os.cpu_count(), "currentOS": platform.system(), "network_credential_type": "SFTP",
-        "network_credential_value": "/", "network_credential_pass": False, "do_validation": True
+        "network_credential_value": "/", "network_credential_pass": False, "do_validation": True,
+        "hash_cache_path": os.path.abspath(os.path.join("area51", "tapestry-hashcache.json"))
         }
 
     # There are, however, dynamic constraints we have to test for
@@ -962,6 +1944,49 @@ def test_sftp_place(config):
     return errors
 
 
+def test_sftp_place_resume(config):
+    """Places the first half of the test article "control-config.cfg" on the
+    SFTP server, as an interrupted upload would, then has sftp_place resume
+    it. The placed file must be whole and match the article's hash, which
+    sftp_place checks by reading it back.
+
+    :param config:
+    :return:
+    """
+    errors = []
+    ns = tapestry.Namespace()
+    ns.currentOS = platform.system()
+    ns.addrNet, ns.portNet = config["sftp_id"].split(":")
+    ns.nameNet = config["sftp_uid"]
+    ns.network_credential_value = config["sftp_credential"]
+    ns.network_credential_type = "passphrase"
+    ns.network_credential_pass = False  # We're just testing passwords here
+    tgt_file = os.path.join(config["path_config"],
+                            os.path.join("test articles", "control-config.cfg"))
+
+    connection, failure = tapestry.sftp_connect(ns)
+
+    if not connection:
+        errors.append("[ERROR] Connection attempt failed - did the previous test succeed?")
+        return errors
+
+    with open(tgt_file, "rb") as f:
+        contents = f.read()
+    connection.chdir(config["sftp_rootpath"])
+    with connection.open("control-config.cfg", "wb") as remote:
+        remote.write(contents[:len(contents) // 2])
+
+    placed, raised = tapestry.sftp_place(connection, tgt_file, config["sftp_rootpath"],
+                                         hashlib.sha256(contents).hexdigest(), resume=True)
+
+    if not placed:
+        errors.append("[ERROR] Raised: %s" % raised)
+    elif connection.stat("control-config.cfg").st_size != len(contents):
+        errors.append("[ERROR] The resumed file is not the size of the original.")
+
+    return errors
+
+
 def test_sftp_find(config):
     """Predicated on the result of test_sftp_put, this test ensures that the
     list of returned items is as expected from the sftp share.